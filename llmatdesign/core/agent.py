@@ -17,6 +17,7 @@ from pymatgen.io.ase import AseAtomsAdaptor
 from pymatgen.core.composition import Composition
 
 from matdeeplearn.common.ase_utils import MDLCalculator
+from matdeeplearn.common.calculator_service import RemoteMDLCalculator, ServiceClient
 
 from llmatdesign.modules.structure_optimization import StructureOptimizer
 
@@ -29,6 +30,7 @@ class Agent:
         bandgap_config_path=None,
         formation_energy_config_path=None,
         mp_api_key=None,
+        calculator_service=None,
     ):
         self.llm = llm
         self.save_path = Path("./outputs/") if save_path is None else Path(save_path)
@@ -38,6 +40,21 @@ class Agent:
 
         self.is_success = False
         self.mp_api_key = os.environ.get("MP_API_KEY") if mp_api_key is None else mp_api_key
+        self.calculator_service = calculator_service
+        # calculators of a shared calculator service (see
+        # matdeeplearn.common.calculator_service), served as forcefield,
+        # bandgap and formation_energy, or in-process ones from the configs
+        if self.calculator_service is not None:
+            client = ServiceClient(self.calculator_service)
+            service_names = client.call("names")
+            client.close()
+            remote = lambda name: RemoteMDLCalculator(self.calculator_service, name) if name in service_names else None
+            self.calculator = remote("forcefield")
+            self.bandgap_calculator = remote("bandgap")
+            self.formation_energy_calculator = remote("formation_energy")
+            self.structure_optimizer = StructureOptimizer(self.calculator) if self.calculator is not None else None
+            return
+
         # set up the force field calculator
         if self.forcefield_config_path is not None:
             self.calculator = MDLCalculator(self.forcefield_config_path)
@@ -135,6 +152,16 @@ class Agent:
         if len(atoms) == 1:
             # no need to optimize single-atom structure
             optimized_atoms = [atoms]
+        elif isinstance(self.calculator, RemoteMDLCalculator):
+            # relax in the calculator service, a failure there leaves the agent running
+            tic = time()
+            try:
+                optimized, energy, num_steps, seconds = self.calculator.relax(atoms)
+                optimized_atoms = [optimized]
+                print(f"Optimized 1 structure in {num_steps} steps, {time() - tic:.2f} s")
+            except (RuntimeError, EOFError, OSError) as e:
+                print(f"Optimization failed in the calculator service, using the unoptimized structure: {e}")
+                optimized_atoms = [atoms]
         else:
             tic = time()
             times = []
@@ -1,17 +1,17 @@
 import os
-import copy
 import logging
-from typing import Tuple, List
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, Tuple, List
 from time import time
 
 import ase
 import ase.io
 from ase import Atoms
-from ase.optimize import FIRE
-from ase.constraints import ExpCellFilter
-from ase.io.trajectory import Trajectory
 
 from matdeeplearn.common.ase_utils import MDLCalculator
+from matdeeplearn.common.relaxation import relax_atoms
 
 logging.basicConfig(level=logging.INFO)
 
@@ -47,25 +47,113 @@ class StructureOptimizer:
         - atoms: The optimized Atoms object.
         - time_per_step: The average time taken per optimization step.
         """
-        atoms.calc = self.calculator       
-        if self.relax_cell:
-            atoms = ExpCellFilter(atoms)
-
-        optimizer = FIRE(atoms, logfile=logfile)
-        
-        if write_traj_name is not None:
-            traj = Trajectory(write_traj_name + '.traj', 'w', atoms)
-            optimizer.attach(traj.write, interval=1)
-
-        start_time = time()
-        optimizer.run(fmax=0.001, steps=500)
-        end_time = time()
-        num_steps = optimizer.get_number_of_steps()
-        
-        if isinstance(atoms, ExpCellFilter):
-            atoms = atoms.atoms
-        time_per_step = (end_time - start_time) / num_steps if num_steps != 0 else 0
+        atoms, num_steps, seconds = self.run(atoms, logfile=logfile, write_traj_name=write_traj_name)
+        time_per_step = seconds / num_steps if num_steps != 0 else 0
         return atoms, time_per_step
+
+    def run(self, atoms: Atoms, logfile=None, write_traj_name=None) -> Tuple[Atoms, int, float]:
+        """
+        Optimize the structure like `optimize`, returning the optimized Atoms object, the number of
+        optimization steps and the total time taken in seconds.
+        """
+        num_steps, seconds = relax_atoms(
+            atoms,
+            self.calculator,
+            relax_cell=self.relax_cell,
+            logfile=logfile,
+            trajectory=None if write_traj_name is None else write_traj_name + '.traj',
+        )
+        return atoms, num_steps, seconds
+
+
+# structure optimizer of a relax_many worker process, set by _init_worker
+_worker_optimizer = None
+
+
+def _init_worker(calculator_config, rank, relax_cell, num_threads):
+    global _worker_optimizer
+    import torch
+
+    torch.set_num_threads(num_threads)
+    calculator = MDLCalculator(calculator_config, rank=rank)
+    _worker_optimizer = StructureOptimizer(calculator, relax_cell=relax_cell)
+
+
+def _relax(atoms: Atoms) -> Tuple[Atoms, float, int, float]:
+    optimized, num_steps, seconds = _worker_optimizer.run(atoms)
+    energy = float(optimized.get_potential_energy())
+    optimized.calc = None
+    return optimized, energy, num_steps, seconds
+
+
+def relax_many(atoms_list: List[Atoms],
+               n_workers: int,
+               calculator_config,
+               relax_cell: bool = False,
+               rank: str = 'cpu',
+               num_threads: int = None,
+               max_restarts: int = 3,
+               ) -> Iterator[Tuple[int, Atoms, float, int, float]]:
+    """
+    Optimize many structures in a pool of worker processes, each holding a warm calculator, and
+    yield the results as the workers finish them (not in input order).
+
+    Parameters:
+    - atoms_list: The Atoms objects to be optimized, they are not modified.
+    - n_workers: Number of worker processes.
+    - calculator_config: MDLCalculator config (or path to one) of the worker calculators.
+    - relax_cell (bool): If True, the cells are relaxed as well.
+    - rank: Device of the worker calculators.
+    - num_threads: Torch threads per worker, defaults to the number of cores divided by n_workers.
+    - max_restarts: Number of times the pool is restarted after a worker died.
+
+    Yields:
+    - index: Position of the structure in atoms_list.
+    - atoms: The optimized Atoms object (without calculator).
+    - energy: Energy of the optimized structure.
+    - steps: Number of optimization steps.
+    - time: Time taken for the optimization in seconds.
+
+    Structures whose optimization raises are logged and skipped. If a worker dies (e.g. out of
+    memory), the pool is restarted and the unfinished structures are submitted again, up to
+    max_restarts times; BrokenProcessPool is raised if the pool breaks before finishing any
+    structure (e.g. the calculator can not be loaded) or after max_restarts restarts.
+    """
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    unfinished = dict(enumerate(atoms_list))
+    restarts = 0
+    while unfinished:
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(calculator_config, rank, relax_cell, num_threads),
+        )
+        finished = 0
+        try:
+            futures = {pool.submit(_relax, atoms.copy()): idx for idx, atoms in unfinished.items()}
+            for future in as_completed(futures):
+                idx = futures[future]
+                try:
+                    optimized, energy, num_steps, seconds = future.result()
+                except BrokenProcessPool:
+                    if finished == 0 or restarts >= max_restarts:
+                        raise
+                    break
+                except Exception as e:
+                    logging.warning(f"Optimization of structure {idx} failed: {e!r}")
+                    del unfinished[idx]
+                    continue
+                del unfinished[idx]
+                finished += 1
+                yield idx, optimized, energy, num_steps, seconds
+        finally:
+            # a caller stopping early does not wait for the queued structures
+            pool.shutdown(wait=False, cancel_futures=True)
+        if unfinished:
+            restarts += 1
+            logging.warning(f"A relax_many worker died, restarting the pool for {len(unfinished)} structures.")
     
     
 if __name__ == '__main__':
@@ -74,27 +162,24 @@ if __name__ == '__main__':
     
     # config for calculator
     calculator_config = './configs/optimize/torchmdnet.yml'
-    calculator = MDLCalculator(calculator_config, rank=device)
     
     # You need to turn structures into a list of Atoms objects
     # MDLCalculator has a data_to_atoms_list that can convert a Data object to a list of Atoms objects
     original_atoms: List[Atoms] = [ase.io.read("structures/zmatrix/2.cif")]
-    optimized_atoms: List[Atoms] = []
-    
-    optim = StructureOptimizer(calculator, relax_cell=True)
+    n_workers = 4
+    optimized_atoms: List[Atoms] = [None] * len(original_atoms)
     start = time()
     times = []
 
-    print(f"Optimizing {len(original_atoms)} structures...")
+    print(f"Optimizing {len(original_atoms)} structures with {n_workers} workers...")
         
-    for idx, atoms in enumerate(original_atoms):
-        atoms.set_calculator(calculator)
-        to_optim = copy.deepcopy(atoms)
-        optimized, time_per_step = optim.optimize(to_optim)
-        times.append(time_per_step)
-        optimized_atoms.append(optimized)
-        if (idx + 1) % 20 == 0:
-            logging.info(f"Completed optimizing {idx + 1} structures.")
+    for count, (idx, optimized, energy, num_steps, seconds) in enumerate(
+        relax_many(original_atoms, n_workers, calculator_config, relax_cell=True, rank=device)
+    ):
+        times.append(seconds / num_steps if num_steps != 0 else 0)
+        optimized_atoms[idx] = optimized
+        if (count + 1) % 20 == 0:
+            logging.info(f"Completed optimizing {count + 1} structures.")
     end = time()
 
     print(f"Total time taken: {end - start} seconds")
\ No newline at end of file
@@ -6,10 +6,13 @@ import torch
 import yaml
 from ase import Atoms
 from ase.geometry import Cell
-from ase.calculators.calculator import Calculator
+from ase.calculators.calculator import Calculator, PropertyNotImplementedError
 from torch_geometric.data.data import Data
 from torch_geometric.loader import DataLoader
 
+from matdeeplearn.common import model_cache
+from matdeeplearn.common.model_export import compile_model, compile_options
+from matdeeplearn.common.precision import inference_autocast, to_fp32
 from matdeeplearn.common.registry import registry
 from matdeeplearn.models.base_model import BaseModel
 from matdeeplearn.preprocessor.helpers import generate_node_features
@@ -46,15 +49,25 @@ class MDLCalculator(Calculator):
         else:
             raise NotImplementedError('Unsupported config type.')
                 
-        gradient = config["model"].get("gradient", False)
+        self.gradient = config["model"].get("gradient", False)
         otf_edge_index = config["model"].get("otf_edge_index", False)
         otf_edge_attr = config["model"].get("otf_edge_attr", False)
         self.otf_node_attr = config["model"].get("otf_node_attr", False)
-        assert otf_edge_index and otf_edge_attr and gradient, "To use this calculator to calculate forces and stress, you should set otf_edge_index, oft_edge_attr and gradient to True."
+        assert otf_edge_index and otf_edge_attr, "To use this calculator, you should set otf_edge_index and oft_edge_attr to True."
+        if not self.gradient:
+            logging.info("MDLCalculator: gradient is False, only the energy (or predicted property) is calculated.")
         
         self.device = rank if torch.cuda.is_available() else 'cpu'
         self.models = MDLCalculator._load_model(config, self.device)
         self.n_neighbors = config['dataset']['preprocess_params'].get('n_neighbors', 250)
+        self.node_representation = config['dataset']['preprocess_params'].get('node_representation', 'onehot')
+        # fp32, bf16 or fp16, see matdeeplearn.common.precision
+        self.precision = config['task'].get('inference_precision', 'fp32')
+        # models loaded with gradients (exported int8 models have none)
+        self._model_gradient = [getattr(model, "_orig_mod", model).gradient for model in self.models]
+        if self.gradient and not all(self._model_gradient):
+            logging.warning("MDLCalculator: the loaded models have no gradients (e.g. int8 quantized artifacts), only the energy (or predicted property) is calculated.")
+            self.gradient = False
 
     def direct_calculate(self, atoms: Atoms) -> float:
         """
@@ -66,30 +79,27 @@ class MDLCalculator(Calculator):
         Returns:
         - property (float): return the calculated property directly.
         """
-        cell = torch.tensor(atoms.cell.array, dtype=torch.float32)
-        pos = torch.tensor(atoms.positions, dtype=torch.float32)
-        atomic_numbers = torch.LongTensor(atoms.get_atomic_numbers())
-
-        data = Data(n_atoms=len(atomic_numbers), pos=pos, cell=cell.unsqueeze(dim=0),
-            z=atomic_numbers, structure_id=atoms.info.get('structure_id', None))
-
-        # Generate node features
-        if not self.otf_node_attr:
-            generate_node_features(data, self.n_neighbors, device=self.device)
-            data.x = data.x.to(torch.float32)
+        return self.calculate_energies([atoms])[0].item()
 
-        data_list = [data]
-        loader = DataLoader(data_list, batch_size=1)
-        loader_iter = iter(loader)
-        batch = next(loader_iter).to(self.device)
-
-        out_list = []
-        for model in self.models:
-            out_list.append(model(batch))
+    def calculate_energies(self, atoms_list: List[Atoms], batch_size: int = 64) -> np.ndarray:
+        """
+        Calculate the energy (or predicted property) of many structures, batch_size structures per
+        model call, without forces, stresses or autograd. Use this to rank candidate structures.
 
-        calculated_property = torch.stack([entry["output"] for entry in out_list]).mean(dim=0)
+        Args:
+        - atoms_list (list): The atomic structures for which calculations are to be performed.
+        - batch_size (int): Number of structures per batch.
 
-        return calculated_property.detach().cpu().numpy().squeeze().item()
+        Returns:
+        - energies (np.ndarray): The ensemble mean prediction of every structure, in input order.
+        """
+        data_list = [self._atoms_to_data(atoms) for atoms in atoms_list]
+        energies = []
+        for batch in DataLoader(data_list, batch_size=batch_size):
+            out_list = self._predict(batch.to(self.device), forces=False, stress=False)
+            energy = torch.stack([entry["output"] for entry in out_list]).mean(dim=0)
+            energies.append(energy.detach().cpu().numpy().reshape(batch.num_graphs, -1))
+        return np.concatenate(energies).squeeze(-1)
 
     def calculate(self, atoms: Atoms, properties=implemented_properties, system_changes=None) -> None:
         """
@@ -106,9 +116,70 @@ class MDLCalculator(Calculator):
         Note:
         - This method performs energy, forces, and stress calculations using a neural network-based calculator.
             The results are stored in the instance variable 'self.results' as 'energy', 'forces', and 'stress'.
+        - Only the requested properties are computed: energy alone runs without autograd, and the stress (and
+            the displacement graph it needs) is only computed if it is requested, e.g. a fixed-cell relaxation
+            only requests forces.
         """
         Calculator.calculate(self, atoms, properties, system_changes)
+        self.results = {}
+        compute_forces = "forces" in properties or "stress" in properties
+        compute_stress = "stress" in properties
+        if compute_forces and not self.gradient:
+            raise PropertyNotImplementedError("Forces and stress need models with gradient set to True.")
 
+        batch = next(iter(DataLoader([self._atoms_to_data(atoms)], batch_size=1))).to(self.device)
+        out_list = self._predict(batch, forces=compute_forces, stress=compute_stress)
+
+        energy = torch.stack([entry["output"] for entry in out_list]).mean(dim=0)
+        self.results['energy'] = energy.detach().cpu().numpy().squeeze()
+        if compute_forces:
+            forces = torch.stack([entry["pos_grad"] for entry in out_list]).mean(dim=0)
+            self.results['forces'] = forces.detach().cpu().numpy().squeeze()
+        if compute_stress:
+            stresses = torch.stack([entry["cell_grad"] for entry in out_list]).mean(dim=0)
+            self.results['stress'] = stresses.squeeze().detach().cpu().numpy().squeeze()
+
+    def calculate_many(self, atoms_list: List[Atoms], properties=implemented_properties, batch_size: int = 64) -> List[dict]:
+        """
+        Calculate energy, forces, and stress of many structures, batch_size structures per model call.
+
+        Args:
+        - atoms_list (list): The atomic structures for which calculations are to be performed.
+        - properties (list): List of properties to calculate. Defaults to ['energy', 'forces', 'stress'].
+        - batch_size (int): Number of structures per batch.
+
+        Returns:
+        - results (list): One dict per structure, in input order, with the same entries as 'self.results'
+            after 'calculate'.
+        """
+        compute_forces = "forces" in properties or "stress" in properties
+        compute_stress = "stress" in properties
+        if compute_forces and not self.gradient:
+            raise PropertyNotImplementedError("Forces and stress need models with gradient set to True.")
+
+        data_list = [self._atoms_to_data(atoms) for atoms in atoms_list]
+        results = []
+        for batch in DataLoader(data_list, batch_size=batch_size):
+            batch = batch.to(self.device)
+            out_list = self._predict(batch, forces=compute_forces, stress=compute_stress)
+
+            energy = torch.stack([entry["output"] for entry in out_list]).mean(dim=0)
+            batch_results = [{'energy': e.squeeze()} for e in energy.detach().cpu().numpy().reshape(batch.num_graphs, -1)]
+            if compute_forces:
+                forces = torch.stack([entry["pos_grad"] for entry in out_list]).mean(dim=0)
+                for result, f in zip(batch_results, torch.split(forces.detach().cpu(), batch.n_atoms.tolist())):
+                    result['forces'] = f.numpy()
+            if compute_stress:
+                stresses = torch.stack([entry["cell_grad"] for entry in out_list]).mean(dim=0)
+                for result, s in zip(batch_results, stresses.detach().cpu().numpy()):
+                    result['stress'] = s.squeeze()
+            results.extend(batch_results)
+        return results
+
+    def _atoms_to_data(self, atoms: Atoms) -> Data:
+        """
+        Convert an ase.Atoms object to a Data object the models take.
+        """
         cell = torch.tensor(atoms.cell.array, dtype=torch.float32)
         pos = torch.tensor(atoms.positions, dtype=torch.float32)
         atomic_numbers = torch.LongTensor(atoms.get_atomic_numbers())
@@ -118,25 +189,22 @@ class MDLCalculator(Calculator):
         
         # Generate node features
         if not self.otf_node_attr:
-            generate_node_features(data, self.n_neighbors, device=self.device)
+            generate_node_features(data, self.n_neighbors, device=self.device, node_representation=self.node_representation)
             data.x = data.x.to(torch.float32)
-        
-        data_list = [data]
-        loader = DataLoader(data_list, batch_size=1)
-        loader_iter = iter(loader)
-        batch = next(loader_iter).to(self.device)
-        
-        out_list = []
-        for model in self.models:      
-            out_list.append(model(batch))
+        return data
 
-        energy = torch.stack([entry["output"] for entry in out_list]).mean(dim=0)
-        forces = torch.stack([entry["pos_grad"] for entry in out_list]).mean(dim=0)
-        stresses = torch.stack([entry["cell_grad"] for entry in out_list]).mean(dim=0)
-        
-        self.results['energy'] = energy.detach().cpu().numpy().squeeze()
-        self.results['forces'] = forces.detach().cpu().numpy().squeeze()
-        self.results['stress'] = stresses.squeeze().detach().cpu().numpy().squeeze()
+    def _predict(self, batch, forces: bool, stress: bool) -> List[dict]:
+        """
+        Run every model on a batch, with autograd only for the requested gradients.
+        """
+        # the choice is passed with the batch, the shared models are not changed (see model_cache)
+        batch.gradient = forces
+        batch.compute_stress = stress
+        out_list = []
+        with torch.set_grad_enabled(forces), inference_autocast(self.precision, self.device):
+            for model in self.models:
+                out_list.append(to_fp32(model(batch)))
+        return out_list
         
     @staticmethod
     def data_to_atoms_list(data: Data) -> List[Atoms]:
@@ -166,11 +234,47 @@ class MDLCalculator(Calculator):
             atoms_list[i].structure_id = data.structure_id[i][0]
         return atoms_list
     
+    @staticmethod
+    def model_args(config: dict) -> dict:
+        """
+        This static method returns the constructor arguments of the models of a configuration.
+
+        Parameters:
+        - config (dict): Configuration dictionary containing model and dataset parameters.
+
+        Returns:
+        - model_args: Keyword arguments for the model class.
+        """
+        graph_config = config['dataset']['preprocess_params']
+        model_config = config['model']
+
+        # otf node features use the same representation as preprocessing
+        model_config.setdefault("node_representation", graph_config.get("node_representation", "onehot"))
+        return dict(
+                node_dim=graph_config["node_dim"], 
+                edge_dim=graph_config["edge_dim"], 
+                output_dim=1, 
+                cutoff_radius=graph_config["cutoff_radius"], 
+                n_neighbors=graph_config["n_neighbors"], 
+                graph_method=graph_config["edge_calc_method"], 
+                num_offsets=graph_config["num_offsets"], 
+                **model_config
+                )
+
     @staticmethod
     def _load_model(config: dict, rank: str) -> List[BaseModel]:
         """
         This static method loads a model based on the provided configuration.
 
+        Checkpoints exported with matdeeplearn.common.model_export are loaded as
+        they were exported (model arguments, weights and compile options). Other
+        models are compiled with torch.compile if model.compile is set.
+
+        Loaded models come from matdeeplearn.common.model_cache: they are shared
+        by all calculators of the process using the same checkpoint, in eval
+        mode and read-only. Checkpoints are memory-mapped unless
+        task.mmap_checkpoints is False.
+
         Parameters:
         - config (dict): Configuration dictionary containing model and dataset parameters.
         - rank: Rank information for distributed training.
@@ -179,41 +283,40 @@ class MDLCalculator(Calculator):
         - model_list: A list of loaded models.
         """
         
-        graph_config = config['dataset']['preprocess_params']
         model_config = config['model']
         
         model_list = []
         model_name = model_config["name"]
         logging.info(f'MDLCalculator: setting up {model_name} for calculation')
         # Obtain node, edge, and output dimensions for model initialization   
-        for _ in range(model_config["model_ensemble"]): 
-            node_dim = graph_config["node_dim"]
-            edge_dim = graph_config["edge_dim"]   
-
-            model_cls = registry.get_model_class(model_name)
-            model = model_cls(
-                    node_dim=node_dim, 
-                    edge_dim=edge_dim, 
-                    output_dim=1, 
-                    cutoff_radius=graph_config["cutoff_radius"], 
-                    n_neighbors=graph_config["n_neighbors"], 
-                    graph_method=graph_config["edge_calc_method"], 
-                    num_offsets=graph_config["num_offsets"], 
-                    **model_config
-                    )
-            model = model.to(rank)
-            model_list.append(model)
+        model_args = MDLCalculator.model_args(config)
         
         checkpoints = config['task']["checkpoint_path"].split(',')
-        if len(checkpoints) == 0:
-            logging.warning("MDLCalculator: No checkpoint.pt file is found, and untrained models are used for prediction.")
-        else:
-            for i in range(len(checkpoints)):
+        mmap = config['task'].get('mmap_checkpoints', True)
+        for i in range(model_config["model_ensemble"]): 
+            model = None
+            if i < len(checkpoints):
                 try:
-                    checkpoint = torch.load(checkpoints[i])
-                    model_list[i].load_state_dict(checkpoint["state_dict"])
-                    logging.info(f'MDLCalculator: weights for model No.{i+1} loaded from {checkpoints[i]}')
+                    # shared with every calculator loading the same checkpoint
+                    model = model_cache.load_model(checkpoints[i], model_name, model_args, rank, mmap)
+                    logging.info(f'MDLCalculator: model No.{i+1} loaded from {checkpoints[i]}')
                 except ValueError:
                     logging.warning(f"MDLCalculator: No checkpoint.pt file is found for model No.{i+1}, and an untrained model is used for prediction.")
+            if model is None:
+                model_cls = registry.get_model_class(model_name)
+                model = model_cls(**model_args)
+                model = model.to(rank)
+            model_list.append(model)
+
+        if model_config.get("edge_padding") is not None:
+            for model in model_list:
+                if not getattr(model, "static_shapes", False):
+                    logging.warning(f"MDLCalculator: {model_name} does not support padded edges (static_shapes), edge_padding is ignored.")
+                    break
+
+        options = compile_options(model_config.get("compile", False))
+        if options is not None:
+            logging.info(f'MDLCalculator: compiling {model_name} with torch.compile')
+            model_list = [compile_model(model, **options) for model in model_list]
 
         return model_list
@@ -0,0 +1,402 @@
+"""
+Calculator service: one pool of worker processes holding warm MDLCalculator
+models, shared by any number of agent processes over a Unix socket.
+
+Clients send energy/forces/stress calculations, property predictions
+(energies) and relaxations. Calculations and predictions that arrive from
+different clients within batch_wait seconds are merged into one batched
+model call per calculator, relaxations run one per worker. A failing
+request (or a crashed worker) returns an error to its client only; the
+pool is restarted after a crash. Start a service with
+
+``python -m matdeeplearn.common.calculator_service --address /tmp/mdl.sock --workers 4 --config forcefield=configs/forcefield.yml --config bandgap=configs/bandgap.yml``
+
+and replace MDLCalculator(config) by RemoteMDLCalculator("/tmp/mdl.sock",
+"forcefield") in the clients.
+"""
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from ase.calculators.calculator import Calculator
+
+from matdeeplearn.common.relaxation import relax_atoms
+
+# calculators of a worker process, by name, set by _init_worker
+_calculators = {}
+
+
+def _init_worker(configs, rank, num_threads):
+    import torch
+
+    from matdeeplearn.common.ase_utils import MDLCalculator
+
+    torch.set_num_threads(num_threads)
+    for name, config in configs.items():
+        _calculators[name] = MDLCalculator(config, rank=rank)
+
+
+def _run_calculate(name, atoms_list, properties):
+    return _calculators[name].calculate_many(atoms_list, properties)
+
+
+def _run_energies(name, atoms_list):
+    return list(_calculators[name].calculate_energies(atoms_list))
+
+
+def _run_relax(name, atoms, relax_cell=False, fmax=0.001, steps=500):
+    atoms = atoms.copy()
+    num_steps, seconds = relax_atoms(
+        atoms, _calculators[name], relax_cell=relax_cell, fmax=fmax, steps=steps
+    )
+    energy = float(atoms.get_potential_energy())
+    atoms.calc = None
+    return atoms, energy, num_steps, seconds
+
+
+class CalculatorService:
+    """
+    Serve the calculators of configs (name -> config or path to a yaml
+    config in the MDLCalculator format) on a Unix socket
+
+    Parameters
+    ----------
+        configs: dict
+            calculator configs by name, every worker loads all of them
+
+        address: str
+            path of the Unix socket
+
+        n_workers: int
+            worker processes
+
+        num_threads: int
+            torch threads per worker, defaults to the cores divided by n_workers
+
+        max_batch: int
+            largest number of structures merged into one batched call
+
+        batch_wait: float
+            seconds a request waits for others to batch with
+    """
+
+    def __init__(
+        self,
+        configs,
+        address,
+        n_workers=1,
+        rank="cpu",
+        num_threads=None,
+        max_batch=64,
+        batch_wait=0.005,
+        authkey=None,
+    ):
+        self.configs = dict(configs)
+        self.address = address
+        self.n_workers = n_workers
+        self.rank = rank
+        self.num_threads = num_threads or max(1, (os.cpu_count() or 1) // n_workers)
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.authkey = authkey
+
+        self._requests = queue.Queue()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._listener = None
+        self._running = False
+
+    def _start_pool(self):
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.configs, self.rank, self.num_threads),
+        )
+
+    def _submit(self, fn, *args, **kwargs):
+        with self._pool_lock:
+            try:
+                return self._pool.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                logging.warning("Calculator service: worker pool crashed, restarting it")
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._start_pool()
+                return self._pool.submit(fn, *args, **kwargs)
+
+    @staticmethod
+    def _reply(client, request_id, ok, payload):
+        conn, lock = client
+        try:
+            with lock:
+                conn.send((request_id, ok, payload))
+        except (OSError, EOFError):
+            logging.debug("Calculator service: client disconnected before its reply")
+
+    def _handle_client(self, conn):
+        client = (conn, threading.Lock())
+        while self._running:
+            try:
+                request_id, method, kwargs = conn.recv()
+            except (EOFError, OSError):
+                break
+            if method == "names":
+                self._reply(client, request_id, True, sorted(self.configs))
+            elif method not in ("calculate", "energies", "relax"):
+                self._reply(client, request_id, False, "Unknown method {}".format(method))
+            elif kwargs.get("name") not in self.configs:
+                self._reply(client, request_id, False, "Unknown calculator {}".format(kwargs.get("name")))
+            else:
+                self._requests.put((client, request_id, method, kwargs))
+        conn.close()
+
+    def _dispatch(self):
+        while self._running:
+            try:
+                pending = [self._requests.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.batch_wait
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in pending:
+                client, request_id, method, kwargs = request
+                if method == "relax":
+                    self._submit_batch([request])
+                else:
+                    key = (method, kwargs["name"], tuple(kwargs.get("properties", ())))
+                    groups.setdefault(key, []).append(request)
+
+            for requests in groups.values():
+                self._submit_batch(requests)
+
+    def _submit_batch(self, requests):
+        """
+        run a relax request, or calculate or energies requests of one
+        calculator as one batched call
+        """
+        _, _, method, kwargs = requests[0]
+        try:
+            if method == "relax":
+                future = self._submit(_run_relax, **kwargs)
+            else:
+                atoms_list = [atoms for request in requests for atoms in request[3]["atoms_list"]]
+                if method == "calculate":
+                    future = self._submit(_run_calculate, kwargs["name"], atoms_list, list(kwargs["properties"]))
+                else:
+                    future = self._submit(_run_energies, kwargs["name"], atoms_list)
+        except RuntimeError:
+            # the pool is shut down, the service is stopping
+            for client, request_id, _, _ in requests:
+                self._reply(client, request_id, False, "Calculator service: stopped")
+            return
+        future.add_done_callback(self._reply_batch(requests))
+
+    def _reply_batch(self, requests):
+        """
+        callback sending each request of a batched call its share of the
+        results; a failed batch of several requests is run again one request
+        at a time, so only the failing request gets the error
+        """
+
+        def callback(future):
+            try:
+                results = future.result()
+            except Exception as e:
+                if len(requests) > 1:
+                    logging.debug(f"Calculator service: batch of {len(requests)} requests failed, running them one by one")
+                    for request in requests:
+                        self._submit_batch([request])
+                    return
+                if isinstance(e, BrokenProcessPool):
+                    error = "Calculator service: worker crashed"
+                else:
+                    error = traceback.format_exc()
+                self._reply(requests[0][0], requests[0][1], False, error)
+                return
+
+            if requests[0][2] == "relax":
+                self._reply(requests[0][0], requests[0][1], True, results)
+                return
+            start = 0
+            for client, request_id, _, kwargs in requests:
+                count = len(kwargs["atoms_list"])
+                self._reply(client, request_id, True, results[start:start + count])
+                start += count
+
+        return callback
+
+    def serve_forever(self):
+        """
+        start the workers and serve clients until stop is called
+        """
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self._start_pool()
+        # load the models in every worker before accepting clients
+        warmup = [self._pool.submit(time.sleep, 0.1) for _ in range(self.n_workers)]
+        for future in warmup:
+            future.result()
+
+        self._running = True
+        self._listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        logging.info(
+            "Calculator service: {} on {} with {} workers".format(
+                sorted(self.configs), self.address, self.n_workers
+            )
+        )
+        try:
+            while self._running:
+                try:
+                    conn = self._listener.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self._handle_client, args=(conn,), daemon=True).start()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._running = False
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class ServiceClient:
+    """
+    Connection to a CalculatorService, safe to share between threads
+    """
+
+    def __init__(self, address, authkey=None, timeout=60):
+        start = time.monotonic()
+        while True:
+            try:
+                self.conn = Client(address, family="AF_UNIX", authkey=authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() - start > timeout:
+                    raise
+                time.sleep(0.1)
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def call(self, method, **kwargs):
+        with self._lock:
+            request_id = next(self._ids)
+            self.conn.send((request_id, method, kwargs))
+            while True:
+                reply_id, ok, payload = self.conn.recv()
+                if reply_id == request_id:
+                    break
+        if not ok:
+            raise RuntimeError(payload)
+        return payload
+
+    def close(self):
+        self.conn.close()
+
+
+class RemoteMDLCalculator(Calculator):
+    """
+    ASE calculator running the calculator calculator_name of a CalculatorService,
+    a drop-in replacement of MDLCalculator
+    """
+
+    implemented_properties = ["energy", "forces", "stress"]
+
+    def __init__(self, address, calculator_name, authkey=None, **kwargs):
+        Calculator.__init__(self, **kwargs)
+        self.address = address
+        self.calculator_name = calculator_name
+        self.authkey = authkey
+        self.client = ServiceClient(address, authkey=authkey)
+
+    def calculate(self, atoms=None, properties=implemented_properties, system_changes=None) -> None:
+        Calculator.calculate(self, atoms, properties, system_changes)
+        self.results = self.client.call(
+            "calculate", name=self.calculator_name, atoms_list=[self.atoms.copy()], properties=list(properties)
+        )[0]
+
+    def direct_calculate(self, atoms):
+        return float(self.calculate_energies([atoms])[0])
+
+    def calculate_energies(self, atoms_list):
+        energies = self.client.call(
+            "energies", name=self.calculator_name, atoms_list=[atoms.copy() for atoms in atoms_list]
+        )
+        return np.array(energies)
+
+    def relax(self, atoms, relax_cell=False, fmax=0.001, steps=500):
+        """
+        relax a copy of atoms in the service with FIRE (see
+        matdeeplearn.common.relaxation.relax_atoms)
+
+        Returns the relaxed atoms (without calculator), their energy, the
+        number of optimizer steps and the wall time in seconds.
+        """
+        return self.client.call(
+            "relax", name=self.calculator_name, atoms=atoms.copy(), relax_cell=relax_cell, fmax=fmax, steps=steps
+        )
+
+    def __getstate__(self):
+        # the connection is not picklable, e.g. for deepcopies of atoms
+        state = self.__dict__.copy()
+        del state["client"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.client = ServiceClient(self.address, authkey=self.authkey)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MatDeepLearn calculator service")
+    parser.add_argument("--address", default="/tmp/matdeeplearn_calculator.sock", type=str, help="Path of the Unix socket")
+    parser.add_argument("--config", action="append", required=True, type=str, help="name=path of a calculator config, repeatable")
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes")
+    parser.add_argument("--threads", default=None, type=int, help="Torch threads per worker")
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--batch_wait", default=0.005, type=float, help="Seconds a request waits to be batched with others")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    configs = dict(entry.split("=", 1) for entry in args.config)
+    service = CalculatorService(
+        configs,
+        args.address,
+        n_workers=args.workers,
+        rank=args.device,
+        num_threads=args.threads,
+        batch_wait=args.batch_wait,
+    )
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
+import queue
+import threading
 import warnings
 from typing import List
 
+import numpy as np
 import torch
-from torch.utils.data import random_split
+from torch.utils.data import (
+    BatchSampler,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+    Subset,
+    random_split,
+)
+from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 from torch_geometric.transforms import Compose
 
 from matdeeplearn.common.registry import registry
-from matdeeplearn.preprocessor.datasets import LargeStructureDataset, StructureDataset
+from matdeeplearn.preprocessor.datasets import (
+    LargeStructureDataset,
+    MemmapStructureDataset,
+    StructureDataset,
+)
 
 
 # train test split
@@ -86,6 +101,7 @@ def get_dataset(
     transform_list: List[dict] = [],
     large_dataset=False,
     dataset_device=None,
+    memory_map=False,
 ):
     """
     get dataset according to data_path
@@ -99,6 +115,10 @@ def get_dataset(
         path to the folder containing data.pt file
 
     transform_list: transformation function/classes to be applied
+
+    large_dataset: load the sharded format written with large_dataset=True
+
+    memory_map: load the memory-mapped format written with memory_map=True
     """
 
     # get on the fly transforms for use on dataset access
@@ -107,18 +127,623 @@ def get_dataset(
     # check if large dataset is needed
     if large_dataset:
         Dataset = LargeStructureDataset
+    elif memory_map:
+        Dataset = MemmapStructureDataset
     else:
         Dataset = StructureDataset
 
-    composition = Compose(otf_transforms) if len(otf_transforms) >= 1 else None
+    # on the fly transforms expect compute dtypes, widen compact structures first
+    composition = Compose([widen_batch] + otf_transforms) if len(otf_transforms) >= 1 else None
         
     dataset = Dataset(data_path, processed_data_path="", processed_file_name=processed_file_name, transform=composition, device=dataset_device)
 
     return dataset
 
 
+def widen_batch(batch):
+    """
+    widen the narrow storage dtypes of compact datasets (see
+    DataProcessor compact_storage) back to compute dtypes, for a batch or
+    a single structure
+    """
+    for key, value in batch.to_dict().items():
+        if isinstance(value, torch.Tensor):
+            if key == "cell_offsets" and not value.is_floating_point():
+                batch[key] = value.float()
+            elif value.dtype in (torch.int8, torch.int16, torch.int32):
+                batch[key] = value.long()
+            elif value.dtype == torch.float16:
+                batch[key] = value.float()
+        elif key == "structure_id" and isinstance(value, str):
+            batch[key] = [value]
+        elif key == "structure_id" and len(value) > 0 and isinstance(value[0], str):
+            batch[key] = [[structure_id] for structure_id in value]
+    return batch
+
+
+class WideningCollater:
+    """
+    wraps the collate function of a DataLoader to widen compact batches
+    """
+
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, data_list):
+        return widen_batch(self.collate_fn(data_list))
+
+
+def get_graph_sizes(dataset):
+    """
+    number of atoms and edges of every structure in dataset, read from the
+    collated slices where possible instead of loading every structure
+    """
+    if isinstance(dataset, Subset):
+        n_atoms, n_edges = get_graph_sizes(dataset.dataset)
+        indices = np.asarray(dataset.indices)
+        return n_atoms[indices], n_edges[indices]
+
+    if isinstance(dataset, LargeStructureDataset):
+        sizes = dataset.graph_sizes()
+        if sizes is not None:
+            return sizes
+
+    slices = getattr(dataset, "slices", None)
+    if slices is None and isinstance(dataset, MemmapStructureDataset):
+        if dataset._arrays is None:
+            dataset._open()
+        slices = dataset._slices
+
+    if slices is not None and "pos" in slices:
+        n_atoms = np.diff(np.asarray(slices["pos"]))
+        if "edge_index" in slices:
+            n_edges = np.diff(np.asarray(slices["edge_index"]))
+        else:
+            n_edges = np.zeros_like(n_atoms)
+        return n_atoms, n_edges
+
+    n_atoms, n_edges = [], []
+    for data in dataset:
+        n_atoms.append(data.pos.shape[0])
+        n_edges.append(data.edge_index.shape[1] if "edge_index" in data else 0)
+    return np.asarray(n_atoms), np.asarray(n_edges)
+
+
+class SizeBucketBatchSampler(Sampler):
+    """
+    Batch sampler that packs structures into batches under a budget of
+    atoms and/or edges instead of a fixed number of structures.
+
+    Every epoch the indices are shuffled (seeded by seed + epoch), split
+    into pools of bucket_size batches worth of structures, sorted by size
+    within each pool and packed greedily, so batches hold structures of
+    similar size. The batch order is shuffled again and batches are
+    distributed over num_replicas ranks, each rank getting the same number
+    of batches. A structure larger than the budget forms its own batch.
+
+    Parameters
+    ----------
+        dataset: torch.utils.data.Dataset
+            dataset (or Subset) to sample from
+
+        max_atoms: int
+            maximum number of atoms per batch
+
+        max_edges: int
+            maximum number of edges per batch
+
+        max_graphs: int
+            maximum number of structures per batch
+
+        shuffle: bool
+            shuffle the structures and the batches every epoch
+
+        num_replicas: int
+            number of distributed processes
+
+        rank: int
+            rank of the current process
+
+        seed: int
+            random seed, must be identical on all ranks
+
+        bucket_size: int
+            number of batches that are packed together
+    """
+
+    def __init__(
+        self,
+        dataset,
+        max_atoms: int = None,
+        max_edges: int = None,
+        max_graphs: int = None,
+        shuffle: bool = True,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        bucket_size: int = 100,
+    ):
+        if max_atoms is None and max_edges is None and max_graphs is None:
+            raise ValueError("SizeBucketBatchSampler needs max_atoms, max_edges or max_graphs.")
+
+        self.dataset = dataset
+        self.max_atoms = max_atoms
+        self.max_edges = max_edges
+        self.max_graphs = max_graphs
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        self.n_atoms, self.n_edges = get_graph_sizes(dataset)
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def unsharded(self, shuffle=False):
+        """
+        a copy of this sampler that yields all batches on a single process
+        """
+        return SizeBucketBatchSampler(
+            self.dataset,
+            max_atoms=self.max_atoms,
+            max_edges=self.max_edges,
+            max_graphs=self.max_graphs,
+            shuffle=shuffle,
+            seed=self.seed,
+            bucket_size=self.bucket_size,
+        )
+
+    def _fits(self, n_graphs, n_atoms, n_edges):
+        return (
+            (self.max_graphs is None or n_graphs <= self.max_graphs)
+            and (self.max_atoms is None or n_atoms <= self.max_atoms)
+            and (self.max_edges is None or n_edges <= self.max_edges)
+        )
+
+    def _pack(self, indices):
+        batches, batch = [], []
+        batch_atoms = batch_edges = 0
+        for idx in indices:
+            n_atoms, n_edges = int(self.n_atoms[idx]), int(self.n_edges[idx])
+            if batch and not self._fits(len(batch) + 1, batch_atoms + n_atoms, batch_edges + n_edges):
+                batches.append(batch)
+                batch, batch_atoms, batch_edges = [], 0, 0
+            batch.append(int(idx))
+            batch_atoms += n_atoms
+            batch_edges += n_edges
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _build_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        n = len(self.n_atoms)
+        indices = rng.permutation(n) if self.shuffle else np.arange(n)
+
+        # pool size in structures, estimated from the mean structure size
+        sizes = self.n_edges if self.max_edges is not None else self.n_atoms
+        budget = self.max_edges if self.max_edges is not None else self.max_atoms
+        if budget is not None and sizes.mean() > 0:
+            per_batch = max(1, int(budget / sizes.mean()))
+        else:
+            per_batch = self.max_graphs
+        pool_size = max(1, per_batch * self.bucket_size)
+
+        batches = []
+        for start in range(0, n, pool_size):
+            pool = indices[start : start + pool_size]
+            pool = pool[np.argsort(sizes[pool], kind="stable")]
+            batches.extend(self._pack(pool))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # every rank needs the same number of batches, repeat from the start
+        if self.num_replicas > 1:
+            total = int(np.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+            batches = batches + batches[: total - len(batches)]
+            batches = batches[self.rank :: self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._build_batches()
+        batches, self._batches = self._batches, None
+        return iter(batches)
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._build_batches()
+        return len(self._batches)
+
+
+class ShardSampler(Sampler):
+    """
+    Sampler for a LargeStructureDataset (or a Subset of one) that keeps
+    the structures of a shard together: every epoch the order of the shards
+    is shuffled (seeded by seed + epoch) and then the structures within
+    each shard, so consecutive batches read from the same shard instead of
+    loading a different shard for almost every structure. With
+    num_replicas > 1 each rank gets a contiguous part of the order, padded
+    from the start to the same length on every rank.
+
+    Parameters
+    ----------
+        dataset: torch.utils.data.Dataset
+            LargeStructureDataset or Subset of one
+
+        shuffle: bool
+            shuffle the shards and the structures within them every epoch
+
+        num_replicas: int
+            number of distributed processes
+
+        rank: int
+            rank of the current process
+
+        seed: int
+            random seed, must be identical on all ranks
+    """
+
+    def __init__(
+        self,
+        dataset,
+        shuffle: bool = True,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ):
+        self.shard_of = self._shard_index(dataset)
+        if self.shard_of is None:
+            raise ValueError("ShardSampler needs a LargeStructureDataset or a Subset of one.")
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(np.ceil(len(self.shard_of) / num_replicas))
+
+    @staticmethod
+    def _shard_index(dataset):
+        if isinstance(dataset, Subset):
+            shard_of = ShardSampler._shard_index(dataset.dataset)
+            return None if shard_of is None else shard_of[np.asarray(dataset.indices)]
+        if isinstance(dataset, LargeStructureDataset):
+            return dataset.shard_index()
+        return None
+
+    @staticmethod
+    def supports(dataset):
+        return ShardSampler._shard_index(dataset) is not None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        n = len(self.shard_of)
+        shards = np.unique(self.shard_of)
+        if self.shuffle:
+            shards = rng.permutation(shards)
+        shard_order = np.empty(shards.max() + 1 if len(shards) else 0, dtype=np.int64)
+        shard_order[shards] = np.arange(len(shards))
+
+        # a stable sort by shard position keeps the shuffled order within shards
+        indices = rng.permutation(n) if self.shuffle else np.arange(n)
+        indices = indices[np.argsort(shard_order[self.shard_of[indices]], kind="stable")]
+
+        indices = np.resize(indices, self.num_samples * self.num_replicas)
+        indices = indices[self.rank * self.num_samples : (self.rank + 1) * self.num_samples]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def gather_graphs(data, slices, idx, inc_dict=None):
+    """
+    Builds a Batch of the structures idx out of collated storage without
+    creating per-structure Data objects: for every attribute the rows of
+    the selected structures are gathered with one index_select built from
+    the slices, and node indices are shifted by the running atom count.
+
+    Parameters
+    ----------
+        data: torch_geometric.data.Data
+            collated storage, e.g. InMemoryDataset.data or a Batch
+
+        slices: dict
+            slices of data on the host, e.g. InMemoryDataset.slices or
+            Batch._slice_dict
+
+        idx: torch.Tensor
+            host tensor of the structures to select, may repeat
+
+        inc_dict: dict
+            increments already applied to data (Batch._inc_dict), removed
+            before the new increments are added
+    """
+    device = data.pos.device
+    num_graphs = idx.numel()
+    node_key = next(key for key in ("pos", "x", "z") if key in slices)
+    node_counts = slices[node_key][idx + 1] - slices[node_key][idx]
+    node_inc = torch.cumsum(node_counts, 0) - node_counts
+
+    base_cls = next(cls for cls in type(data).__mro__ if not issubclass(cls, Batch))
+    batch = Batch(_base_cls=base_cls)
+    slice_dict, new_inc_dict = {}, {}
+    for key in slices:
+        value = data[key]
+        if not isinstance(value, torch.Tensor):
+            # collated lists hold one entry per structure
+            batch[key] = [value[i] for i in idx.tolist()]
+            slice_dict[key] = torch.arange(num_graphs + 1)
+            new_inc_dict[key] = None
+            continue
+
+        starts = slices[key][idx]
+        counts = slices[key][idx + 1] - starts
+        total = int(counts.sum())
+        counts_device = counts.to(device, non_blocking=True)
+        gather = torch.repeat_interleave(
+            (starts - torch.cumsum(counts, 0) + counts).to(device, non_blocking=True),
+            counts_device,
+            output_size=total,
+        ) + torch.arange(total, device=device)
+
+        cat_dim = data.__cat_dim__(key, value)
+        cat_dim = cat_dim + value.dim() if cat_dim < 0 else cat_dim
+        out = value.index_select(cat_dim, gather)
+
+        if "index" in key or key == "face":
+            inc = node_inc
+            if inc_dict is not None and inc_dict.get(key) is not None:
+                inc = inc - inc_dict[key][idx]
+            out = out + torch.repeat_interleave(
+                inc.to(device, non_blocking=True), counts_device, output_size=total
+            ).to(out.dtype)
+            new_inc_dict[key] = node_inc
+        else:
+            new_inc_dict[key] = torch.zeros(num_graphs, dtype=torch.long)
+
+        batch[key] = out
+        slice_dict[key] = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)])
+
+    node_counts_device = node_counts.to(device, non_blocking=True)
+    batch.batch = torch.repeat_interleave(
+        torch.arange(num_graphs, device=device),
+        node_counts_device,
+        output_size=int(node_counts.sum()),
+    )
+    batch.ptr = torch.cat(
+        [node_counts_device.new_zeros(1), torch.cumsum(node_counts_device, 0)]
+    )
+    batch._num_graphs = num_graphs
+    batch._slice_dict = slice_dict
+    batch._inc_dict = new_inc_dict
+    return batch
+
+
+def gather_graph_edges(batch, edge_index, idx, edge_values):
+    """
+    Gathers the edges of the structures idx out of a graph built for batch,
+    matching the Batch gather_graphs(batch, ..., idx) returns: the edges of
+    every selected structure are taken in order and their node indices
+    moved to the structure's atoms in the new batch.
+
+    Parameters
+    ----------
+        batch: torch_geometric.data.Batch
+            batch the graph was built for
+
+        edge_index: torch.Tensor
+            edges of batch, grouped by structure (as generate_graph returns)
+
+        idx: torch.Tensor
+            host tensor of the structures to select, may repeat
+
+        edge_values: list
+            per-edge tensors (e.g. edge weights) gathered along, or None
+
+    Returns the gathered edge_index, edge_values and edge count per structure.
+    """
+    device = edge_index.device
+    idx = idx.to(device)
+    edge_counts = torch.bincount(batch.batch[edge_index[0]], minlength=batch.num_graphs)
+    counts = edge_counts[idx]
+    total = int(counts.sum())
+    starts = (torch.cumsum(edge_counts, 0) - edge_counts)[idx]
+    gather = torch.repeat_interleave(
+        starts - torch.cumsum(counts, 0) + counts, counts, output_size=total
+    ) + torch.arange(total, device=device)
+
+    node_counts = (batch.ptr[1:] - batch.ptr[:-1])[idx]
+    node_shift = torch.cumsum(node_counts, 0) - node_counts - batch.ptr[idx]
+    out_index = edge_index[:, gather] + torch.repeat_interleave(
+        node_shift, counts, output_size=total
+    )
+    out_values = [value[gather] if value is not None else None for value in edge_values]
+    return out_index, out_values, counts
+
+
+class DeviceCollatedLoader:
+    """
+    Loader for an in-memory dataset whose collated tensors already live on
+    the target device. Batches are cut directly out of the collated
+    (data, slices) storage with gather_graphs, so no per-structure Data
+    objects are created.
+
+    Only usable for a StructureDataset (or a Subset of one) without
+    on-the-fly transforms, see supports().
+
+    Parameters
+    ----------
+        dataset: matdeeplearn.preprocessor.datasets.StructureDataset
+            dataset (or Subset) to load from
+
+        batch_size: int
+            number of structures per batch
+
+        shuffle: bool
+            shuffle the structures every epoch, ignored if a sampler is given
+
+        sampler: torch.utils.data.Sampler
+            sampler over the structure indices, e.g. a DistributedSampler
+
+        batch_sampler: SizeBucketBatchSampler
+            if given, batches are formed by this sampler and batch_size,
+            shuffle and sampler are ignored
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+
+        if isinstance(dataset, Subset):
+            base, indices = dataset.dataset, torch.as_tensor(dataset.indices, dtype=torch.long)
+        else:
+            base, indices = dataset, None
+        if base._indices is not None:
+            base_indices = torch.as_tensor(base._indices, dtype=torch.long)
+            indices = base_indices if indices is None else base_indices[indices]
+
+        self.data = base._data
+        self.indices = indices
+        # sizes on the host, so output sizes are known without a device sync
+        self.slices = {key: value.cpu() for key, value in base.slices.items()}
+
+    @staticmethod
+    def supports(dataset):
+        base = dataset.dataset if isinstance(dataset, Subset) else dataset
+        return isinstance(base, StructureDataset) and base.transform is None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        for batch_indices in self.batch_sampler:
+            yield self.collate(batch_indices)
+
+    def collate(self, batch_indices):
+        """
+        build a Batch of the structures at positions batch_indices
+        """
+        idx = torch.as_tensor(batch_indices, dtype=torch.long)
+        if self.indices is not None:
+            idx = self.indices[idx]
+        return widen_batch(gather_graphs(self.data, self.slices, idx))
+
+
+class BatchPrefetcher:
+    """
+    Iterates a loader in a background thread, num_batches batches ahead of
+    the consumer. On CUDA devices the batches are pinned and copied to the
+    device with non_blocking copies on a side stream, so collation and the
+    host-to-device transfer of the next batch overlap with the current
+    step; elsewhere only collation overlaps with compute.
+
+    Other attributes (dataset, batch_sampler, ...) are those of the
+    wrapped loader.
+
+    Parameters
+    ----------
+        loader: torch_geometric.loader.DataLoader
+            loader to prefetch from
+
+        device: torch.device
+            device the batches are moved to
+
+        num_batches: int
+            number of batches kept ready ahead of the consumer
+    """
+
+    _end = object()
+
+    def __init__(self, loader, device, num_batches: int = 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_batches = max(1, num_batches)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["loader"], name)
+
+    def __iter__(self):
+        use_cuda = self.device.type == "cuda"
+        stream = torch.cuda.Stream(self.device) if use_cuda else None
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    event = None
+                    if use_cuda:
+                        with torch.cuda.stream(stream):
+                            batch = batch.apply(_pin).to(self.device, non_blocking=True)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    if not put((batch, event)):
+                        return
+                put((self._end, None))
+            except Exception as e:
+                put((e, None))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event = batches.get()
+                if batch is self._end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # memory was allocated on the side stream
+                    batch.apply(lambda t: _record_stream(t, current))
+                yield batch
+        finally:
+            stop.set()
+
+
+def _pin(tensor):
+    if tensor.is_cuda or tensor.is_pinned():
+        return tensor
+    return tensor.pin_memory()
+
+
+def _record_stream(tensor, stream):
+    if tensor.is_cuda:
+        tensor.record_stream(stream)
+    return tensor
+
+
 def get_dataloader(
-    dataset, batch_size: int, num_workers: int = 8, sampler=None, shuffle=True
+    dataset, batch_size: int, num_workers: int = 8, sampler=None, shuffle=True, batch_sampler=None
 ):
     """
     Returns a single dataloader for a given dataset
@@ -134,6 +759,13 @@ def get_dataloader(
         num_workers: int
             how many subprocesses to use for data loading. 0 means that
             the data will be loaded in the main process.
+
+        batch_sampler: SizeBucketBatchSampler
+            if given, batches are formed by this sampler and batch_size
+            and sampler are ignored
+
+    A dataset that lives on the GPU and has no on-the-fly transforms is
+    batched on the device with DeviceCollatedLoader.
     """
 
     # load data
@@ -141,8 +773,24 @@ def get_dataloader(
         device = str(dataset.dataset[0].pos.device)
     except:
         device = str(dataset[0].pos.device)
-        
-    if device == "cuda:0" or device == "cuda":
+
+    on_device = device == "cuda:0" or device == "cuda"
+    if on_device and DeviceCollatedLoader.supports(dataset):
+        return DeviceCollatedLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=(sampler is None),
+            sampler=sampler,
+            batch_sampler=batch_sampler,
+        )
+    elif batch_sampler is not None:
+        loader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=0 if on_device else num_workers,
+            pin_memory=not on_device,
+        )
+    elif on_device:
         loader = DataLoader(
             dataset,
             batch_size=batch_size,
@@ -160,4 +808,5 @@ def get_dataloader(
             pin_memory=True,
             sampler=sampler,
         )
+    loader.collate_fn = WideningCollater(loader.collate_fn)
     return loader
@@ -0,0 +1,116 @@
+"""
+Process-wide cache of the models loaded from checkpoints, so every
+MDLCalculator (and every agent holding one) created for the same
+checkpoint shares one model instance instead of reading and holding its
+own copy.
+
+Entries are keyed by the checkpoint path and modification time, the
+device and the model arguments, so a rewritten checkpoint is loaded again.
+Cached models are in eval mode with frozen parameters (forces and stresses
+only need gradients with respect to the positions) and are read-only: the
+calculators pass their per-call choice of forces and stress with the batch
+(data.gradient, data.compute_stress, see BaseModel.gradient_enabled)
+instead of setting it on the models.
+"""
+import logging
+import os
+import threading
+
+import torch
+
+from matdeeplearn.common.model_export import load_exported_model
+from matdeeplearn.common.registry import registry
+
+_cache = {}
+_lock = threading.Lock()
+
+# model config entries that do not change the model built from a checkpoint
+_IGNORED_ARGS = ("compile", "model_ensemble")
+
+
+def _cache_key(checkpoint_path, model_name, model_args, rank):
+    path = os.path.realpath(checkpoint_path)
+    args = tuple(
+        (key, repr(value)) for key, value in sorted(model_args.items()) if key not in _IGNORED_ARGS
+    )
+    return (path, os.stat(path).st_mtime_ns, str(rank), model_name, args)
+
+
+def load_checkpoint(checkpoint_path, rank="cpu", mmap=True):
+    """
+    torch.load a checkpoint, memory-mapped if possible: tensors are read
+    from the page cache on first use instead of being copied up front, and
+    pages are shared by processes loading the same file. Checkpoints in the
+    legacy (non zip) format are loaded normally.
+    """
+    if mmap:
+        try:
+            return torch.load(checkpoint_path, map_location=rank, mmap=True)
+        except RuntimeError:
+            logging.debug(f"{checkpoint_path} can not be memory-mapped, loading it into memory")
+    return torch.load(checkpoint_path, map_location=rank)
+
+
+def load_model(checkpoint_path, model_name, model_args, rank="cpu", mmap=True):
+    """
+    return the shared model of a checkpoint (state dict checkpoint or
+    exported artifact), loading it on the first request
+
+    Parameters
+    ----------
+        checkpoint_path: str
+            checkpoint.pt of a training run or an exported artifact
+
+        model_name: str
+            registered name of the model class
+
+        model_args: dict
+            keyword arguments of the model class, artifacts use their own
+
+        rank: str
+            device the model is loaded to
+
+        mmap: bool
+            memory-map the checkpoint file (see load_checkpoint)
+    """
+    key = _cache_key(checkpoint_path, model_name, model_args, rank)
+    with _lock:
+        model = _cache.get(key)
+        if model is not None:
+            logging.debug(f"Model cache: reusing {checkpoint_path}")
+            return model
+
+        checkpoint = load_checkpoint(checkpoint_path, rank, mmap)
+        if "model_args" in checkpoint:
+            model = load_exported_model(checkpoint, rank)
+        else:
+            model = registry.get_model_class(model_name)(**model_args).to(rank)
+            # on cpu the memory-mapped tensors become the parameters, so the
+            # weights are paged in from the file rather than copied
+            assign = mmap and torch.device(rank).type == "cpu"
+            model.load_state_dict(checkpoint["state_dict"], assign=assign)
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+
+        # drop the models of earlier versions of the checkpoint file
+        for stale in [k for k in _cache if k[0] == key[0] and k[1] != key[1]]:
+            del _cache[stale]
+        _cache[key] = model
+        return model
+
+
+def clear_cache():
+    """
+    drop all cached models, they are freed once no calculator holds them
+    """
+    with _lock:
+        _cache.clear()
+
+
+def cached_checkpoints():
+    """
+    paths of the checkpoints currently cached
+    """
+    with _lock:
+        return sorted({key[0] for key in _cache})
@@ -0,0 +1,234 @@
+"""
+Export of trained checkpoints to self-contained inference artifacts for
+MDLCalculator, and torch.compile (or int8 quantization) of the models for
+inference.
+
+An artifact holds the model class name, its constructor arguments (with
+the on-the-fly graph, forces and stress settings of the config), the
+weights and the compile options, so the calculator rebuilds and compiles
+the model from the artifact alone. Export the checkpoints of a calculator
+config with
+
+``python -m matdeeplearn.common.model_export --config_path config.yml --output_dir exported --compile``
+
+and use the printed paths as task.checkpoint_path.
+"""
+import argparse
+import copy
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from matdeeplearn.common.quantization import quantize_model, validate_quantization
+from matdeeplearn.common.registry import registry
+
+
+def compile_options(value):
+    """
+    normalize the compile setting of a model config (False, True or a dict
+    of torch.compile arguments) to a dict of options, or None
+    """
+    if not value:
+        return None
+    if value is True:
+        return {}
+    return dict(value)
+
+
+def compile_model(model, mode=None, dynamic=None, backend="inductor"):
+    """
+    torch.compile a model for inference, forces and stress included
+
+    Graph construction (generate_graph) stays eager: the neighbor search
+    relies on torch_scatter/torch_sparse ops and data-dependent shapes that
+    dynamo cannot trace, so only the layers after it are compiled. Shapes
+    are dynamic by default since the number of edges changes between the
+    steps of a relaxation, and static for models with padded edges
+    (edge_padding), whose shapes stay fixed. With mode="reduce-overhead"
+    the static forward and backward are captured once and replayed (as CUDA
+    graphs on GPU) at every step.
+    """
+    if hasattr(model, "_orig_mod"):
+        return model
+    if dynamic is None:
+        dynamic = getattr(model, "edge_padding", None) is None or not getattr(model, "static_shapes", False)
+    model.generate_graph = torch._dynamo.disable(model.generate_graph)
+    return torch.compile(model, mode=mode, dynamic=dynamic, backend=backend)
+
+
+def load_exported_model(artifact, rank="cpu"):
+    """
+    build an eval-mode model from an exported artifact (or its path), compiled
+    if it was exported with compile options; int8 quantized artifacts run
+    on cpu only
+    """
+    if isinstance(artifact, str):
+        artifact = torch.load(artifact, map_location=rank)
+    model_cls = registry.get_model_class(artifact["model_name"])
+    model = model_cls(**artifact["model_args"])
+    if artifact.get("quantize"):
+        if torch.device(rank).type != "cpu":
+            raise ValueError("int8 quantized models run on cpu, load them with rank='cpu'.")
+        model = quantize_model(model, artifact["quantize"])
+    model.load_state_dict(artifact["state_dict"])
+    model = model.to(rank).eval()
+
+    options = compile_options(artifact.get("compile"))
+    if options is not None:
+        model = compile_model(model, **options)
+    return model
+
+
+def export_models(config, output_dir, compile=False, quantize=None, rank="cpu"):
+    """
+    export every checkpoint of a calculator config (task.checkpoint_path)
+    to an inference artifact in output_dir
+
+    Parameters
+    ----------
+        config: str or dict
+            config (or path to a yaml config) in the MDLCalculator format
+
+        output_dir: str
+            directory the artifacts are written to
+
+        compile: bool or dict
+            compile options stored in the artifacts, the models are
+            compiled when the artifacts are loaded
+
+        quantize: str
+            "heads" or "all" to quantize the linear heads or all linear
+            layers to int8 (see matdeeplearn.common.quantization), for
+            graph-level property models on cpu
+
+    Returns the paths of the artifacts, in checkpoint order.
+    """
+    from matdeeplearn.common.ase_utils import MDLCalculator
+
+    if isinstance(config, str):
+        with open(config, "r") as yaml_file:
+            config = yaml.safe_load(yaml_file)
+    config = copy.deepcopy(config)
+    config["model"]["compile"] = False
+
+    models = MDLCalculator._load_model(config, rank)
+    model_args = MDLCalculator.model_args(config)
+    if quantize:
+        models = [quantize_model(model, quantize) for model in models]
+        model_args["gradient"] = False
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = []
+    for model, checkpoint in zip(models, config["task"]["checkpoint_path"].split(",")):
+        name = os.path.splitext(os.path.basename(checkpoint))[0]
+        if os.path.basename(os.path.dirname(checkpoint)) == "checkpoint":
+            # train runs save results/<run>/checkpoint/checkpoint.pt
+            name = os.path.basename(os.path.dirname(os.path.dirname(checkpoint))) or name
+        path = os.path.join(output_dir, "{}.export.pt".format(name))
+        if path in paths:
+            path = os.path.join(output_dir, "{}_{}.export.pt".format(name, len(paths)))
+        torch.save(
+            {
+                "model_name": config["model"]["name"],
+                "model_args": model_args,
+                "state_dict": model.state_dict(),
+                "compile": compile_options(compile),
+                "quantize": quantize,
+            },
+            path,
+        )
+        logging.info(f"Exported {checkpoint} to {path}")
+        paths.append(path)
+    return paths
+
+
+def benchmark_calculator(config, atoms, steps=20, warmup=3, rattle=0.01, rank="cpu", compile=True):
+    """
+    time MDLCalculator.calculate (energy, forces and stress) on perturbed
+    copies of atoms with the eager and the compiled models of config
+
+    Returns the mean time per call of both, the speedup, the time of the
+    first compiled call (compilation) and the largest deviation of the
+    compiled energy and forces from the eager ones.
+    """
+    from matdeeplearn.common.ase_utils import MDLCalculator
+
+    if isinstance(config, str):
+        with open(config, "r") as yaml_file:
+            config = yaml.safe_load(yaml_file)
+    rng = np.random.default_rng(0)
+    structures = []
+    for _ in range(warmup + steps):
+        perturbed = atoms.copy()
+        perturbed.positions += rng.normal(scale=rattle, size=perturbed.positions.shape)
+        structures.append(perturbed)
+
+    results = {}
+    for key, value in (("eager", False), ("compiled", compile or True)):
+        run_config = copy.deepcopy(config)
+        run_config["model"]["compile"] = value
+        calculator = MDLCalculator(run_config, rank=rank)
+        for model in calculator.models:
+            model.eval()
+
+        energies, forces = [], []
+        start = time.perf_counter()
+        for i, structure in enumerate(structures):
+            if i == warmup:
+                start_steps = time.perf_counter()
+            calculator.calculate(structure)
+            energies.append(np.asarray(calculator.results["energy"]))
+            forces.append(np.asarray(calculator.results["forces"]))
+            if i == 0:
+                results[key + "_first_call_s"] = time.perf_counter() - start
+        results[key + "_ms"] = 1000 * (time.perf_counter() - start_steps) / steps
+        results[key + "_energies"] = np.array(energies)
+        results[key + "_forces"] = np.array(forces)
+
+    return {
+        "eager_ms": results["eager_ms"],
+        "compiled_ms": results["compiled_ms"],
+        "speedup": results["eager_ms"] / results["compiled_ms"],
+        "compile_s": results["compiled_first_call_s"],
+        "max_energy_diff": float(np.abs(results["eager_energies"] - results["compiled_energies"]).max()),
+        "max_force_diff": float(np.abs(results["eager_forces"] - results["compiled_forces"]).max()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MatDeepLearn model export")
+    parser.add_argument("--config_path", required=True, type=str, help="Path to a calculator config file with task.checkpoint_path")
+    parser.add_argument("--output_dir", default="exported", type=str, help="Directory for the exported artifacts")
+    parser.add_argument("--compile", action="store_true", help="Compile the models with torch.compile when the artifacts are loaded")
+    parser.add_argument("--mode", default=None, type=str, help="torch.compile mode, e.g. reduce-overhead or max-autotune")
+    parser.add_argument("--quantize", nargs="?", const="heads", default=None, choices=["heads", "all"], help="Quantize the linear heads (or all linear layers) of graph-level models to int8")
+    parser.add_argument("--benchmark", default=None, type=str, help="Structure file to time eager and compiled (or fp32 and int8) calculations on")
+    parser.add_argument("--steps", default=20, type=int, help="Timed calculations per benchmark")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    compile = {"mode": args.mode} if args.compile and args.mode else args.compile
+    paths = export_models(args.config_path, args.output_dir, compile=compile, quantize=args.quantize)
+    print("checkpoint_path: " + ",".join(paths))
+
+    if args.benchmark is not None:
+        from ase import io
+
+        if args.quantize:
+            report = validate_quantization(
+                args.config_path, io.read(args.benchmark, index=":"), layers=args.quantize
+            )
+        else:
+            report = benchmark_calculator(
+                args.config_path, io.read(args.benchmark), steps=args.steps, compile=compile or True
+            )
+        for key, value in report.items():
+            print("{:>16}: {:.6g}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Reduced precision inference for MDLCalculator, PropertyTrainer.predict and
+ScreeningEngine, set with task.inference_precision (fp32, bf16 or fp16).
+
+bf16 and fp16 run the models under torch.autocast: matmuls and linear
+layers run in the reduced type (accumulating in fp32), while reductions,
+normalizations and graph construction stay in fp32. Forces and stresses
+are gradients with respect to the fp32 positions and displacement.
+
+Check the deviation from fp32 on held-out structures before enabling it
+with
+
+``python -m matdeeplearn.common.precision --config_path config.yml --structures structures.extxyz``
+"""
+import argparse
+import copy
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+import yaml
+
+INFERENCE_PRECISIONS = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def inference_autocast(precision, device):
+    """
+    autocast context for running a model at an inference precision on device
+    """
+    if precision not in INFERENCE_PRECISIONS:
+        raise ValueError(
+            "Unknown inference precision {}, expected one of {}".format(
+                precision, list(INFERENCE_PRECISIONS)
+            )
+        )
+    dtype = INFERENCE_PRECISIONS[precision]
+    return torch.autocast(
+        torch.device(device).type, dtype=dtype or torch.float32, enabled=dtype is not None
+    )
+
+
+def to_fp32(output):
+    """
+    cast the tensors of a model output dict to fp32, e.g. before converting
+    them to numpy, which has no bf16
+    """
+    return {
+        key: value.float() if isinstance(value, torch.Tensor) else value
+        for key, value in output.items()
+    }
+
+
+def validate_precision(config, structures, precisions=("bf16", "fp16"), rank="cpu", repeats=3):
+    """
+    compare energies, forces and stresses of MDLCalculator at reduced
+    precisions with fp32 on a held-out list of ase.Atoms
+
+    Returns, per precision, the mean and max absolute energy deviation per
+    atom, the mean and max absolute force component deviation, the max
+    absolute stress deviation, the mean time per calculation and the
+    speedup over fp32.
+    """
+    from matdeeplearn.common.ase_utils import MDLCalculator
+
+    if isinstance(config, str):
+        with open(config, "r") as yaml_file:
+            config = yaml.safe_load(yaml_file)
+    config = copy.deepcopy(config)
+    calculator = MDLCalculator(config, rank=rank)
+    for model in calculator.models:
+        model.eval()
+
+    results = {}
+    for precision in ("fp32",) + tuple(p for p in precisions if p != "fp32"):
+        calculator.precision = precision
+        energies, forces, stresses, seconds = [], [], [], 0.0
+        for atoms in structures:
+            # first call per structure warms up, the rest are timed
+            calculator.calculate(atoms)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                calculator.calculate(atoms)
+            seconds += (time.perf_counter() - start) / repeats
+            energies.append(float(calculator.results["energy"]) / len(atoms))
+            forces.append(np.asarray(calculator.results["forces"]).reshape(-1))
+            stresses.append(np.asarray(calculator.results["stress"]).reshape(-1))
+        results[precision] = {
+            "energies": np.array(energies),
+            "forces": np.concatenate(forces),
+            "stresses": np.concatenate(stresses),
+            "ms": 1000 * seconds / len(structures),
+        }
+
+    reference = results.pop("fp32")
+    report = {"fp32": {"ms": reference["ms"]}}
+    for precision, result in results.items():
+        energy_error = np.abs(result["energies"] - reference["energies"])
+        force_error = np.abs(result["forces"] - reference["forces"])
+        report[precision] = {
+            "energy_mae_per_atom": float(energy_error.mean()),
+            "energy_max_per_atom": float(energy_error.max()),
+            "force_mae": float(force_error.mean()),
+            "force_max": float(force_error.max()),
+            "stress_max": float(np.abs(result["stresses"] - reference["stresses"]).max()),
+            "ms": result["ms"],
+            "speedup": reference["ms"] / result["ms"],
+        }
+    return report
+
+
+def main():
+    from ase import io
+
+    parser = argparse.ArgumentParser(description="MatDeepLearn inference precision validation")
+    parser.add_argument("--config_path", required=True, type=str, help="Path to a calculator config file")
+    parser.add_argument("--structures", required=True, type=str, help="Structure file (all frames are used) or directory of structure files")
+    parser.add_argument("--precisions", default="bf16,fp16", type=str, help="Comma separated precisions to compare with fp32")
+    parser.add_argument("--device", default="cuda:0", type=str)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.structures):
+        structures = [io.read(path) for path in sorted(glob.glob(os.path.join(args.structures, "*")))]
+    else:
+        structures = io.read(args.structures, index=":")
+
+    report = validate_precision(
+        args.config_path, structures, precisions=tuple(args.precisions.split(",")), rank=args.device
+    )
+    for precision, values in report.items():
+        print(precision)
+        for key, value in values.items():
+            print("{:>22}: {:.6g}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
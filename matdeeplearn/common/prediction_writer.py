@@ -0,0 +1,125 @@
+import csv
+import os
+
+import numpy as np
+
+PREDICTION_FORMATS = ("csv", "parquet")
+
+
+def prediction_headers(num_columns, node_level=False, labels=True, std=False):
+    """
+    column headers of a prediction file with num_columns columns: the ids,
+    then the targets (if labels), the predictions and the stds (if std)
+    """
+    id_headers = ["structure_id"]
+    if node_level:
+        id_headers += ["node_id"]
+
+    groups = (["target"] if labels else []) + ["prediction"] + (["std"] if std else [])
+    num_cols = (num_columns - len(id_headers)) // len(groups)
+    headers = list(id_headers)
+    for group in groups:
+        headers += [group] * num_cols
+    return headers, len(id_headers)
+
+
+class PredictionWriter:
+    """
+    Streams prediction rows to a csv or parquet file, so results are written
+    batch by batch instead of being accumulated and written at the end.
+
+    Rows are 2D arrays as produced by np.column_stack((ids, ..., predictions)).
+    csv rows are written as they arrive; parquet rows are buffered and
+    written as a row group every buffer_rows rows, with the id columns as
+    strings and the remaining columns as float64. Writing parquet requires
+    pyarrow.
+
+    Parameters
+    ----------
+        filename: str
+            output file, the extension is replaced to match file_format
+
+        headers: list
+            column names, repeated names get an index suffix in parquet
+
+        num_id_columns: int
+            number of leading id columns
+
+        file_format: str
+            "csv" or "parquet"
+
+        buffer_rows: int
+            number of rows per parquet row group
+    """
+
+    def __init__(self, filename, headers, num_id_columns=1, file_format="csv", buffer_rows=100000):
+        if file_format not in PREDICTION_FORMATS:
+            raise ValueError(
+                "Unknown prediction format {}, expected one of {}".format(file_format, PREDICTION_FORMATS)
+            )
+        self.filename = os.path.splitext(filename)[0] + "." + file_format
+        self.headers = headers
+        self.num_id_columns = num_id_columns
+        self.file_format = file_format
+        self.buffer_rows = buffer_rows
+        self.num_rows = 0
+        self._buffer = []
+        self._buffered_rows = 0
+
+        if file_format == "csv":
+            self._file = open(self.filename, "w")
+            self._csvwriter = csv.writer(self._file)
+            self._csvwriter.writerow(headers)
+        else:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Writing parquet predictions requires pyarrow.")
+            self._pa = pa
+            names = []
+            for i, name in enumerate(headers):
+                names.append(name if headers.count(name) == 1 else "{}_{}".format(name, headers[:i].count(name)))
+            self._schema = pa.schema(
+                [(name, pa.string() if i < num_id_columns else pa.float64()) for i, name in enumerate(names)]
+            )
+            self._file = pq.ParquetWriter(self.filename, self._schema)
+
+    def write(self, rows):
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows.reshape(-1, 1)
+        self.num_rows += len(rows)
+        if self.file_format == "csv":
+            self._csvwriter.writerows(rows)
+            return
+
+        self._buffer.append(rows)
+        self._buffered_rows += len(rows)
+        if self._buffered_rows >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.file_format == "csv":
+            self._file.flush()
+            return
+        if not self._buffer:
+            return
+        rows = np.concatenate(self._buffer, axis=0)
+        self._buffer, self._buffered_rows = [], 0
+        columns = [
+            self._pa.array(rows[:, i].astype(str if i < self.num_id_columns else np.float64))
+            for i in range(rows.shape[1])
+        ]
+        self._file.write_table(self._pa.Table.from_arrays(columns, schema=self._schema))
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        return self.filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
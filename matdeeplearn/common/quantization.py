@@ -0,0 +1,101 @@
+"""
+Dynamic int8 quantization of graph-level property models (CGCNN, SchNet,
+MPNN, ...) for CPU screening.
+
+The weights of the linear layers are stored as int8 and activations are
+quantized on the fly, so only nn.Linear layers change and no calibration
+data is needed. Quantized layers have no gradients, so quantized models
+only predict the property (gradient=False), no forces or stresses.
+Export quantized artifacts for MDLCalculator.direct_calculate with
+
+``python -m matdeeplearn.common.model_export --config_path config.yml --output_dir exported --quantize``
+
+and check their accuracy against fp32 with validate_quantization.
+"""
+import copy
+import logging
+import time
+
+import numpy as np
+import torch
+import yaml
+from torch import nn
+
+# the dense pre-GNN layers and post-GNN heads of the graph-level models
+HEAD_LAYERS = ("pre_lin_list", "post_lin_list", "lin_out", "lin_out_2")
+
+
+def quantizable_layers(model, layers="heads"):
+    """
+    names of the nn.Linear layers of model quantized for layers="heads"
+    (pre_lin_list, post_lin_list and lin_out) or layers="all"
+    """
+    if layers not in ("heads", "all"):
+        raise ValueError("Unknown quantized layers {}, expected heads or all".format(layers))
+    return {
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear)
+        and (layers == "all" or name.split(".")[0] in HEAD_LAYERS)
+    }
+
+
+def quantize_model(model, layers="heads"):
+    """
+    return a dynamically int8 quantized copy of a graph-level model, on cpu,
+    in eval mode and without forces and stresses (gradient=False)
+    """
+    if getattr(model, "prediction_level", "graph") != "graph":
+        raise ValueError("Only graph-level property models can be quantized.")
+    model = copy.deepcopy(model).cpu().eval()
+    model.gradient = False
+    return torch.ao.quantization.quantize_dynamic(
+        model, quantizable_layers(model, layers), dtype=torch.qint8
+    )
+
+
+def validate_quantization(config, structures, layers="heads", repeats=3):
+    """
+    compare MDLCalculator.direct_calculate of the int8 quantized models of
+    config with the fp32 models on a held-out list of ase.Atoms
+
+    Returns the mean and max absolute deviation of the predictions, the
+    mean time per structure of both and the speedup.
+    """
+    from matdeeplearn.common.ase_utils import MDLCalculator
+
+    if isinstance(config, str):
+        with open(config, "r") as yaml_file:
+            config = yaml.safe_load(yaml_file)
+    calculator = MDLCalculator(copy.deepcopy(config), rank="cpu")
+    fp32_models = [model.eval() for model in calculator.models]
+    int8_models = [quantize_model(model, layers) for model in fp32_models]
+
+    results = {}
+    for key, models in (("fp32", fp32_models), ("int8", int8_models)):
+        calculator.models = models
+        predictions, seconds = [], 0.0
+        with torch.no_grad():
+            for atoms in structures:
+                calculator.direct_calculate(atoms)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    prediction = calculator.direct_calculate(atoms)
+                seconds += (time.perf_counter() - start) / repeats
+                predictions.append(prediction)
+        results[key] = (np.array(predictions), 1000 * seconds / len(structures))
+
+    error = np.abs(results["int8"][0] - results["fp32"][0])
+    report = {
+        "mae": float(error.mean()),
+        "max_error": float(error.max()),
+        "fp32_ms": results["fp32"][1],
+        "int8_ms": results["int8"][1],
+        "speedup": results["fp32"][1] / results["int8"][1],
+    }
+    logging.info(
+        "int8 quantization: MAE {:.4g}, max error {:.4g}, {:.2f}x speedup".format(
+            report["mae"], report["max_error"], report["speedup"]
+        )
+    )
+    return report
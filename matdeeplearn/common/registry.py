@@ -13,8 +13,14 @@ Import the global registry object using
 Various decorators for registry different kind of classes with unique keys
 
 - Register a model: ``@registry.register_model``
+
+Classes listed in matdeeplearn.common.registry_manifest are imported on
+their first lookup; names missing from the manifest trigger a full import
+of the registered packages (setup_imports).
 """
 import importlib
+import sys
+import time
 from typing import Callable
 
 
@@ -54,6 +60,8 @@ class Registry:
         "loss_name_mapping": {},
         "state": {},
         "transforms": {},
+        # seconds spent importing each module through the registry
+        "import_times": {},
     }
 
     @classmethod
@@ -248,12 +256,50 @@ class Registry:
             f"or provide the full import path to the {kind} (e.g., '{existing_cls_path}')."
         )
 
+    @classmethod
+    def import_module(cls, module_name: str):
+        """Imports a module and records the time it took if it was not imported yet"""
+        if module_name in sys.modules:
+            return sys.modules[module_name]
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        cls.mapping["import_times"][module_name] = time.perf_counter() - start
+        return module
+
+    @classmethod
+    def import_report(cls):
+        """Returns a table of the modules imported through the registry, slowest first"""
+        times = sorted(cls.mapping["import_times"].items(), key=lambda item: -item[1])
+        lines = ["{:>10.3f} s  {}".format(seconds, module_name) for module_name, seconds in times]
+        lines.append("{:>10.3f} s  total".format(sum(seconds for _, seconds in times)))
+        return "\n".join(lines)
+
+    @classmethod
+    def _lazy_import(cls, name: str, mapping_name: str):
+        from matdeeplearn.common.registry_manifest import MANIFEST
+
+        module_name = MANIFEST.get(mapping_name, {}).get(name)
+        if module_name is not None:
+            cls.import_module(module_name)
+            if name in cls.mapping[mapping_name]:
+                return cls.mapping[mapping_name][name]
+
+        # not in the manifest (or the manifest is stale), import everything
+        from matdeeplearn.common.trainer_context import setup_imports
+
+        setup_imports(lazy=False)
+        return cls.mapping[mapping_name].get(name, None)
+
     @classmethod
     def get_class(cls, name: str, mapping_name: str):
         existing_mapping = cls.mapping[mapping_name].get(name, None)
         if existing_mapping is not None:
             return existing_mapping
 
+        existing_mapping = cls._lazy_import(name, mapping_name)
+        if existing_mapping is not None:
+            return existing_mapping
+
         # mapping be class path of type `{module_name}.{class_name}` (e.g., `matdeeplearn.trainers.PropertyTrainer`)
         if name.count(".") < 1:
             raise cls.__import_error(name, mapping_name)
@@ -0,0 +1,86 @@
+"""
+Static manifest of the registered names of matdeeplearn and the modules
+that register them, so the registry can import a module only when one of
+its names is looked up (see Registry.get_class) instead of importing every
+module up front.
+
+Regenerate after adding or renaming a registered class with
+
+``python -m matdeeplearn.common.registry_manifest``
+"""
+import re
+from pathlib import Path
+
+MANIFEST = {
+    "task_name_mapping": {
+        "train": "matdeeplearn.tasks.task",
+        "predict": "matdeeplearn.tasks.task",
+        "finetune": "matdeeplearn.tasks.task",
+    },
+    "model_name_mapping": {
+        "CGCNN": "matdeeplearn.models.cgcnn",
+        "CrystalGraph": "matdeeplearn.models.crystal_graph",
+        "CrystalGraphMulti": "matdeeplearn.models.crystal_graph_multi",
+        "MPNN": "matdeeplearn.models.mpnn",
+        "SchNet": "matdeeplearn.models.schnet",
+        "tensor_net": "matdeeplearn.models.tensor_net",
+        "torchmd_et": "matdeeplearn.models.torchmd_et",
+        "torchmd_etEarly": "matdeeplearn.models.torchmd_etEarly",
+    },
+    "trainer_name_mapping": {
+        "base": "matdeeplearn.trainers.base_trainer",
+        "property": "matdeeplearn.trainers.property_trainer",
+    },
+    "loss_name_mapping": {
+        "TorchLossWrapper": "matdeeplearn.modules.loss",
+        "ForceLoss": "matdeeplearn.modules.loss",
+        "ForceStressLoss": "matdeeplearn.modules.loss",
+        "DOSLoss": "matdeeplearn.modules.loss",
+    },
+    "transforms": {
+        "GetY": "matdeeplearn.preprocessor.transforms",
+        "NumNodeTransform": "matdeeplearn.preprocessor.transforms",
+        "LineGraphMod": "matdeeplearn.preprocessor.transforms",
+        "ToFloat": "matdeeplearn.preprocessor.transforms",
+    },
+}
+
+# packages scanned by build_manifest, old and in_progress code is skipped
+# like in setup_imports
+MANIFEST_PACKAGES = ["tasks", "models", "trainers", "modules", "preprocessor"]
+
+_REGISTER_KINDS = {
+    "task": "task_name_mapping",
+    "model": "model_name_mapping",
+    "trainer": "trainer_name_mapping",
+    "loss": "loss_name_mapping",
+    "transform": "transforms",
+}
+_REGISTER_PATTERN = re.compile(r"^@registry\.register_(\w+)\(\s*[\"']([^\"']+)[\"']", re.MULTILINE)
+
+
+def build_manifest(project_root=None):
+    """
+    scan the sources (without importing them) for registry decorators and
+    return the manifest they define
+    """
+    if project_root is None:
+        project_root = Path(__file__).resolve().parent.parent.parent
+    project_root = Path(project_root)
+
+    manifest = {mapping_name: {} for mapping_name in _REGISTER_KINDS.values()}
+    for package in MANIFEST_PACKAGES:
+        for f in sorted((project_root / "matdeeplearn" / package).rglob("*.py")):
+            if "old" in str(f) or "in_progress" in str(f):
+                continue
+            module_name = ".".join(f.relative_to(project_root).with_suffix("").parts)
+            for kind, name in _REGISTER_PATTERN.findall(f.read_text()):
+                if kind in _REGISTER_KINDS:
+                    manifest[_REGISTER_KINDS[kind]][name] = module_name
+    return manifest
+
+
+if __name__ == "__main__":
+    import pprint
+
+    pprint.pprint(build_manifest(), sort_dicts=False)
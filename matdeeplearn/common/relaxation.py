@@ -0,0 +1,45 @@
+"""
+FIRE relaxation of ase.Atoms, shared by StructureOptimizer (and
+relax_many) and the calculator service.
+"""
+import time
+
+from ase.optimize import FIRE
+
+try:
+    from ase.filters import ExpCellFilter
+except ImportError:
+    # ase < 3.23
+    from ase.constraints import ExpCellFilter
+
+
+def relax_atoms(atoms, calculator, relax_cell=False, fmax=0.001, steps=500, logfile=None, trajectory=None):
+    """
+    relax atoms in place with FIRE, and the cell with ExpCellFilter if
+    relax_cell; atoms keep calculator attached
+
+    Parameters
+    ----------
+        atoms: ase.Atoms
+            structure to relax
+
+        calculator: ase Calculator
+            calculator of the energy, forces (and stress with relax_cell)
+
+        fmax, steps:
+            convergence criterion and maximum number of FIRE steps
+
+        logfile: str
+            file the optimizer log is written to, none if None
+
+        trajectory: str
+            .traj file every step is written to, none if None
+
+    Returns the number of optimizer steps and the wall time in seconds.
+    """
+    atoms.calc = calculator
+    target = ExpCellFilter(atoms) if relax_cell else atoms
+    optimizer = FIRE(target, logfile=logfile, trajectory=trajectory)
+    start = time.time()
+    optimizer.run(fmax=fmax, steps=steps)
+    return optimizer.get_number_of_steps(), time.time() - start
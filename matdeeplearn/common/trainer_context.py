@@ -1,7 +1,7 @@
 # from matdeeplearn.common.utils import setup_logging
 
 import copy
-import importlib
+import logging
 import time
 from argparse import Namespace
 from contextlib import contextmanager
@@ -44,6 +44,7 @@ def new_trainer_context(*, config: Dict[str, Any], args: Namespace):
         task_cls = registry.get_task_class(config["task"]["run_mode"])
         assert task_cls is not None, "Task not found"
         task = task_cls(config)
+        logging.debug("Modules imported by the registry:\n" + registry.import_report())
         # start_time = time.time()
         ctx = _TrainingContext(config=config, task=task, trainer=trainer)
         yield ctx
@@ -67,6 +68,7 @@ def _import_local_file(path: Path, *, project_root: Path):
     :param project_root: The root directory of the project (i.e., the "matdeeplearn" folder)
     :type project_root: Path
     """
+    from matdeeplearn.common.registry import registry
 
     path = path.resolve()
     project_root = project_root.resolve()
@@ -75,7 +77,7 @@ def _import_local_file(path: Path, *, project_root: Path):
         path.absolute().relative_to(project_root.absolute()).with_suffix("").parts
     )
     # logging.debug(f"Resolved module name of {path} to {module_name}")
-    importlib.import_module(module_name)
+    registry.import_module(module_name)
 
 
 def _get_project_root():
@@ -102,9 +104,18 @@ def _get_project_root():
 
 
 # Copied from https://github.com/facebookresearch/mmf/blob/master/mmf/utils/env.py#L89.
-def setup_imports():
+def setup_imports(lazy: bool = True):
+    """
+    Makes the registered classes available to the registry. With lazy=True
+    nothing is imported here: the registry imports the module of a class
+    from the manifest when the class is first looked up. With lazy=False
+    every module of the registered packages is imported.
+    """
     from matdeeplearn.common.registry import registry
 
+    if lazy:
+        return
+
     # First, check if imports are already setup
     has_already_setup = registry.get("imports_setup", no_warning=True)
     if has_already_setup:
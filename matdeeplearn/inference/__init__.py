@@ -0,0 +1,3 @@
+__all__ = ["ScreeningEngine", "iter_structures"]
+
+from .screening import ScreeningEngine, iter_structures
@@ -0,0 +1,41 @@
+import argparse
+import logging
+
+from matdeeplearn.inference.screening import ScreeningEngine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MatDeepLearn screening")
+    parser.add_argument("--config_path", required=True, type=str, help="Path to a config file with model and dataset parameters and task.checkpoint_path")
+    parser.add_argument("--source", required=True, type=str, help="Directory or file (json, jsonl, cif, ...) of structures to screen")
+    parser.add_argument("--output_dir", default="screening", type=str, help="Directory for predictions and ranked results")
+    parser.add_argument("--device", default="cuda:0", type=str)
+    parser.add_argument("--num_workers", default=4, type=int, help="Graph construction processes, 0 builds graphs in the main process")
+    parser.add_argument("--chunk_size", default=512, type=int, help="Structures per graph construction task")
+    parser.add_argument("--batch_max_atoms", default=4096, type=int)
+    parser.add_argument("--batch_max_graphs", default=256, type=int)
+    parser.add_argument("--top_k", default=None, type=int, help="Number of ranked structures to write, all by default")
+    parser.add_argument("--descending", action="store_true", help="Rank the largest predictions first")
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = ScreeningEngine(
+        args.config_path,
+        device=args.device,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size,
+        batch_max_atoms=args.batch_max_atoms,
+        batch_max_graphs=args.batch_max_graphs,
+    )
+    engine.run(
+        args.source,
+        args.output_dir,
+        top_k=args.top_k,
+        descending=args.descending,
+        file_format=args.format,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+import copy
+import glob
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import yaml
+from ase import Atoms, io
+
+from matdeeplearn.common.ase_utils import MDLCalculator
+from matdeeplearn.common.data import SizeBucketBatchSampler, gather_graphs, widen_batch
+from matdeeplearn.common.precision import inference_autocast
+from matdeeplearn.common.prediction_writer import PredictionWriter, prediction_headers
+from matdeeplearn.preprocessor.processor import collate_data_list, from_config
+
+def iter_structures(source):
+    """
+    lazily yield the structures of source, which is a directory, a file or
+    an iterable of ase.Atoms, raw structure dicts or file paths.
+
+    JSON files hold a list of raw structure dicts (the format read by
+    DataProcessor) and JSON lines files one dict per line; these are
+    yielded as dicts. Any other file is yielded as its path and read with
+    ase in the worker that builds its graph.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        source = str(source)
+        if os.path.isdir(source):
+            paths = sorted(
+                p for p in glob.glob(os.path.join(source, "*")) if os.path.isfile(p)
+            )
+        else:
+            paths = [source]
+        for path in paths:
+            yield from _iter_file(path)
+        return
+
+    for item in source:
+        if isinstance(item, (str, os.PathLike)):
+            yield from _iter_file(str(item))
+        else:
+            yield item
+
+
+def _iter_file(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".jsonl":
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif ext == ".json":
+        with open(path) as f:
+            records = json.load(f)
+        yield from records if isinstance(records, list) else [records]
+    else:
+        yield path
+
+
+def structure_record(item, prediction_level="graph"):
+    """
+    convert a structure (ase.Atoms, file path or raw dict) to a raw
+    structure dict as read by DataProcessor.json_wrap, with a placeholder
+    target if it has none
+    """
+    if isinstance(item, str):
+        atoms = io.read(item)
+        atoms.info.setdefault("structure_id", os.path.splitext(os.path.basename(item))[0])
+        item = atoms
+    if isinstance(item, Atoms):
+        item = {
+            "structure_id": str(item.info.get("structure_id", item.get_chemical_formula())),
+            "positions": item.get_positions(),
+            "cell": np.array(item.get_cell()),
+            "atomic_numbers": item.get_atomic_numbers(),
+        }
+    if "y" not in item:
+        item = dict(item)
+        item["y"] = [0.0] * len(item["atomic_numbers"]) if prediction_level == "node" else 0.0
+    return item
+
+
+def _build_graphs(processor, items):
+    """
+    worker entry point: read and convert one chunk of structures and
+    return their graphs collated
+    """
+    records = [structure_record(item, processor.prediction_level) for item in items]
+    dict_structures = processor.wrap_records(records)
+    if len(dict_structures) == 0:
+        return None
+    return collate_data_list(processor.get_data_list(dict_structures))
+
+
+class _TopKRanking:
+    """
+    the top_k rows by value (smallest, or largest if descending) seen so
+    far, in a bounded heap; ties keep the input order
+    """
+
+    def __init__(self, top_k, descending=False):
+        self.top_k = top_k
+        self.sign = -1.0 if descending else 1.0
+        # entries (-key, -position, row), the root is the worst kept row
+        self.heap = []
+        self.position = 0
+
+    def add(self, rows, values):
+        keys = self.sign * np.asarray(values, dtype=np.float64)
+        if self.top_k <= 0:
+            return
+        candidates = np.arange(len(keys))
+        if len(keys) > self.top_k:
+            # only the top_k of a batch can enter the ranking
+            candidates = np.sort(np.argpartition(keys, self.top_k - 1)[: self.top_k])
+        for i in candidates:
+            entry = (-keys[i], -(self.position + i), rows[i])
+            if len(self.heap) < self.top_k:
+                heapq.heappush(self.heap, entry)
+            elif entry[:2] > self.heap[0][:2]:
+                heapq.heapreplace(self.heap, entry)
+        self.position += len(keys)
+
+    def iter_sorted(self):
+        if self.heap:
+            yield np.stack([entry[2] for entry in sorted(self.heap, key=lambda e: (-e[0], -e[1]))])
+
+
+class _ExternalRanking:
+    """
+    all rows sorted by value (smallest, or largest if descending) with an
+    external merge sort: rows are buffered, written to run_dir as sorted
+    runs of run_size rows and the runs are merged lazily
+    """
+
+    def __init__(self, run_dir, descending=False, run_size=100000, block_size=4096):
+        self.run_dir = run_dir
+        self.sign = -1.0 if descending else 1.0
+        self.run_size = run_size
+        self.block_size = block_size
+        self.rows, self.keys = [], []
+        self.buffered = 0
+        self.runs = []
+
+    def add(self, rows, values):
+        self.rows.append(rows)
+        self.keys.append(self.sign * np.asarray(values, dtype=np.float64))
+        self.buffered += len(rows)
+        if self.buffered >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        if not self.buffered:
+            return
+        rows, keys = np.concatenate(self.rows, axis=0), np.concatenate(self.keys)
+        order = np.argsort(keys, kind="stable")
+        self.rows, self.keys, self.buffered = [], [], 0
+        os.makedirs(self.run_dir, exist_ok=True)
+        path = os.path.join(self.run_dir, "run_{}".format(len(self.runs)))
+        np.save(path + "_keys.npy", keys[order])
+        np.save(path + "_rows.npy", rows[order])
+        self.runs.append(path)
+
+    def _iter_run(self, index, path):
+        keys = np.load(path + "_keys.npy", mmap_mode="r")
+        rows = np.load(path + "_rows.npy", mmap_mode="r")
+        for position in range(len(keys)):
+            yield keys[position], index, position, rows[position]
+
+    def iter_sorted(self):
+        if not self.runs:
+            # everything fits in one run, sort it in memory
+            if self.buffered:
+                rows, keys = np.concatenate(self.rows, axis=0), np.concatenate(self.keys)
+                yield rows[np.argsort(keys, kind="stable")]
+            return
+        self._spill()
+        try:
+            merged = heapq.merge(*(self._iter_run(i, path) for i, path in enumerate(self.runs)))
+            while True:
+                block = [entry[3] for entry in itertools.islice(merged, self.block_size)]
+                if not block:
+                    break
+                yield np.stack(block)
+        finally:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+class ScreeningEngine:
+    """
+    Inference-only prediction over large structure libraries.
+
+    Structures are streamed from the source in chunks; each chunk is read
+    and converted to graphs in a pool of worker processes, so graph
+    construction overlaps with model evaluation in the main process. Within
+    a chunk, structures are grouped into batches of similar size under an
+    atom budget (SizeBucketBatchSampler) and cut from the collated chunk
+    without per-structure Data objects. The ensemble runs under
+    torch.inference_mode and only the predicted property is computed (no
+    forces, stresses, losses or metrics).
+
+    Parameters
+    ----------
+        config: str or dict
+            config (or path to a yaml config) in the MDLCalculator format:
+            model, dataset.preprocess_params, task.checkpoint_path and
+            optionally task.inference_precision
+
+        device: str
+            device the models run on, cpu if cuda is not available
+
+        num_workers: int
+            graph construction processes, 0 builds graphs in the main process
+
+        chunk_size: int
+            structures per graph construction task
+
+        batch_max_atoms: int
+            maximum number of atoms per batch
+
+        batch_max_graphs: int
+            maximum number of structures per batch
+    """
+
+    def __init__(
+        self,
+        config,
+        device="cuda:0",
+        num_workers=4,
+        chunk_size=512,
+        batch_max_atoms=4096,
+        batch_max_graphs=256,
+    ):
+        if isinstance(config, str):
+            with open(config, "r") as yaml_file:
+                config = yaml.safe_load(yaml_file)
+        config = copy.deepcopy(config)
+        # predictions only, no autograd forces or stresses
+        config["model"]["gradient"] = False
+
+        self.device = device if torch.cuda.is_available() else "cpu"
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.batch_max_atoms = batch_max_atoms
+        self.batch_max_graphs = batch_max_graphs
+        self.precision = config["task"].get("inference_precision", "fp32")
+
+        self.models = MDLCalculator._load_model(config, self.device)
+        for model in self.models:
+            model.eval()
+
+        dataset_config = dict(config["dataset"], src=None, target_path=None, verbose=False)
+        self.processor = from_config(dataset_config)
+        self.processor.root_path = None
+        self.processor.target_file_path = None
+        self.processor.device = "cpu"
+        self.processor.disable_tqdm = True
+
+    def iter_chunks(self, source):
+        """
+        yield the graphs of source chunk by chunk as collated (data, slices),
+        in input order
+        """
+        items = iter_structures(source)
+        chunks = iter(lambda: list(itertools.islice(items, self.chunk_size)), [])
+
+        if self.num_workers <= 0:
+            for chunk in chunks:
+                collated = _build_graphs(self.processor, chunk)
+                if collated is not None:
+                    yield collated
+            return
+
+        # spawn so workers do not inherit the (possibly initialized) torch thread pools
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=torch.set_num_threads,
+            initargs=(1,),
+        ) as executor:
+            pending = []
+            for chunk in chunks:
+                pending.append(executor.submit(_build_graphs, self.processor, chunk))
+                if len(pending) >= 2 * self.num_workers:
+                    collated = pending.pop(0).result()
+                    if collated is not None:
+                        yield collated
+            for future in pending:
+                collated = future.result()
+                if collated is not None:
+                    yield collated
+
+    def iter_batches(self, data, slices):
+        """
+        yield size-bucketed batches of one collated chunk
+        """
+        sampler = SizeBucketBatchSampler(
+            # get_graph_sizes only needs the slices of the chunk
+            SimpleNamespace(slices=slices),
+            max_atoms=self.batch_max_atoms,
+            max_graphs=self.batch_max_graphs,
+            shuffle=False,
+        )
+        for batch_indices in sampler:
+            idx = torch.as_tensor(batch_indices, dtype=torch.long)
+            yield widen_batch(gather_graphs(data, slices, idx))
+
+    @torch.inference_mode()
+    def predict_batch(self, batch):
+        """
+        ensemble mean and std of the prediction for one batch
+        """
+        batch = batch.to(self.device)
+        with inference_autocast(self.precision, self.device):
+            outputs = torch.stack([model(batch)["output"].float() for model in self.models])
+        mean = outputs.mean(dim=0)
+        std = outputs.std(dim=0) if len(self.models) > 1 else torch.zeros_like(mean)
+        return mean.cpu().numpy(), std.cpu().numpy()
+
+    def screen(self, source):
+        """
+        yield (structure_ids, predictions, stds) per batch, in the order the
+        batches are evaluated
+        """
+        for data, slices in self.iter_chunks(source):
+            for batch in self.iter_batches(data, slices):
+                mean, std = self.predict_batch(batch)
+                structure_ids = [s[0] if isinstance(s, list) else s for s in batch.structure_id]
+                yield structure_ids, mean, std
+
+    def run(
+        self,
+        source,
+        output_dir,
+        top_k=None,
+        descending=False,
+        file_format="csv",
+        log_interval=30,
+        sort_run_size=100000,
+    ):
+        """
+        screen all structures of source, streaming every prediction to
+        predictions.<file_format> in output_dir and writing the top_k
+        structures (all if None), sorted by their first predicted value,
+        to ranked.<file_format>
+
+        With top_k only the best top_k rows are kept while screening. Without
+        it all structures are ranked with an external sort: sorted runs of
+        sort_run_size rows are spilled to output_dir and merged at the end.
+
+        Returns a summary with the number of structures, the elapsed time
+        and the throughput in structures per second.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        ensemble = len(self.models) > 1
+        writer = None
+        ranking = (
+            _TopKRanking(top_k, descending)
+            if top_k is not None
+            else _ExternalRanking(os.path.join(output_dir, "sort_runs"), descending, sort_run_size)
+        )
+        n_structures = 0
+        start = last_log = time.time()
+
+        for structure_ids, mean, std in self.screen(source):
+            rows = np.column_stack((structure_ids, mean, std) if ensemble else (structure_ids, mean))
+            if writer is None:
+                headers, num_id_columns = prediction_headers(rows.shape[1], False, False, ensemble)
+                writer = PredictionWriter(
+                    os.path.join(output_dir, "predictions.csv"), headers, num_id_columns, file_format
+                )
+            writer.write(rows)
+            ranking.add(rows, mean[:, 0])
+            n_structures += len(structure_ids)
+
+            now = time.time()
+            if now - last_log >= log_interval:
+                last_log = now
+                logging.info(
+                    "Screened {} structures, {:.1f} structures/s".format(
+                        n_structures, n_structures / (now - start)
+                    )
+                )
+
+        if writer is None:
+            raise ValueError("No structures found in {}".format(source))
+        writer.close()
+        elapsed = time.time() - start
+
+        with PredictionWriter(
+            os.path.join(output_dir, "ranked.csv"), writer.headers, writer.num_id_columns, file_format
+        ) as ranked:
+            for rows in ranking.iter_sorted():
+                ranked.write(rows)
+
+        summary = {
+            "structures": n_structures,
+            "seconds": elapsed,
+            "structures_per_second": n_structures / elapsed if elapsed > 0 else float("inf"),
+            "predictions": writer.filename,
+            "ranked": ranked.filename,
+        }
+        logging.info(
+            "Screened {} structures in {:.1f} s ({:.1f} structures/s)".format(
+                n_structures, elapsed, summary["structures_per_second"]
+            )
+        )
+        return summary
@@ -1,8 +1,20 @@
 __all__ = ["BaseModel", "CGCNN", "MPNN", "SchNet", "TorchMD_ET", "TorchMD_ET_early"]
 
-from .base_model import BaseModel
-from .cgcnn import CGCNN
-from .mpnn import MPNN
-from .schnet import SchNet
-from .torchmd_et import TorchMD_ET
-from .torchmd_etEarly import TorchMD_ET_Early
+import importlib
+
+# models are imported on first access, so importing one model (or the
+# registry looking one up) does not import all of them
+_lazy_imports = {
+    "BaseModel": ".base_model",
+    "CGCNN": ".cgcnn",
+    "MPNN": ".mpnn",
+    "SchNet": ".schnet",
+    "TorchMD_ET": ".torchmd_et",
+    "TorchMD_ET_Early": ".torchmd_etEarly",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        return getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
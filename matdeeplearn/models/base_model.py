@@ -26,12 +26,15 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
         otf_edge_index=False,
         otf_edge_attr=False,
         otf_node_attr=False,
+        node_representation="onehot",
         graph_method="ocp",
         gradient=False,
         cutoff_radius=8,
         n_neighbors=None,
         edge_dim=50,        
         num_offsets=1,        
+        edge_padding=None,
+        compute_stress=True,
         **kwargs
         ) -> None:
         super(BaseModel, self).__init__()
@@ -40,13 +43,35 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
         self.otf_edge_index = otf_edge_index
         self.otf_edge_attr = otf_edge_attr
         self.otf_node_attr = otf_node_attr
+        self.node_representation = node_representation
         self.gradient = gradient
         self.cutoff_radius = cutoff_radius
         self.n_neighbors = n_neighbors
         self.edge_dim = edge_dim
         self.graph_method = graph_method
         self.num_offsets = num_offsets
+        # headroom of padded otf edge lists, None disables padding (see pad_edges)
+        self.edge_padding = edge_padding
+        self.edge_capacity = 0
+        # with gradient, stress needs the displacement graph, forces alone do not
+        self.compute_stress = compute_stress
         
+    def gradient_enabled(self, data):
+        """
+        whether forces (and stresses) are computed for data: self.gradient,
+        unless the caller turned them off for this call with data.gradient =
+        False, as MDLCalculator does on its shared, read-only models
+        """
+        return self.gradient == True and getattr(data, "gradient", True)
+
+    def stress_enabled(self, data):
+        """
+        whether the stress is computed for data along with the forces:
+        self.compute_stress, unless turned off for this call with
+        data.compute_stress = False
+        """
+        return self.compute_stress and getattr(data, "compute_stress", True)
+
     @property
     @abstractmethod
     def target_attr(self):
@@ -105,21 +130,31 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
                 max number of neighbors
         """
 
+        # positions, cell offsets and distances stay fp32 under reduced precision inference
+        if torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled():
+            with torch.autocast(data.pos.device.type, enabled=False):
+                return self.generate_graph(data, cutoff_radius, n_neighbors)
+
         #For calculation of stress, see https://github.com/mir-group/nequip/blob/main/nequip/nn/_grad_output.py
         #Originally from: https://github.com/atomistic-machine-learning/schnetpack/issues/165                 
-        if self.gradient:
+        if self.gradient_enabled(data):
             data.pos.requires_grad_(True)
-            data.displacement = torch.zeros((len(data), 3, 3), dtype=data.pos.dtype, device=data.pos.device)            
-            data.displacement.requires_grad_(True)
-            symmetric_displacement = 0.5 * (data.displacement + data.displacement.transpose(-1, -2))
-            data.pos = data.pos + torch.bmm(data.pos.unsqueeze(-2), symmetric_displacement[data.batch]).squeeze(-2)            
-            data.cell = data.cell + torch.bmm(data.cell, symmetric_displacement) 
+            if self.stress_enabled(data):
+                data.displacement = torch.zeros((len(data), 3, 3), dtype=data.pos.dtype, device=data.pos.device)            
+                data.displacement.requires_grad_(True)
+                symmetric_displacement = 0.5 * (data.displacement + data.displacement.transpose(-1, -2))
+                data.pos = data.pos + torch.bmm(data.pos.unsqueeze(-2), symmetric_displacement[data.batch]).squeeze(-2)            
+                data.cell = data.cell + torch.bmm(data.cell, symmetric_displacement) 
 
         if torch.sum(data.cell) == 0:
             self.graph_method = "mdl"
 
+        shared_graph = self.shared_graph(data)
+
         #Can differ from non-otf if amp=True for a very small percentage of edges ~0.01%                    
-        if self.graph_method == "ocp":
+        if shared_graph is not None:
+            edge_index, edge_weights, edge_vec, cell_offsets, offset_distance, neighbors = shared_graph
+        elif self.graph_method == "ocp":
             edge_index, cell_offsets, neighbors = radius_graph_pbc(
                 cutoff_radius,
                 n_neighbors,
@@ -204,6 +239,8 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
         # check if edge features that is normalized over the entire dataset can be skipped
         generate_edge_features(data, self.edge_dim)
         '''
+        if self.edge_padding is not None and getattr(self, "static_shapes", False):
+            edge_index, edge_weights, edge_vec = self.pad_edges(edge_index, edge_weights, edge_vec)
         return (
             edge_index,
             edge_weights,
@@ -213,6 +250,103 @@ class BaseModel(nn.Module, metaclass=ABCMeta):
             neighbors,
         )
 
+    def shared_graph(self, data):
+        """
+        the graph of data searched once for several models (shared_edge_index
+        etc., see PropertyTrainer._share_graph), or None if data has none or
+        it cannot be reused. Without gradients it is used as is; with
+        gradients the distances are recomputed from the (displaced)
+        positions, which needs the per-edge cell offsets of the ocp method.
+        """
+        if getattr(data, "shared_edge_index", None) is None:
+            return None
+        if not self.gradient_enabled(data):
+            return (
+                data.shared_edge_index,
+                data.shared_edge_weight,
+                data.shared_edge_vec,
+                getattr(data, "shared_cell_offsets", None),
+                getattr(data, "shared_offset_distance", None),
+                getattr(data, "shared_neighbors", None),
+            )
+        if self.graph_method != "ocp":
+            return None
+        edge_gen_out = get_pbc_distances(
+            data.pos,
+            data.shared_edge_index,
+            data.cell,
+            data.shared_cell_offsets,
+            data.shared_neighbors,
+            return_offsets=True,
+            return_distance_vec=True,
+        )
+        return (
+            edge_gen_out["edge_index"],
+            edge_gen_out["distances"],
+            edge_gen_out["distance_vec"],
+            data.shared_cell_offsets,
+            edge_gen_out["offsets"],
+            data.shared_neighbors,
+        )
+
+    def pad_edges(self, edge_index, edge_weights, edge_vec):
+        """
+        pads the otf edges to a fixed capacity, so the layers after graph
+        generation see the same shapes at every step of a relaxation and
+        compiled (or CUDA graph captured) code is replayed instead of
+        recompiled. Padded edges have index -1, which models with
+        static_shapes (TensorNet) map to a ghost atom, and zero length; cell
+        offsets and neighbor counts are left unpadded.
+
+        The capacity is set from the first graph with edge_padding headroom
+        (e.g. 0.2 for 20% more edges) and only grows when a graph exceeds it.
+        """
+        num_edges = edge_index.shape[1]
+        if num_edges > self.edge_capacity:
+            self.edge_capacity = int(num_edges * (1 + self.edge_padding)) + 1
+        num_padded = self.edge_capacity - num_edges
+
+        edge_index = torch.cat(
+            (edge_index, edge_index.new_full((2, num_padded), -1)), dim=1
+        )
+        edge_weights = torch.cat((edge_weights, edge_weights.new_zeros(num_padded)))
+        edge_vec = torch.cat((edge_vec, edge_vec.new_zeros((num_padded, 3))))
+        return edge_index, edge_weights, edge_vec
+
+    def compute_gradients(self, data, out):
+        """
+        computes the forces and the stress from the gradients of out with
+        respect to the positions and the displacement injected by
+        generate_graph. With compute_stress False there is no displacement,
+        only the forces are computed and the stress is None.
+
+        Parameters
+        ----------
+            data: torch_geometric.data.data.Data
+                data the graph was generated for
+
+            out: torch.Tensor
+                energy (or other scalar) predicted by the model
+        """
+        if not self.stress_enabled(data):
+            grad = torch.autograd.grad(
+                    out,
+                    [data.pos],
+                    grad_outputs=torch.ones_like(out),
+                    create_graph=self.training)
+            return -1 * grad[0], None
+
+        volume = torch.einsum("zi,zi->z", data.cell[:, 0, :], torch.cross(data.cell[:, 1, :], data.cell[:, 2, :], dim=1)).unsqueeze(-1)
+        grad = torch.autograd.grad(
+                out,
+                [data.pos, data.displacement],
+                grad_outputs=torch.ones_like(out),
+                create_graph=self.training)
+        forces = -1 * grad[0]
+        stress = grad[1]
+        stress = stress / volume.view(-1, 1, 1)
+        return forces, stress
+
 def conditional_grad(dec):
     "Decorator to enable/disable grad depending on whether force/energy predictions are being made"
     # Adapted from https://stackoverflow.com/questions/60907323/accessing-class-property-as-decorator-argument
@@ -220,7 +354,8 @@ def conditional_grad(dec):
         @wraps(func)
         def cls_method(self, *args, **kwargs):
             f = func
-            if self.gradient == True:
+            # the first argument is the data of the call
+            if (self.gradient_enabled(args[0]) if args else self.gradient == True):
                 f = dec(func)
             return f(self, *args, **kwargs)
 
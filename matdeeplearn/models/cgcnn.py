@@ -15,7 +15,7 @@ from torch_scatter import scatter, scatter_add, scatter_max, scatter_mean
 
 from matdeeplearn.common.registry import registry
 from matdeeplearn.models.base_model import BaseModel, conditional_grad
-from matdeeplearn.preprocessor.helpers import GaussianSmearing, node_rep_one_hot
+from matdeeplearn.preprocessor.helpers import GaussianSmearing, node_rep_lookup
 
 @registry.register_model("CGCNN")
 class CGCNN(BaseModel):
@@ -155,7 +155,7 @@ class CGCNN(BaseModel):
                 data.edge_attr = self.distance_expansion(data.edge_weight) 
                 
         if self.otf_node_attr == True:
-            data.x = node_rep_one_hot(data.z).float()        
+            data.x = node_rep_lookup(data.z, self.node_representation)        
             
         # Pre-GNN dense layers
         for i in range(0, len(self.pre_lin_list)):
@@ -229,16 +229,8 @@ class CGCNN(BaseModel):
         out = self._forward(data)
         output["output"] =  out
 
-        if self.gradient == True and out.requires_grad == True:         
-            volume = torch.einsum("zi,zi->z", data.cell[:, 0, :], torch.cross(data.cell[:, 1, :], data.cell[:, 2, :], dim=1)).unsqueeze(-1)                      
-            grad = torch.autograd.grad(
-                    out,
-                    [data.pos, data.displacement],
-                    grad_outputs=torch.ones_like(out),
-                    create_graph=self.training) 
-            forces = -1 * grad[0]
-            stress = grad[1]
-            stress = stress / volume.view(-1, 1, 1)             
+        if self.gradient_enabled(data) and out.requires_grad == True:         
+            forces, stress = self.compute_gradients(data, out)
 
             output["pos_grad"] =  forces
             output["cell_grad"] =  stress
@@ -5,6 +5,7 @@ import numpy as np
 import torch.nn as nn
 from matdeeplearn.models.base_model import BaseModel, conditional_grad
 from matdeeplearn.common.registry import registry
+from matdeeplearn.preprocessor.helpers import node_rep_lookup
 from torch_scatter import scatter, segment_coo
 from torch_geometric.nn import (
     global_mean_pool,
@@ -154,7 +155,7 @@ class CrystalGraphConvNet(BaseModel):
         out = self._forward(data)
         output["output"] =  out
 
-        if self.gradient == True and out.requires_grad == True:         
+        if self.gradient_enabled(data) and out.requires_grad == True:         
             if self.gradient_method == "conventional":
                 volume = torch.einsum("zi,zi->z", data.cell[:, 0, :], torch.cross(data.cell[:, 1, :], data.cell[:, 2, :], dim=1)).unsqueeze(-1)                        
                 grad = torch.autograd.grad(
@@ -168,15 +169,7 @@ class CrystalGraphConvNet(BaseModel):
             #For calculation of stress, see https://github.com/mir-group/nequip/blob/main/nequip/nn/_grad_output.py
             #Originally from: https://github.com/atomistic-machine-learning/schnetpack/issues/165                              
             elif self.gradient_method == "nequip":
-                volume = torch.einsum("zi,zi->z", data.cell[:, 0, :], torch.cross(data.cell[:, 1, :], data.cell[:, 2, :], dim=1)).unsqueeze(-1)                        
-                grad = torch.autograd.grad(
-                        out,
-                        [data.pos, data.displacement],
-                        grad_outputs=torch.ones_like(out),
-                        create_graph=self.training) 
-                forces = -1 * grad[0]
-                stress = grad[1]
-                stress = stress / volume.view(-1, 1, 1)         
+                forces, stress = self.compute_gradients(data, out)
 
             output["pos_grad"] =  forces
             output["cell_grad"] =  stress
@@ -223,7 +216,7 @@ class CrystalGraphConvNet(BaseModel):
                 data.edge_attr = self.distance_expansion(data.edge_weight)
 
         if self.otf_node_attr == True:
-            data.x = node_rep_one_hot(data.z).float()
+            data.x = node_rep_lookup(data.z, self.node_representation)
 
         
         atom_fea = data.x
@@ -14,7 +14,7 @@ from torch_geometric.nn.models.dimenet import (
 from torch_geometric.nn.resolver import activation_resolver
 from torch_scatter import scatter
 from torch_sparse import SparseTensor
-from matdeeplearn.preprocessor.helpers import triplets
+from matdeeplearn.preprocessor.helpers import triplets, triplets_from_csr
 from matdeeplearn.models.base_model import BaseModel, conditional_grad
 
 from matdeeplearn.common.registry import registry
@@ -372,13 +372,18 @@ class DimeNetPlusPlusWrap(DimeNetPlusPlus):
         #data.neighbors = neighbors
         j, i = data.edge_index
         dist = data.distances   
-        try:
-            idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets(
-                data.edge_index,
-                data.cell_offsets,
-                num_nodes=data.z.size(0),)
-        except:
-            _, _, idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets(data.edge_index, num_nodes=data.z.size(0))
+        if "triplet_count" in data:
+            # triplets cached during processing (preprocess_triplets)
+            idx_kj, idx_ji = triplets_from_csr(data.triplet_count, data.triplet_kj_offset)
+            idx_i, idx_j, idx_k = i[idx_ji], j[idx_ji], j[idx_kj]
+        else:
+            try:
+                idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets(
+                    data.edge_index,
+                    data.cell_offsets,
+                    num_nodes=data.z.size(0),)
+            except:
+                _, _, idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets(data.edge_index, num_nodes=data.z.size(0))
         
         try:
             offsets = data.cell_offsets
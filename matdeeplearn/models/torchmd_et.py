@@ -15,7 +15,7 @@ from matdeeplearn.models.utils import (
 from matdeeplearn.models.base_model import BaseModel, conditional_grad
 from matdeeplearn.models.torchmd_output_modules import Scalar, EquivariantScalar
 from matdeeplearn.common.registry import registry
-from matdeeplearn.preprocessor.helpers import node_rep_one_hot
+from matdeeplearn.preprocessor.helpers import node_rep_lookup
 @registry.register_model("torchmd_et")
 
 
@@ -194,7 +194,7 @@ class TorchMD_ET(BaseModel):
         data.edge_vec = data.edge_vec / torch.norm(data.edge_vec, dim=1).unsqueeze(1)
         
         if self.otf_node_attr == True:
-            data.x = node_rep_one_hot(data.z).float()          
+            data.x = node_rep_lookup(data.z, self.node_representation)          
         
         if self.neighbor_embedding is not None:
             x = self.neighbor_embedding(data.z, x, data.edge_index, data.edge_weight, data.edge_attr)
@@ -232,16 +232,8 @@ class TorchMD_ET(BaseModel):
         out = self._forward(data)
         output["output"] =  out
 
-        if self.gradient == True and out.requires_grad == True:         
-            volume = torch.einsum("zi,zi->z", data.cell[:, 0, :], torch.cross(data.cell[:, 1, :], data.cell[:, 2, :], dim=1)).unsqueeze(-1)                        
-            grad = torch.autograd.grad(
-                    out,
-                    [data.pos, data.displacement],
-                    grad_outputs=torch.ones_like(out),
-                    create_graph=self.training) 
-            forces = -1 * grad[0]
-            stress = grad[1]
-            stress = stress / volume.view(-1, 1, 1)         
+        if self.gradient_enabled(data) and out.requires_grad == True:         
+            forces, stress = self.compute_gradients(data, out)
 
             output["pos_grad"] =  forces
             output["cell_grad"] =  stress
@@ -1,3 +1,20 @@
-from .datasets import LargeStructureDataset, StructureDataset
-from .processor import DataProcessor
-from .transforms import *
+import importlib
+
+# imported on first access: importing a submodule such as helpers does not
+# pull in the processor (pandas, ase.io) or register every transform
+_lazy_imports = {
+    "LargeStructureDataset": ".datasets",
+    "MemmapStructureDataset": ".datasets",
+    "StructureDataset": ".datasets",
+    "DataProcessor": ".processor",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        return getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+    # transforms used to be star-imported here
+    transforms = importlib.import_module(".transforms", __name__)
+    if hasattr(transforms, name):
+        return getattr(transforms, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,235 @@
+import bisect
+import glob
+import json
+import logging
 import os
+from collections import OrderedDict
 
+import numpy as np
 import torch
-from torch_geometric.data import InMemoryDataset
+from torch_geometric.data import Data, Dataset, InMemoryDataset
+from torch_geometric.data.collate import collate
+from torch_geometric.data.separate import separate
+
+SHARD_INDEX_FILE = "index.json"
+MEMMAP_META_FILE = "meta.json"
+
+
+def shard_dir_name(processed_file_name):
+    """
+    name of the shard directory that replaces a single processed file,
+    e.g. data_train.pt -> data_train_shards
+    """
+    return os.path.splitext(processed_file_name)[0] + "_shards"
+
+
+class ShardWriter:
+    """
+    writes collated (data, slices) chunks as numbered shard files into
+    shard_dir, together with an index of the number of structures per shard.
+    The index is only written on close(), so an interrupted run never leaves
+    a readable but incomplete dataset behind.
+
+    With append=True an existing store is opened and new shards are added
+    after the existing ones; the rest of its index is kept in self.index.
+    Shard files the index no longer lists are deleted on close().
+    """
+
+    def __init__(self, shard_dir, append=False):
+        self.path = shard_dir
+        self.shards = []
+        self.index = {}
+        self.next_file = 0
+        os.makedirs(shard_dir, exist_ok=True)
+        index_path = os.path.join(shard_dir, SHARD_INDEX_FILE)
+        if append and os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            self.shards = self.index["shards"]
+            # files are numbered on, so rewritten shards never reuse a listed name
+            self.next_file = 1 + max(
+                (int(shard["file"][len("shard_"):-len(".pt")]) for shard in self.shards), default=-1
+            )
+            return
+
+        for f in glob.glob(os.path.join(shard_dir, "shard_*.pt")):
+            os.remove(f)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def append(self, data, slices):
+        """
+        write one shard and return its position in the index
+        """
+        file_name = "shard_{:05d}.pt".format(self.next_file)
+        self.next_file += 1
+        torch.save((data, slices), os.path.join(self.path, file_name))
+        shard = {"file": file_name, "size": len(next(iter(slices.values()))) - 1}
+        # per-structure sizes, so samplers do not need to load the shards
+        if "pos" in slices:
+            shard["n_atoms"] = torch.diff(slices["pos"]).tolist()
+        if "edge_index" in slices:
+            shard["n_edges"] = torch.diff(slices["edge_index"]).tolist()
+        self.shards.append(shard)
+        return len(self.shards) - 1
+
+    def close(self, **index):
+        """
+        write the index; additional entries (e.g. content hashes) are stored
+        alongside the shard list
+        """
+        self.index.update(index)
+        self.index["shards"] = self.shards
+        index_path = os.path.join(self.path, SHARD_INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+        # only now that the new index is in place, e.g. shards replaced by compact()
+        listed = {shard["file"] for shard in self.shards}
+        for f in glob.glob(os.path.join(self.path, "shard_*.pt")):
+            if os.path.basename(f) not in listed:
+                os.remove(f)
+
+    def compact(self, records, shard_size, min_fill=0.5):
+        """
+        rewrite the shards of an appended store that are mostly stale, and
+        merge small shards. records maps record hashes to the [shard, index]
+        of every live structure. Shards with fewer live structures than
+        min_fill of their size are rewritten, and shards with fewer than
+        shard_size live structures are merged when that saves shards (e.g.
+        the small shards left by successive appends). Shards without live
+        structures are dropped. The live structures are repacked in shards
+        of shard_size appended after the kept ones.
+
+        Returns records updated to the compacted shard list.
+        """
+        live = [[] for _ in self.shards]
+        for record_hash, (shard_idx, local_idx) in records.items():
+            live[shard_idx].append((local_idx, record_hash))
+        rewrite = {i for i, shard in enumerate(self.shards) if len(live[i]) < min_fill * shard["size"]}
+        small = [i for i in range(len(self.shards)) if 0 < len(live[i]) < shard_size]
+        if -(-sum(len(live[i]) for i in small) // shard_size) < len(small):
+            rewrite.update(small)
+        if not rewrite:
+            return records
+
+        old_shards = self.shards
+        kept = [i for i in range(len(old_shards)) if i not in rewrite]
+        position = {old: new for new, old in enumerate(kept)}
+        self.shards = [old_shards[i] for i in kept]
+        records = {
+            record_hash: [position[shard_idx], local_idx]
+            for record_hash, (shard_idx, local_idx) in records.items()
+            if shard_idx not in rewrite
+        }
+
+        data_list, hashes = [], []
+
+        def flush():
+            data, slices, _ = collate(
+                data_list[0].__class__, data_list=data_list, increment=False, add_batch=False
+            )
+            shard_idx = self.append(data, slices)
+            for local_idx, record_hash in enumerate(hashes):
+                records[record_hash] = [shard_idx, local_idx]
+            data_list.clear()
+            hashes.clear()
+
+        # one source shard is loaded at a time
+        for i in sorted(rewrite):
+            if not live[i]:
+                continue
+            data, slices = torch.load(os.path.join(self.path, old_shards[i]["file"]))
+            for local_idx, record_hash in sorted(live[i]):
+                data_list.append(
+                    separate(cls=data.__class__, batch=data, idx=local_idx, slice_dict=slices, decrement=False)
+                )
+                hashes.append(record_hash)
+                if len(data_list) == shard_size:
+                    flush()
+        if data_list:
+            flush()
+        logging.info(
+            "Compacted {} shards of {} into {} shards.".format(
+                len(rewrite), self.path, len(self.shards) - len(kept)
+            )
+        )
+        return records
+
+    def __len__(self):
+        return sum(shard["size"] for shard in self.shards)
+
+
+def memmap_dir_name(processed_file_name):
+    """
+    name of the memory-mapped directory that replaces a single processed
+    file, e.g. data_train.pt -> data_train_mmap
+    """
+    return os.path.splitext(processed_file_name)[0] + "_mmap"
+
+
+class MemmapWriter:
+    """
+    writes collated (data, slices) chunks as one flat binary file per
+    attribute (<key>.bin, concatenation dimension first) plus one file of
+    slices per tensor attribute (<key>.slices.bin, int64). Chunks are
+    appended to the files, so the whole dataset is never held in memory.
+    Non-tensor attributes (e.g. structure_id) are stored as json lists. dtypes and
+    shapes are written to meta.json on close().
+    """
+
+    def __init__(self, mmap_dir):
+        self.path = mmap_dir
+        self.meta = {"num_structures": 0, "tensors": {}, "lists": {}}
+        self.lists = {}
+        os.makedirs(mmap_dir, exist_ok=True)
+        for f in glob.glob(os.path.join(mmap_dir, "*")):
+            os.remove(f)
+
+    def _append_bytes(self, file_name, array):
+        with open(os.path.join(self.path, file_name), "ab") as f:
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    def append(self, data, slices):
+        first = self.meta["num_structures"] == 0
+        for key, key_slices in slices.items():
+            value = data[key]
+            if isinstance(value, torch.Tensor):
+                cat_dim = data.__cat_dim__(key, value) % max(value.dim(), 1)
+                array = value.detach().cpu().movedim(cat_dim, 0).numpy()
+                if first:
+                    self.meta["tensors"][key] = {
+                        "dtype": array.dtype.str,
+                        "shape": list(array.shape[1:]),
+                        "cat_dim": cat_dim,
+                        "length": 0,
+                    }
+                meta = self.meta["tensors"][key]
+                key_slices = key_slices + meta["length"]
+                meta["length"] += array.shape[0]
+                self._append_bytes(key + ".bin", array)
+                self._append_bytes(
+                    key + ".slices.bin",
+                    key_slices.numpy().astype(np.int64)[(0 if first else 1):],
+                )
+            else:
+                # collated lists hold one entry per structure
+                self.lists.setdefault(key, []).extend(value)
+        self.meta["num_structures"] += len(next(iter(slices.values()))) - 1
+
+    def close(self):
+        for key, values in self.lists.items():
+            with open(os.path.join(self.path, key + ".json"), "w") as f:
+                json.dump(values, f)
+            self.meta["lists"][key] = len(values)
+        meta_path = os.path.join(self.path, MEMMAP_META_FILE)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(self.meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def __len__(self):
+        return self.meta["num_structures"]
 
 
 class StructureDataset(InMemoryDataset):
@@ -55,5 +283,228 @@ class StructureDataset(InMemoryDataset):
         return [self.processed_file_name]
 
 
-class LargeStructureDataset(InMemoryDataset):
-    pass
+class LargeStructureDataset(Dataset):
+    """
+    dataset backed by a directory of collated shard files written by
+    DataProcessor with large_dataset=True. Only the shard index is read on
+    construction; shards are loaded on access and at most
+    max_resident_shards of them are kept in memory (least recently used
+    shards are evicted first). Access is fastest when consecutive indices
+    fall into the same shard.
+    """
+
+    def __init__(
+        self,
+        root,
+        processed_data_path,
+        processed_file_name,
+        transform=None,
+        pre_transform=None,
+        pre_filter=None,
+        device=None,
+        max_resident_shards=4,
+    ):
+        self.root = root
+        self.processed_data_path = processed_data_path
+        self.processed_file_name = processed_file_name
+        self.max_resident_shards = max_resident_shards
+        super(LargeStructureDataset, self).__init__(
+            root, transform, pre_transform, pre_filter
+        )
+        if not torch.cuda.is_available() or device == "cpu" or device is None:
+            self.map_location = torch.device("cpu")
+        else:
+            self.map_location = device
+
+        with open(self.processed_paths[0]) as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.shard_files = [shard["file"] for shard in index["shards"]]
+        self.shard_offsets = [0]
+        for shard in index["shards"]:
+            self.shard_offsets.append(self.shard_offsets[-1] + shard["size"])
+        # incrementally processed stores list their (shard, index) entries
+        # explicitly, since replaced structures stay behind in older shards
+        self.entries = index.get("entries", None)
+        self._shards = OrderedDict()
+
+    @property
+    def raw_file_names(self):
+        return []
+
+    def download(self):
+        pass
+
+    @property
+    def processed_dir(self):
+        return os.path.join(self.root, self.processed_data_path)
+
+    @property
+    def shard_dir(self):
+        return os.path.join(self.processed_dir, shard_dir_name(self.processed_file_name))
+
+    @property
+    def processed_file_names(self):
+        return [os.path.join(shard_dir_name(self.processed_file_name), SHARD_INDEX_FILE)]
+
+    def len(self):
+        if self.entries is not None:
+            return len(self.entries)
+        return self.shard_offsets[-1]
+
+    def shard_index(self):
+        """
+        shard of every structure, read from the index
+        """
+        if self.entries is not None:
+            return np.asarray([shard_idx for shard_idx, _ in self.entries], dtype=np.int64)
+        return np.repeat(np.arange(len(self.shard_files)), np.diff(self.shard_offsets))
+
+    def graph_sizes(self):
+        """
+        number of atoms and edges of every structure, read from the index,
+        or None if the index was written without them
+        """
+        if any("n_atoms" not in shard for shard in self.shards):
+            return None
+        n_atoms = np.concatenate([np.asarray(shard["n_atoms"], dtype=np.int64) for shard in self.shards])
+        n_edges = np.concatenate(
+            [np.asarray(shard.get("n_edges", [0] * shard["size"]), dtype=np.int64) for shard in self.shards]
+        )
+        if self.entries is not None:
+            entries = np.asarray(self.entries, dtype=np.int64).reshape(-1, 2)
+            flat_idx = np.asarray(self.shard_offsets)[entries[:, 0]] + entries[:, 1]
+            return n_atoms[flat_idx], n_edges[flat_idx]
+        return n_atoms, n_edges
+
+    def _load_shard(self, shard_idx):
+        if shard_idx in self._shards:
+            self._shards.move_to_end(shard_idx)
+            return self._shards[shard_idx]
+
+        shard = torch.load(
+            os.path.join(self.shard_dir, self.shard_files[shard_idx]),
+            map_location=self.map_location,
+        )
+        self._shards[shard_idx] = shard
+        if len(self._shards) > self.max_resident_shards:
+            self._shards.popitem(last=False)
+        return shard
+
+    def get(self, idx):
+        if self.entries is not None:
+            shard_idx, local_idx = self.entries[idx]
+        else:
+            shard_idx = bisect.bisect_right(self.shard_offsets, idx) - 1
+            local_idx = idx - self.shard_offsets[shard_idx]
+        data, slices = self._load_shard(shard_idx)
+        return separate(
+            cls=data.__class__,
+            batch=data,
+            idx=local_idx,
+            slice_dict=slices,
+            decrement=False,
+        )
+
+    def __getstate__(self):
+        # do not ship resident shards to DataLoader workers
+        state = self.__dict__.copy()
+        state["_shards"] = OrderedDict()
+        return state
+
+
+class MemmapStructureDataset(Dataset):
+    """
+    dataset backed by the memory-mapped format written by DataProcessor
+    with memory_map=True. Attribute files are opened with numpy.memmap
+    (copy-on-write) in every process on first access, so DataLoader workers
+    share the page cache instead of unpickling their own copy of the data,
+    and __getitem__ returns views into the mapped files. The data always
+    stays on the host, batches are moved to the device after collation.
+    """
+
+    def __init__(
+        self,
+        root,
+        processed_data_path,
+        processed_file_name,
+        transform=None,
+        pre_transform=None,
+        pre_filter=None,
+        device=None,
+    ):
+        self.root = root
+        self.processed_data_path = processed_data_path
+        self.processed_file_name = processed_file_name
+        if device is not None and torch.device(device).type != "cpu":
+            logging.warning(
+                "Memory-mapped datasets stay on the host, ignoring device {}.".format(device)
+            )
+        super(MemmapStructureDataset, self).__init__(
+            root, transform, pre_transform, pre_filter
+        )
+        with open(self.processed_paths[0]) as f:
+            self.meta = json.load(f)
+        self._arrays = None
+
+    @property
+    def raw_file_names(self):
+        return []
+
+    def download(self):
+        pass
+
+    @property
+    def processed_dir(self):
+        return os.path.join(self.root, self.processed_data_path)
+
+    @property
+    def mmap_dir(self):
+        return os.path.join(self.processed_dir, memmap_dir_name(self.processed_file_name))
+
+    @property
+    def processed_file_names(self):
+        return [os.path.join(memmap_dir_name(self.processed_file_name), MEMMAP_META_FILE)]
+
+    def len(self):
+        return self.meta["num_structures"]
+
+    def _memmap(self, file_name, dtype, shape):
+        if shape[0] == 0 or 0 in shape:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(
+            os.path.join(self.mmap_dir, file_name), dtype=dtype, mode="c", shape=shape
+        )
+
+    def _open(self):
+        n_slices = self.meta["num_structures"] + 1
+        self._arrays, self._slices, self._lists = {}, {}, {}
+        for key, meta in self.meta["tensors"].items():
+            self._arrays[key] = self._memmap(
+                key + ".bin", np.dtype(meta["dtype"]), tuple([meta["length"]] + meta["shape"])
+            )
+            self._slices[key] = self._memmap(key + ".slices.bin", np.int64, (n_slices,))
+        for key in self.meta["lists"]:
+            with open(os.path.join(self.mmap_dir, key + ".json")) as f:
+                self._lists[key] = json.load(f)
+
+    def get(self, idx):
+        if self._arrays is None:
+            self._open()
+
+        data = Data()
+        for key, array in self._arrays.items():
+            start, end = self._slices[key][idx], self._slices[key][idx + 1]
+            value = torch.from_numpy(array[start:end])
+            data[key] = value.movedim(0, self.meta["tensors"][key]["cat_dim"])
+        for key, values in self._lists.items():
+            data[key] = values[idx]
+        return data
+
+    def __getstate__(self):
+        # memmaps would be pickled as full copies, reopen them in the worker instead
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        for key in ("_slices", "_lists"):
+            state.pop(key, None)
+        return state
@@ -1,5 +1,7 @@
 import contextlib
+import functools
 import itertools
+import json
 import os
 import sys
 from itertools import combinations, product
@@ -8,7 +10,6 @@ from typing import Literal
 
 import ase
 import numpy as np
-import pandas
 import torch
 import torch.nn.functional as F
 from ase import Atoms
@@ -135,6 +136,8 @@ def generate_mp_combos(mp_attrs: dict, num_layers) -> list:
 
 
 def get_mae_from_preds():
+    import pandas
+
     df = pandas.read_csv(os.path.join(sys.argv[1], "test_predictions.csv"))
     # pred_comp = df.filter(["target", "prediction"])
     return np.abs(df["target"] - df["prediction"]).mean()
@@ -230,22 +233,24 @@ def normalize_edge_cutoff(dataset, descriptor_label, r):
 
 
 def get_ranges(dataset, descriptor_label):
-    mean = 0.0
-    std = 0.0
-    for index in range(0, len(dataset)):
-        if len(dataset[index].edge_descriptor[descriptor_label]) > 0:
-            if index == 0:
-                feature_max = dataset[index].edge_descriptor[descriptor_label].max()
-                feature_min = dataset[index].edge_descriptor[descriptor_label].min()
-            mean += dataset[index].edge_descriptor[descriptor_label].mean()
-            std += dataset[index].edge_descriptor[descriptor_label].std()
-            if dataset[index].edge_descriptor[descriptor_label].max() > feature_max:
-                feature_max = dataset[index].edge_descriptor[descriptor_label].max()
-            if dataset[index].edge_descriptor[descriptor_label].min() < feature_min:
-                feature_min = dataset[index].edge_descriptor[descriptor_label].min()
-
-    mean = mean / len(dataset)
-    std = std / len(dataset)
+    descriptors = [
+        data.edge_descriptor[descriptor_label]
+        for data in dataset
+        if len(data.edge_descriptor[descriptor_label]) > 0
+    ]
+    values = torch.cat(descriptors)
+    sizes = torch.tensor([len(d) for d in descriptors], device=values.device)
+    ptr = torch.cat([sizes.new_zeros(1), sizes.cumsum(0)])
+
+    # per structure mean and (unbiased) std, averaged over the dataset
+    means = segment_csr(values, ptr, reduce="mean")
+    squared = (values - means.repeat_interleave(sizes)) ** 2
+    stds = torch.sqrt(segment_csr(squared, ptr, reduce="sum") / (sizes - 1))
+
+    mean = means.sum() / len(dataset)
+    std = stds.sum() / len(dataset)
+    feature_min = values.min()
+    feature_max = values.max()
     return mean, std, feature_min, feature_max
 
 
@@ -259,6 +264,29 @@ def clean_up(data_list, attr_list):
         for attr in removable_attrs:
             delattr(data, attr)
 
+def compact_data(data, half_edge_attr=False):
+    """
+    convert a processed Data() object to narrow storage dtypes: int32 index
+    and triplet tensors, int8 cell offsets (if integral), optionally float16 edge_attr,
+    no u tensor and a plain string structure_id. Widened again on collation.
+    """
+    for key, value in data.to_dict().items():
+        if not isinstance(value, torch.Tensor):
+            continue
+        if ("index" in key or key.startswith("triplet_")) and value.dtype == torch.int64:
+            data[key] = value.to(torch.int32)
+        elif key == "cell_offsets" and value.is_floating_point():
+            if torch.equal(value, value.round()) and bool((value.abs() <= 127).all()):
+                data[key] = value.to(torch.int8)
+        elif key == "edge_attr" and half_edge_attr:
+            data[key] = value.half()
+
+    if "u" in data:
+        del data.u
+    if isinstance(data.structure_id, list) and len(data.structure_id) == 1:
+        data.structure_id = str(data.structure_id[0])
+    return data
+
 def get_pbc_cells(cell: torch.Tensor, offset_number: int, device: str = "cpu"):
     """
     Get the periodic boundary condition (PBC) offsets for a unit cell
@@ -445,42 +473,84 @@ def node_rep_from_file(node_representation="onehot"):
     loaded_rep = None
 
     if file_type == "csv":
-        loaded_rep = np.genfromtxt(rep_file_path, delimiter=",")
-        # TODO: need to check if typecasting to integer is needed
-        loaded_rep = loaded_rep.astype(int)
+        # row i holds the representation of atomic number i + 1
+        loaded_rep = np.genfromtxt(rep_file_path, delimiter=",", dtype=np.float32)
 
     elif file_type == "json":
-        # TODO
-        pass
+        # {atomic number: representation}, missing elements are left as zeros
+        with open(rep_file_path) as f:
+            rep_dict = json.load(f)
+        rep_dim = len(next(iter(rep_dict.values())))
+        loaded_rep = np.zeros((100, rep_dim), dtype=np.float32)
+        for atomic_number, rep in rep_dict.items():
+            if int(atomic_number) <= 100:
+                loaded_rep[int(atomic_number) - 1] = rep
+
+    else:
+        raise ValueError("Unsupported node representation file: {}".format(rep_file_path))
 
     return loaded_rep
 
-def generate_node_features(input_data, n_neighbors, device, use_degree=False, node_rep_func = node_rep_one_hot):
+@functools.lru_cache(maxsize=None)
+def node_rep_table(node_representation="onehot", device="cpu"):
+    """
+    (100, d) float tensor of the node representation, loaded once per
+    representation and device
+    """
+    return torch.tensor(node_rep_from_file(node_representation), device=device)
+
+def node_rep_lookup(Z, node_representation="onehot"):
+    # minus 1 as the reps are 0-indexed but atomic number starts from 1
+    return node_rep_table(node_representation, Z.device)[Z - 1]
+
+def generate_node_features(input_data, n_neighbors, device, use_degree=False, node_rep_func=None, node_representation="onehot"):
+    if node_rep_func is None:
+        node_rep_func = functools.partial(node_rep_lookup, node_representation=node_representation)
+
     if isinstance(input_data, Data):
-        input_data.x = node_rep_func(input_data.z)
+        input_data.x = node_rep_func(input_data.z).float()
         if use_degree:
             return one_hot_degree(input_data, n_neighbors)
         return input_data
 
-    for i, data in enumerate(input_data):
-        # minus 1 as the reps are 0-indexed but atomic number starts from 1
-        data.x = node_rep_func(data.z).float()
+    if len(input_data) == 0:
+        return
+
+    # featurize all structures with a single lookup on the concatenated z
+    x = node_rep_func(torch.cat([data.z for data in input_data])).float()
+    for data, data_x in zip(input_data, x.split([data.z.shape[0] for data in input_data])):
+        data.x = data_x
 
     #for i, data in enumerate(input_data):
         #input_data[i] = one_hot_degree(data, n_neighbors)
 
 
-def generate_edge_features(input_data, edge_steps, r, device):
+def generate_edge_features(input_data, edge_steps, r, device, chunk_size=1000000):
     distance_gaussian = GaussianSmearing(0, 1, edge_steps, 0.2, device=device)
 
     if isinstance(input_data, Data):
         input_data = [input_data]
+    if len(input_data) == 0:
+        return
 
-    normalize_edge_cutoff(input_data, "distance", r)
-    for i, data in enumerate(input_data):
-        input_data[i].edge_attr = distance_gaussian(
-            input_data[i].edge_descriptor["distance"]
+    # normalize and expand the distances of all structures at once, in chunks
+    # of chunk_size edges to bound the size of the temporaries
+    sizes = [len(data.edge_descriptor["distance"]) for data in input_data]
+    distances = torch.cat([data.edge_descriptor["distance"] for data in input_data]) / r
+    edge_attr = torch.empty(
+        (distances.shape[0], edge_steps), dtype=distances.dtype, device=distances.device
+    )
+    for start in range(0, distances.shape[0], chunk_size):
+        edge_attr[start : start + chunk_size] = distance_gaussian(
+            distances[start : start + chunk_size]
         )
+
+    for data, data_distances, data_edge_attr in zip(
+        input_data, distances.split(sizes), edge_attr.split(sizes)
+    ):
+        data.edge_descriptor["distance"] = data_distances
+        data.edge_attr = data_edge_attr
+
 def triplets(
     edge_index,
     num_nodes,
@@ -542,6 +612,41 @@ def triplets_pbc(edge_index, cell_offsets, num_nodes):
     return idx_i, idx_j, idx_k, idx_kj, idx_ji
 
 
+def triplets_csr(edge_index, num_nodes, cell_offsets=None):
+    """
+    triplet indices of one graph in a compact, batch independent form:
+    the number of triplets of every (j->i) edge, and for every triplet the
+    position of its (k->j) edge relative to its (j->i) edge.
+    Expanded again with triplets_from_csr.
+    """
+    if cell_offsets is not None and cell_offsets.dim() == 2 and cell_offsets.shape[0] == edge_index.shape[1]:
+        _, _, _, idx_kj, idx_ji = triplets_pbc(edge_index, cell_offsets.to(edge_index.device), num_nodes)
+    else:
+        _, _, _, _, _, idx_kj, idx_ji = triplets(edge_index, num_nodes)
+
+    # idx_ji is sorted, so the counts fully describe it
+    triplet_count = torch.bincount(idx_ji, minlength=edge_index.shape[1])
+    return triplet_count, idx_kj - idx_ji
+
+def triplets_from_csr(triplet_count, triplet_kj_offset):
+    """
+    expand cached triplets (see triplets_csr) to (idx_kj, idx_ji) edge
+    indices; also valid for batches, where the counts are concatenated
+    """
+    idx_ji = torch.repeat_interleave(
+        torch.arange(triplet_count.shape[0], device=triplet_count.device), triplet_count
+    )
+    return idx_ji + triplet_kj_offset, idx_ji
+
+def compute_triplet_angles(edge_vec, idx_kj, idx_ji):
+    """
+    angles between the (k->j) and (j->i) edge vectors of every triplet
+    """
+    vec_ji, vec_kj = edge_vec[idx_ji], edge_vec[idx_kj]
+    a = (vec_ji * vec_kj).sum(dim=-1)
+    b = torch.cross(vec_ji, vec_kj, dim=-1).norm(dim=-1)
+    return torch.atan2(b, a)
+
 def compute_bond_angles(
     pos: torch.Tensor, offsets: torch.Tensor, edge_index: torch.Tensor, num_nodes: int
 ) -> torch.Tensor:
@@ -551,11 +656,11 @@ def compute_bond_angles(
     """
     # Calculate triplets
     if (offsets is None):
-        _, _, idx_i, idx_j, idx_k, idx_kj, idx_ji = tripletsOld(
-        edge_index, num_nodes
+        _, _, idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets(
+            edge_index, num_nodes
         )
     else:
-        idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets(
+        idx_i, idx_j, idx_k, idx_kj, idx_ji = triplets_pbc(
             edge_index, offsets.to(device=edge_index.device), num_nodes
         )
 
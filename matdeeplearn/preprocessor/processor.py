@@ -1,6 +1,12 @@
+import collections
+import hashlib
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -8,17 +14,26 @@ import torch
 import ase
 from ase import io, Atoms, neighborlist
 from torch_geometric.data import Data, InMemoryDataset
+from torch_geometric.data.collate import collate
 from torch_geometric.transforms import Compose
 from torch_geometric.utils import dense_to_sparse
 from tqdm import tqdm
 
 from matdeeplearn.common.registry import registry
+from matdeeplearn.preprocessor.datasets import (
+    MemmapWriter,
+    ShardWriter,
+    memmap_dir_name,
+    shard_dir_name,
+)
 from matdeeplearn.preprocessor.helpers import (
     clean_up,
+    compact_data,
     generate_edge_features,
     generate_node_features,
     get_cutoff_distance_matrix,
     calculate_edges_master,
+    triplets_csr,
 )
 
 
@@ -42,6 +57,15 @@ def from_config(dataset_config):
     verbose: bool = dataset_config.get("verbose", True)
     edge_calc_method = dataset_config["preprocess_params"].get("edge_calc_method", "mdl")
     device: str = dataset_config.get("device", "cpu")
+    num_workers = dataset_config["preprocess_params"].get("num_workers", 1)
+    chunk_size = dataset_config["preprocess_params"].get("chunk_size", None)
+    large_dataset = dataset_config.get("large_dataset", False)
+    shard_size = dataset_config["preprocess_params"].get("shard_size", 1000)
+    memory_map = dataset_config.get("memory_map", False)
+    incremental = dataset_config["preprocess_params"].get("incremental", False)
+    compact_storage = dataset_config["preprocess_params"].get("compact_storage", False)
+    compact_edge_attr = dataset_config["preprocess_params"].get("compact_edge_attr", False)
+    preprocess_triplets = dataset_config["preprocess_params"].get("preprocess_triplets", False)
 
     processor = DataProcessor(
         root_path=root_path_dict,
@@ -64,6 +88,15 @@ def from_config(dataset_config):
         verbose=verbose,
         edge_calc_method=edge_calc_method,
         device=device,
+        num_workers=num_workers,
+        chunk_size=chunk_size,
+        large_dataset=large_dataset,
+        shard_size=shard_size,
+        memory_map=memory_map,
+        incremental=incremental,
+        compact_storage=compact_storage,
+        compact_edge_attr=compact_edge_attr,
+        preprocess_triplets=preprocess_triplets,
     )
     
     return processor
@@ -76,6 +109,69 @@ def process_data(dataset_config):
     return dataset
 
 
+def collate_data_list(data_list):
+    """
+    collate a list of Data() objects into a single (data, slices) pair,
+    the same layout InMemoryDataset.collate produces (also for one element)
+    """
+    data, slices, _ = collate(
+        data_list[0].__class__,
+        data_list=data_list,
+        increment=False,
+        add_batch=False,
+    )
+    return data, slices
+
+
+def merge_collated(collated_list):
+    """
+    merge several collated (data, slices) pairs into one, keeping the
+    order of collated_list. Since collation is done without incrementing
+    indices this only requires concatenation and shifting the slices.
+
+    The attributes of the pairs in collated_list are deleted once merged,
+    so besides the result at most one attribute is held twice.
+    """
+    collated_list = [c for c in collated_list if c is not None]
+    if len(collated_list) == 1:
+        return collated_list[0]
+
+    first_data, first_slices = collated_list[0]
+    data = first_data.__class__()
+    slices = {}
+    for key in first_slices.keys():
+        values = [c[0][key] for c in collated_list]
+        if isinstance(values[0], torch.Tensor):
+            cat_dim = first_data.__cat_dim__(key, values[0])
+            data[key] = torch.cat(values, dim=0 if cat_dim is None else cat_dim)
+        else:
+            data[key] = list(itertools.chain.from_iterable(values))
+        del values
+        for c_data, _ in collated_list:
+            del c_data[key]
+
+        merged, offset = [first_slices[key][:1]], 0
+        for _, c_slices in collated_list:
+            merged.append(c_slices[key][1:] + offset)
+            offset = offset + c_slices[key][-1]
+        slices[key] = torch.cat(merged)
+
+    return data, slices
+
+
+def _process_shard(processor, records):
+    """
+    worker entry point of the parallel mode: read, convert and featurize
+    one shard of raw records and return it collated
+    """
+    torch.set_num_threads(1)
+    dict_structures = processor.wrap_records(records)
+    if len(dict_structures) == 0:
+        return None
+    data_list = processor.get_data_list(dict_structures)
+    return collate_data_list(data_list)
+
+
 class DataProcessor:
     def __init__(
         self,
@@ -99,6 +195,15 @@ class DataProcessor:
         verbose: bool = True,
         edge_calc_method: str = "mdl",
         device: str = "cpu",
+        num_workers: int = 1,
+        chunk_size: int = None,
+        large_dataset: bool = False,
+        shard_size: int = 1000,
+        memory_map: bool = False,
+        incremental: bool = False,
+        compact_storage: bool = False,
+        compact_edge_attr: bool = False,
+        preprocess_triplets: bool = False,
     ) -> None:
         """
         create a DataProcessor that processes the raw data and save into data.pt file.
@@ -150,6 +255,57 @@ class DataProcessor:
 
             verbose: bool
                 if True, certain messages will be printed
+
+            num_workers: int
+                default 1. Number of processes used to read and featurize
+                structures. If > 1, structures are split into shards which
+                are processed in a process pool and merged in input order.
+
+            chunk_size: int
+                default None. If set, raw structures are streamed from the
+                source (JSON lines, or incrementally parsed JSON if ijson is
+                installed) and converted in chunks of chunk_size structures,
+                so only one chunk of intermediate objects (raw dicts and Data()
+                objects) is held in memory. The collated split saved to
+                data.pt is still held in full; use large_dataset or
+                memory_map to write it to disk chunk by chunk instead.
+
+            large_dataset: bool
+                default False. If True, each split is saved as a directory of
+                shard files plus an index (read by LargeStructureDataset)
+                instead of a single data.pt file.
+
+            shard_size: int
+                default 1000. Number of structures per shard file when
+                large_dataset is True, and per written chunk when memory_map
+                is True.
+
+            memory_map: bool
+                default False. If True, each split is saved as a directory of
+                flat per-attribute binary files (read with numpy.memmap by
+                MemmapStructureDataset) instead of a single data.pt file.
+
+            incremental: bool
+                default False. Only used with large_dataset. If True, raw
+                structures are hashed together with the preprocessing
+                parameters and only new or changed structures are processed
+                and appended to the existing shards.
+
+            compact_storage: bool
+                default False. If True, graphs are stored with narrow dtypes:
+                int32 index tensors, int8 cell offsets, no u tensor and plain
+                string structure ids. They are widened again when batches
+                are collated.
+
+            compact_edge_attr: bool
+                default False. If True (and compact_storage is True), edge_attr
+                is stored as float16.
+
+            preprocess_triplets: bool
+                default False. If True (and preprocess_edges is True), the
+                (k->j->i) triplets of every graph are enumerated once and
+                stored as triplet_count (per edge) and triplet_kj_offset (per
+                triplet), for angle-based models and the LineGraphMod transform.
         """
 
         self.root_path_dict = root_path
@@ -172,6 +328,15 @@ class DataProcessor:
         self.edge_calc_method = edge_calc_method
         self.device = device
         self.transforms = transforms
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.large_dataset = large_dataset
+        self.shard_size = shard_size
+        self.memory_map = memory_map
+        self.incremental = incremental
+        self.compact_storage = compact_storage
+        self.compact_edge_attr = compact_edge_attr
+        self.preprocess_triplets = preprocess_triplets
         self.disable_tqdm = logging.root.level > logging.INFO
 
     def src_check(self):
@@ -180,25 +345,142 @@ class DataProcessor:
         else:
             return self.json_wrap()
 
-    def ase_wrap(self):
+    def get_raw_records(self):
+        """
+        return the raw records of the current split without converting them:
+        (structure_id, y) pairs for ase readable files, or the raw dicts of
+        the JSON file
+        """
+        if self.target_file_path:
+            df = pd.read_csv(self.target_file_path, header=None)
+            file_names = df[0].to_list()
+            y = df.iloc[:, 1:].to_numpy()
+            return list(zip(file_names, y))
+
+        if self._is_json_lines():
+            return list(self.iter_raw_records())
+
+        logging.info(
+            "Loading json file as dict (this might take a while for large json file size)."
+        )
+        with open(self.root_path) as f:
+            return json.load(f)
+
+    def _is_json_lines(self):
+        return os.path.splitext(self.root_path)[1].lower() in (".jsonl", ".jsonlines")
+
+    def iter_raw_records(self):
+        """
+        lazily yield the raw records of the current split. JSON lines files
+        are read line by line and a single JSON list is parsed incrementally
+        with ijson, so the whole file is never loaded at once. Without ijson
+        this falls back to json.load.
+        """
+        if self.target_file_path:
+            yield from self.get_raw_records()
+            return
+
+        if self._is_json_lines():
+            logging.info("Streaming structures from JSON lines file.")
+            with open(self.root_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line)
+            return
+
+        try:
+            import ijson
+        except ImportError:
+            logging.warning(
+                "ijson is not installed, loading the whole json file instead of streaming it."
+            )
+            yield from self.get_raw_records()
+            return
+
+        logging.info("Streaming structures from json file.")
+        with open(self.root_path, "rb") as f:
+            yield from ijson.items(f, "item", use_float=True)
+
+    def is_valid_record(self, record):
+        """
+        False for raw records that are skipped during conversion
+        (single atom structures in JSON files)
+        """
+        if self.target_file_path:
+            return True
+        return len(record["atomic_numbers"]) != 1
+
+    def record_hash(self, record):
+        """
+        content hash of a raw record: the structure file and target for ase
+        readable files, or the full raw dict for JSON files
+        """
+        h = hashlib.sha1()
+        if self.target_file_path:
+            structure_id, target_val = record
+            p = os.path.join(self.root_path, str(structure_id) + "." + self.data_format)
+            h.update(str(structure_id).encode())
+            with open(p, "rb") as f:
+                h.update(f.read())
+            h.update(np.asarray(target_val, dtype=np.float64).tobytes())
+        else:
+            h.update(json.dumps(record, sort_keys=True, default=float).encode())
+        return h.hexdigest()
+
+    def preprocess_fingerprint(self):
+        """
+        hash of all parameters that change the processed output of a record
+        """
+        params = {
+            "r": self.r,
+            "n_neighbors": self.n_neighbors,
+            "num_offsets": self.num_offsets,
+            "edge_calc_method": self.edge_calc_method,
+            "edge_dim": self.edge_dim,
+            "node_representation": self.node_representation,
+            "prediction_level": self.prediction_level,
+            "preprocess_edges": self.preprocess_edges,
+            "preprocess_edge_features": self.preprocess_edge_features,
+            "preprocess_node_features": self.preprocess_node_features,
+            "self_loop": self.self_loop,
+            "image_selfloop": self.image_selfloop,
+            "additional_attributes": self.additional_attributes,
+            "transforms": [t for t in self.transforms if not t.get("otf_transform", False)],
+            "compact_storage": self.compact_storage,
+            "compact_edge_attr": self.compact_edge_attr,
+            "preprocess_triplets": self.preprocess_triplets,
+        }
+        return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def wrap_records(self, records):
+        """
+        convert raw records returned by get_raw_records to standardized dicts
+        """
+        if self.target_file_path:
+            return self.ase_wrap(records)
+        else:
+            return self.json_wrap(records)
+
+    def ase_wrap(self, records=None):
         """
         raw files are ase readable and self.target_file_path is not None
+
+        records: list of (structure_id, y) pairs, read from
+        self.target_file_path if not given
         """
         logging.info("Reading individual structures using ASE.")
 
-        df = pd.read_csv(self.target_file_path, header=None)
-        file_names = df[0].to_list()
-        y = df.iloc[:, 1:].to_numpy()
+        if records is None:
+            records = self.get_raw_records()
 
         dict_structures = []
-        ase_structures = []
 
         logging.info("Converting data to standardized form for downstream processing.")
-        for i, structure_id in enumerate(file_names):
+        for structure_id, target_val in tqdm(records, disable=self.disable_tqdm):
             p = os.path.join(self.root_path, str(structure_id) + "." + self.data_format)
-            ase_structures.append(io.read(p))
+            s = io.read(p)
 
-        for i, s in enumerate(tqdm(ase_structures, disable=self.disable_tqdm)):
             d = {}
             pos = torch.tensor(s.get_positions(), device=self.device, dtype=torch.float)
             cell = torch.tensor(
@@ -211,7 +493,7 @@ class DataProcessor:
             d["positions"] = pos
             d["cell"] = cell
             d["atomic_numbers"] = atomic_numbers
-            d["structure_id"] = str(file_names[i])
+            d["structure_id"] = str(structure_id)
 
             # add additional attributes
             if self.additional_attributes:
@@ -219,7 +501,7 @@ class DataProcessor:
                 for k, v in attributes.items():
                     d[k] = v
                     
-            d["y"] = y[i]
+            d["y"] = target_val
             
             dict_structures.append(d)
 
@@ -240,32 +522,25 @@ class DataProcessor:
 
         return attributes
 
-    def json_wrap(self):
+    def json_wrap(self, original_structures=None):
         """
         all structures are saved in a single json file
+
+        original_structures: list of raw structure dicts, loaded from
+        self.root_path if not given
         """
         logging.info("Reading one JSON file for multiple structures.")
 
-        f = open(self.root_path)
-
-        logging.info(
-            "Loading json file as dict (this might take a while for large json file size)."
-        )
-        original_structures = json.load(f)
-        f.close()
+        if original_structures is None:
+            original_structures = self.get_raw_records()
 
         dict_structures = []
         y = []
-        y_dim = (
-            len(original_structures[0]["y"])
-            if isinstance(original_structures[0]["y"], list)
-            else 1
-        )
 
         logging.info("Converting data to standardized form for downstream processing.")
         for i, s in enumerate(tqdm(original_structures, disable=self.disable_tqdm)):
             d = {}
-            if (len(s["atomic_numbers"]) == 1):
+            if not self.is_valid_record(s):
                 continue
             pos = torch.tensor(s["positions"], device=self.device, dtype=torch.float)
             if "cell" in s:
@@ -309,104 +584,263 @@ class DataProcessor:
         return dict_structures
 
     def process(self, save=True):
-        
+        """
+        process all splits found in root_path and save them to pt_path.
+
+        Returns a dict of split name to the list of Data() objects, to
+        the collated (data, slices) when processing with num_workers > 1
+        or chunk_size, or to the output directory with large_dataset or memory_map.
+        """
         data_list={}
         if isinstance(self.root_path_dict, dict):
-            
-            if self.root_path_dict.get("train"):     
-                self.root_path = self.root_path_dict["train"]
+            for split in ["train", "val", "test", "predict"]:
+                if not self.root_path_dict.get(split):
+                    continue
+                self.root_path = self.root_path_dict[split]
                 if self.target_file_path_dict: 
-                    self.target_file_path = self.target_file_path_dict["train"]
+                    self.target_file_path = self.target_file_path_dict[split]
                 else: 
                     self.target_file_path = self.target_file_path_dict
-                logging.info("Train dataset found at {}".format(self.root_path))
-                logging.info("Processing device: {}".format(self.device))
-        
-                dict_structures = self.src_check()
-                data_list["train"] = self.get_data_list(dict_structures)
-                data, slices = InMemoryDataset.collate(data_list["train"])
-        
-                if save:
-                    if self.pt_path:
-                        save_path = os.path.join(self.pt_path, "data_train.pt")    
-                    torch.save((data, slices), save_path)
-                    logging.info("Processed train data saved successfully.")   
-                
-            if self.root_path_dict.get("val"):
-                self.root_path = self.root_path_dict["val"] 
-                if self.target_file_path_dict: 
-                    self.target_file_path = self.target_file_path_dict["val"]
-                else: 
-                    self.target_file_path = self.target_file_path_dict            
-                logging.info("Val dataset found at {}".format(self.root_path))
-                logging.info("Processing device: {}".format(self.device))
-        
-                dict_structures = self.src_check()
-                data_list["val"] = self.get_data_list(dict_structures)
-                data, slices = InMemoryDataset.collate(data_list["val"])
-        
-                if save:
-                    if self.pt_path:
-                        save_path = os.path.join(self.pt_path, "data_val.pt")    
-                    torch.save((data, slices), save_path)
-                    logging.info("Processed val data saved successfully.")   
-            
-            if self.root_path_dict.get("test"):    
-                self.root_path = self.root_path_dict["test"]
-                if self.target_file_path_dict: 
-                    self.target_file_path = self.target_file_path_dict["test"]
-                else: 
-                    self.target_file_path = self.target_file_path_dict                
-                logging.info("Test dataset found at {}".format(self.root_path))
-                logging.info("Processing device: {}".format(self.device))
-        
-                dict_structures = self.src_check()
-                data_list["test"] = self.get_data_list(dict_structures)
-                data, slices = InMemoryDataset.collate(data_list["test"])
-    
-                if save:
-                    if self.pt_path:
-                        save_path = os.path.join(self.pt_path, "data_test.pt")    
-                    torch.save((data, slices), save_path)
-                    logging.info("Processed test data saved successfully.")   
-                    
-            if self.root_path_dict.get("predict"):    
-                self.root_path = self.root_path_dict["predict"]
-                if self.target_file_path_dict: 
-                    self.target_file_path = self.target_file_path_dict["predict"]
-                else: 
-                    self.target_file_path = self.target_file_path_dict                
-                logging.info("Predict dataset found at {}".format(self.root_path))
-                logging.info("Processing device: {}".format(self.device))
-        
-                dict_structures = self.src_check()
-                data_list["predict"] = self.get_data_list(dict_structures)
-                data, slices = InMemoryDataset.collate(data_list["predict"])
-    
-                if save:
-                    if self.pt_path:
-                        save_path = os.path.join(self.pt_path, "data_predict.pt")    
-                    torch.save((data, slices), save_path)
-                    logging.info("Processed predict data saved successfully.")  
+                logging.info("{} dataset found at {}".format(split.capitalize(), self.root_path))
+
+                data_list[split] = self._process_split(
+                    "data_{}.pt".format(split), save, "{} ".format(split)
+                )
                                                          
         else: 
             self.root_path = self.root_path_dict
             self.target_file_path = self.target_file_path_dict
             logging.info("Single dataset found at {}".format(self.root_path))
-            logging.info("Processing device: {}".format(self.device))
-    
-            dict_structures = self.src_check()
-            data_list["full"] = self.get_data_list(dict_structures)
-            data, slices = InMemoryDataset.collate(data_list["full"])
-    
-            if save:
-                if self.pt_path:
-                    save_path = os.path.join(self.pt_path, "data.pt")    
-                torch.save((data, slices), save_path)
-                logging.info("Processed data saved successfully.")   
+
+            data_list["full"] = self._process_split("data.pt", save)
                               
         return data_list
 
+    def _process_split(self, file_name, save, label=""):
+        logging.info("Processing device: {}".format(self.device))
+
+        if self.num_workers > 1 and str(self.device) != "cpu":
+            logging.warning(
+                "Parallel processing is only supported on cpu, processing serially on {}.".format(self.device)
+            )
+
+        if self.large_dataset and save and self.incremental:
+            return self.process_incremental(os.path.join(self.pt_path, shard_dir_name(file_name)), label)
+        elif self.large_dataset and save:
+            writer = ShardWriter(os.path.join(self.pt_path, shard_dir_name(file_name)))
+            return self.process_to_writer(writer, label)
+        elif self.memory_map and save:
+            writer = MemmapWriter(os.path.join(self.pt_path, memmap_dir_name(file_name)))
+            return self.process_to_writer(writer, label)
+        elif self.chunk_size:
+            data, slices = self.process_chunked()
+            data_list = (data, slices)
+        elif self.num_workers > 1 and str(self.device) == "cpu":
+            data, slices = self.process_parallel()
+            data_list = (data, slices)
+        else:
+            dict_structures = self.src_check()
+            data_list = self.get_data_list(dict_structures)
+            data, slices = InMemoryDataset.collate(data_list)
+
+        if save:
+            if self.pt_path:
+                save_path = os.path.join(self.pt_path, file_name)
+            torch.save((data, slices), save_path)
+            logging.info("Processed {}data saved successfully.".format(label))
+
+        return data_list
+
+    def process_parallel(self):
+        """
+        process the current split with a pool of self.num_workers processes.
+
+        The raw records are split into contiguous shards; each worker reads,
+        converts, featurizes and collates one shard. Shards are merged in
+        their input order, so the result is identical to the serial path.
+        """
+        records = self.get_raw_records()
+        n_shards = max(1, min(len(records), self.num_workers * 4))
+        shard_size = math.ceil(len(records) / n_shards)
+        shards = [
+            records[i : i + shard_size] for i in range(0, len(records), shard_size)
+        ]
+        logging.info(
+            "Processing {} structures in {} shards with {} workers.".format(
+                len(records), len(shards), self.num_workers
+            )
+        )
+
+        # spawn so workers do not inherit the (possibly initialized) torch thread pools
+        disable_tqdm, self.disable_tqdm = self.disable_tqdm, True
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                futures = [executor.submit(_process_shard, self, shard) for shard in shards]
+                collated = [
+                    future.result() for future in tqdm(futures, disable=disable_tqdm)
+                ]
+        finally:
+            self.disable_tqdm = disable_tqdm
+
+        if all(c is None for c in collated):
+            raise ValueError("No structures left to process in {}".format(self.root_path))
+
+        return merge_collated(collated)
+
+    def iter_collated_chunks(self, records=None):
+        """
+        stream the raw records of the current split (or the given iterable
+        of raw records) in chunks of self.chunk_size and yield each chunk as
+        a collated (data, slices) pair, in input order. Only the current
+        chunk (or, with num_workers > 1, at most 2 * num_workers chunks) is
+        held as raw dicts and Data() objects at a time.
+        """
+        records = iter(self.iter_raw_records() if records is None else records)
+        chunks = iter(lambda: list(itertools.islice(records, self.chunk_size)), [])
+
+        # progress is reported per chunk instead of per structure
+        disable_tqdm, self.disable_tqdm = self.disable_tqdm, True
+        try:
+            if self.num_workers <= 1 or str(self.device) != "cpu":
+                for chunk in chunks:
+                    dict_structures = self.wrap_records(chunk)
+                    if len(dict_structures) == 0:
+                        continue
+                    yield collate_data_list(self.get_data_list(dict_structures))
+                return
+
+            with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                pending = []
+                for chunk in chunks:
+                    pending.append(executor.submit(_process_shard, self, chunk))
+                    if len(pending) >= 2 * self.num_workers:
+                        collated = pending.pop(0).result()
+                        if collated is not None:
+                            yield collated
+                for future in pending:
+                    collated = future.result()
+                    if collated is not None:
+                        yield collated
+        finally:
+            self.disable_tqdm = disable_tqdm
+
+    def process_chunked(self):
+        """
+        process the current split chunk by chunk (see iter_collated_chunks)
+        and merge the collated chunks into a single (data, slices)
+
+        This bounds the raw dicts and Data() objects to one chunk, but the
+        collated chunks and the merged result cover the whole split. Only
+        process_to_writer (large_dataset or memory_map) bounds memory by the
+        chunk size.
+        """
+        collated = []
+        n_structures = 0
+        for data, slices in tqdm(self.iter_collated_chunks(), disable=self.disable_tqdm):
+            collated.append((data, slices))
+            n_structures += len(slices["n_atoms"]) - 1
+            logging.debug("Processed {} structures.".format(n_structures))
+
+        if len(collated) == 0:
+            raise ValueError("No structures left to process in {}".format(self.root_path))
+
+        return merge_collated(collated)
+
+    def process_to_writer(self, writer, label=""):
+        """
+        process the current split in chunks of self.shard_size structures
+        and append every collated chunk to writer (a ShardWriter or a
+        MemmapWriter). The whole split is never held in memory. Returns the
+        output directory.
+        """
+        chunk_size, self.chunk_size = self.chunk_size, self.shard_size
+        try:
+            for data, slices in tqdm(self.iter_collated_chunks(), disable=self.disable_tqdm):
+                writer.append(data, slices)
+        finally:
+            self.chunk_size = chunk_size
+
+        if len(writer) == 0:
+            raise ValueError("No structures left to process in {}".format(self.root_path))
+        writer.close()
+        logging.info(
+            "Processed {}data saved successfully to {} ({} structures).".format(
+                label, writer.path, len(writer)
+            )
+        )
+
+        return writer.path
+
+    def process_incremental(self, shard_dir, label=""):
+        """
+        update the shard store in shard_dir with the current split. Every raw
+        record is identified by its content hash; records already stored
+        with the same preprocessing parameters are reused, new or changed
+        ones are processed in chunks of self.shard_size and appended as new
+        shards. The entries of the index follow the order of the raw data,
+        records no longer present are dropped from it, and mostly stale or
+        small shards are compacted (see ShardWriter.compact). Returns
+        shard_dir.
+        """
+        fingerprint = self.preprocess_fingerprint()
+        writer = ShardWriter(shard_dir, append=True)
+        if writer.index and writer.index.get("fingerprint") != fingerprint:
+            logging.info("Preprocessing parameters changed, rebuilding {}".format(shard_dir))
+            writer = ShardWriter(shard_dir)
+        elif writer.index and "records" not in writer.index:
+            logging.info("{} was not processed incrementally, rebuilding it.".format(shard_dir))
+            writer = ShardWriter(shard_dir)
+        stored = writer.index.get("records", {})
+
+        hashes, pending, queued = [], collections.deque(), set()
+
+        def new_records():
+            for record in self.iter_raw_records():
+                if not self.is_valid_record(record):
+                    continue
+                record_hash = self.record_hash(record)
+                hashes.append(record_hash)
+                if record_hash not in stored and record_hash not in queued:
+                    queued.add(record_hash)
+                    pending.append(record_hash)
+                    yield record
+
+        chunk_size, self.chunk_size = self.chunk_size, self.shard_size
+        try:
+            for data, slices in tqdm(
+                self.iter_collated_chunks(new_records()), disable=self.disable_tqdm
+            ):
+                shard_idx = writer.append(data, slices)
+                for local_idx in range(writer.shards[shard_idx]["size"]):
+                    stored[pending.popleft()] = [shard_idx, local_idx]
+        finally:
+            self.chunk_size = chunk_size
+
+        if len(hashes) == 0:
+            raise ValueError("No structures left to process in {}".format(self.root_path))
+
+        current = set(hashes)
+        records = {h: v for h, v in stored.items() if h in current}
+        records = writer.compact(records, self.shard_size)
+        writer.close(
+            fingerprint=fingerprint,
+            records=records,
+            entries=[records[h] for h in hashes],
+        )
+        logging.info(
+            "Processed {}data saved successfully to {} ({} new, {} reused, {} dropped structures).".format(
+                label, shard_dir, len(queued), len(current) - len(queued), len(stored) - len(records)
+            )
+        )
+
+        return shard_dir
+
     def get_data_list(self, dict_structures):
         n_structures = len(dict_structures)
         data_list = [Data() for _ in range(n_structures)]
@@ -472,6 +906,11 @@ class DataProcessor:
                 # data.edge_descriptor["mask"] = cd_matrix_masked
                 data.edge_descriptor["distance"] = edge_weights
                 # data.distances = edge_weights
+
+                if self.preprocess_triplets:
+                    data.triplet_count, data.triplet_kj_offset = triplets_csr(
+                        edge_indices, data.n_atoms, cell_offsets
+                    )
             
 
             # add additional attributes
@@ -481,7 +920,12 @@ class DataProcessor:
 
         if self.preprocess_node_features == True:            
             logging.info("Generating node features...")
-            generate_node_features(data_list, self.n_neighbors, device=self.device)
+            generate_node_features(
+                data_list,
+                self.n_neighbors,
+                device=self.device,
+                node_representation=self.node_representation,
+            )
 
         if self.preprocess_edge_features == True:
             logging.info("Generating edge features...")
@@ -512,4 +956,8 @@ class DataProcessor:
 
         clean_up(data_list, ["edge_descriptor"])
 
+        if self.compact_storage:
+            for data in data_list:
+                compact_data(data, half_edge_attr=self.compact_edge_attr)
+
         return data_list
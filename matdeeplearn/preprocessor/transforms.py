@@ -2,7 +2,11 @@ import torch
 from torch_sparse import coalesce
 
 from matdeeplearn.common.registry import registry
-from matdeeplearn.preprocessor.helpers import compute_bond_angles
+from matdeeplearn.preprocessor.helpers import (
+    compute_bond_angles,
+    compute_triplet_angles,
+    triplets_from_csr,
+)
 
 """
 here resides the transform classes needed for data processing
@@ -61,15 +65,22 @@ class LineGraphMod(object):
         edge_index, edge_attr = data.edge_index, data.edge_attr
         _, edge_attr = coalesce(edge_index, edge_attr, N, N)
 
-        # compute bond angles
-        try:
-            angles, idx_kj, idx_ji = compute_bond_angles(
-                data.pos, data.cell_offsets, data.edge_index, data.num_nodes
-            )
-        except:
-            angles, idx_kj, idx_ji = compute_bond_angles(
-                data.pos, None, data.edge_index, data.num_nodes
+        # compute bond angles, from the triplets cached during processing
+        # (preprocess_triplets) if available
+        if "triplet_count" in data and "edge_vec" in data:
+            idx_kj, idx_ji = triplets_from_csr(
+                data.triplet_count.long(), data.triplet_kj_offset.long()
             )
+            angles = compute_triplet_angles(data.edge_vec, idx_kj, idx_ji)
+        else:
+            try:
+                angles, idx_kj, idx_ji = compute_bond_angles(
+                    data.pos, data.cell_offsets, data.edge_index, data.num_nodes
+                )
+            except:
+                angles, idx_kj, idx_ji = compute_bond_angles(
+                    data.pos, None, data.edge_index, data.num_nodes
+                )
         triplet_pairs = torch.stack([idx_kj, idx_ji], dim=0)
 
         data.edge_index_lg = triplet_pairs
@@ -1,5 +1,4 @@
 import copy
-import csv
 import logging
 import os
 import random
@@ -17,12 +16,17 @@ from torch.optim import Optimizer
 from torch.utils.data.distributed import DistributedSampler
 from torch_geometric.data import Dataset
 
-from matdeeplearn.common.data import (DataLoader, dataset_split,
-                                      get_dataloader, get_dataset)
+from matdeeplearn.common.data import (BatchPrefetcher, DataLoader,
+                                      ShardSampler, SizeBucketBatchSampler,
+                                      dataset_split, get_dataloader,
+                                      get_dataset)
+from matdeeplearn.common.prediction_writer import (PredictionWriter,
+                                                   prediction_headers)
 from matdeeplearn.common.registry import registry
 from matdeeplearn.models.base_model import BaseModel
 from matdeeplearn.modules.evaluator import Evaluator
 from matdeeplearn.modules.scheduler import LRScheduler
+from matdeeplearn.preprocessor.helpers import node_rep_table
 
 
 @registry.register_trainer("base")
@@ -48,6 +52,11 @@ class BaseTrainer(ABC):
         save_dir: str = None,
         checkpoint_path: str = None,
         use_amp: bool = False,
+        prefetch_batches: int = 0,
+        shared_batches: bool = False,
+        bootstrap: bool = False,
+        output_format: str = "csv",
+        inference_precision: str = "fp32",
     ):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model = model
@@ -77,15 +86,22 @@ class BaseTrainer(ABC):
         self.save_dir = save_dir if save_dir else os.getcwd()
         self.checkpoint_path = checkpoint_path
         self.use_amp = use_amp
+        self.prefetch_batches = prefetch_batches
+        self.shared_batches = shared_batches
+        self.bootstrap = bootstrap
+        self.output_format = output_format
+        self.inference_precision = inference_precision
 
         if self.use_amp:
             logging.info("Using PyTorch automatic mixed-precision")
+        if self.inference_precision != "fp32":
+            logging.info(f"Predicting with {self.inference_precision} inference precision")
 
         self.scaler = GradScaler(enabled=self.use_amp and self.device.type == "cuda")
 
         self.evaluator = Evaluator()
 
-        if self.train_sampler == None:
+        if self.train_sampler == None or getattr(self.train_sampler, "num_replicas", 1) == 1:
             self.rank = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             self.rank = self.train_sampler.rank
@@ -197,6 +213,11 @@ class BaseTrainer(ABC):
             save_dir=save_dir,
             checkpoint_path=checkpoint_path,
             use_amp=config["task"].get("use_amp", False),
+            prefetch_batches=config["optim"].get("prefetch_batches", 0),
+            shared_batches=config["optim"].get("shared_batches", False),
+            bootstrap=config["optim"].get("bootstrap", False),
+            output_format=config["task"].get("output_format", "csv"),
+            inference_precision=config["task"].get("inference_precision", "fp32"),
         )
 
     @staticmethod
@@ -215,28 +236,36 @@ class BaseTrainer(ABC):
                     dataset_path,
                     processed_file_name="data_train.pt",
                     transform_list=dataset_config.get("transforms", []),
+                    large_dataset=dataset_config.get("large_dataset", False),
                     dataset_device=dataset_config.get("dataset_device", "cpu"),
+                    memory_map=dataset_config.get("memory_map", False),
                 )
             if dataset_config["src"].get("val"):
                 dataset["val"] = get_dataset(
                     dataset_path,
                     processed_file_name="data_val.pt",
                     transform_list=dataset_config.get("transforms", []),
+                    large_dataset=dataset_config.get("large_dataset", False),
                     dataset_device=dataset_config.get("dataset_device", "cpu"),
+                    memory_map=dataset_config.get("memory_map", False),
                 )
             if dataset_config["src"].get("test"):
                 dataset["test"] = get_dataset(
                     dataset_path,
                     processed_file_name="data_test.pt",
                     transform_list=dataset_config.get("transforms", []),
+                    large_dataset=dataset_config.get("large_dataset", False),
                     dataset_device=dataset_config.get("dataset_device", "cpu"),
+                    memory_map=dataset_config.get("memory_map", False),
                 )                
             if dataset_config["src"].get("predict"):
                 dataset["predict"] = get_dataset(
                     dataset_path,
                     processed_file_name="data_predict.pt",
                     transform_list=dataset_config.get("transforms", []),
+                    large_dataset=dataset_config.get("large_dataset", False),
                     dataset_device=dataset_config.get("dataset_device", "cpu"),
+                    memory_map=dataset_config.get("memory_map", False),
                 )
 
         else:
@@ -245,7 +274,9 @@ class BaseTrainer(ABC):
                     dataset_path,
                     processed_file_name="data.pt",
                     transform_list=dataset_config.get("transforms", []),
+                    large_dataset=dataset_config.get("large_dataset", False),
                     dataset_device=dataset_config.get("dataset_device", "cpu"),
+                    memory_map=dataset_config.get("memory_map", False),
                 )
                 train_ratio = dataset_config["train_ratio"]
                 val_ratio = dataset_config["val_ratio"]
@@ -262,7 +293,9 @@ class BaseTrainer(ABC):
                     dataset_path,
                     processed_file_name="data.pt",
                     transform_list=dataset_config.get("transforms", []),
+                    large_dataset=dataset_config.get("large_dataset", False),
                     dataset_device=dataset_config.get("dataset_device", "cpu"),
+                    memory_map=dataset_config.get("memory_map", False),
                 )
 
         return dataset
@@ -294,6 +327,8 @@ class BaseTrainer(ABC):
 
             if graph_config["node_dim"]:
                 node_dim = graph_config["node_dim"]
+            elif model_config.get("otf_node_attr", False):
+                node_dim = node_rep_table(graph_config.get("node_representation", "onehot")).shape[1]
             else:
                 node_dim = dataset.num_features
             edge_dim = graph_config["edge_dim"]
@@ -318,6 +353,8 @@ class BaseTrainer(ABC):
             else:
                 model_config["prediction_level"] = graph_config["prediction_level"]
 
+            # otf node features use the same representation as preprocessing
+            model_config.setdefault("node_representation", graph_config.get("node_representation", "onehot"))
             model_cls = registry.get_model_class(model_config["name"])
             model = model_cls(
                     node_dim=node_dim, 
@@ -378,7 +415,25 @@ class BaseTrainer(ABC):
         else:
             dataset = dataset[list(dataset.keys())[0]]
 
-        if world_size > 1:
+        if optim_config.get("batch_max_atoms") or optim_config.get("batch_max_edges"):
+            sampler = SizeBucketBatchSampler(
+                dataset,
+                max_atoms=optim_config.get("batch_max_atoms"),
+                max_edges=optim_config.get("batch_max_edges"),
+                max_graphs=optim_config.get("batch_max_graphs"),
+                num_replicas=world_size,
+                rank=rank if world_size > 1 else 0,
+                seed=optim_config.get("seed", 0),
+            )
+        elif ShardSampler.supports(dataset):
+            # large_dataset: read the shards one after the other
+            sampler = ShardSampler(
+                dataset,
+                num_replicas=world_size,
+                rank=rank if world_size > 1 else 0,
+                seed=optim_config.get("seed", 0),
+            )
+        elif world_size > 1:
             sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank)
         else:
             sampler = None
@@ -390,24 +445,37 @@ class BaseTrainer(ABC):
         data_loader = [{} for _ in range(model_config["model_ensemble"])]
     
         batch_size = optim_config.get("batch_size")
+
+        # ensemble members consume the same batches, one set of loaders is enough
+        num_loaders = 1 if optim_config.get("shared_batches", False) else model_config["model_ensemble"]
         
-        for i in range(model_config["model_ensemble"]):
-            if dataset.get("train"):
+        def eval_sampler(split_dataset):
+            # sharded datasets are evaluated shard by shard
+            return ShardSampler(split_dataset, shuffle=False) if ShardSampler.supports(split_dataset) else None
+
+        for i in range(num_loaders):
+            if dataset.get("train") and isinstance(sampler, SizeBucketBatchSampler):
+                data_loader[i]["train_loader"] = get_dataloader(
+                    dataset["train"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), batch_sampler=sampler
+                )
+            elif dataset.get("train"):
                 data_loader[i]["train_loader"] = get_dataloader(
                     dataset["train"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), sampler=sampler
                 )
             if dataset.get("val"):
                 data_loader[i]["val_loader"] = get_dataloader(
-                    dataset["val"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), sampler=None
+                    dataset["val"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), sampler=eval_sampler(dataset["val"])
                 )
             if dataset.get("test"):
                 data_loader[i]["test_loader"] = get_dataloader(
-                    dataset["test"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), sampler=None
+                    dataset["test"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), sampler=eval_sampler(dataset["test"])
             )
             if run_mode == "predict" and dataset.get("predict"):
                 data_loader[i]["predict_loader"] = get_dataloader(
                     dataset["predict"], batch_size=batch_size, num_workers=dataset_config.get("num_workers", 0), sampler=None, shuffle=True
             )
+        for i in range(num_loaders, model_config["model_ensemble"]):
+            data_loader[i] = data_loader[0]
 
         return data_loader
 
@@ -447,6 +515,12 @@ class BaseTrainer(ABC):
     def predict(self):
         """Implemented by derived classes."""
 
+    def _prefetch(self, loader):
+        """Wraps a loader in a BatchPrefetcher if prefetch_batches is set"""
+        if self.prefetch_batches:
+            return BatchPrefetcher(loader, self.rank, self.prefetch_batches)
+        return loader
+
     def update_best_model(self, metric, index=None, write_model=False, write_csv=False):
         """Updates the best val metric and model, saves the best model, and saves the best model predictions"""
         self.best_metric[index] = metric[type(self.loss_fn).__name__]["metric"]
@@ -561,41 +635,21 @@ class BaseTrainer(ABC):
         
         return filename
 
-    def save_results(self, output, results_dir, filename, node_level_predictions=False, labels=True, std=False):
+    def open_results(self, results_dir, filename, num_columns, node_level_predictions=False, labels=True, std=False):
+        """Opens a PredictionWriter for results with num_columns columns in the configured output format"""
         results_path = os.path.join(
             self.save_dir, "results", self.timestamp_id, results_dir
         )
         os.makedirs(results_path, exist_ok=True)
         filename = os.path.join(results_path, filename)
-        shape = output.shape
 
-        id_headers = ["structure_id"]
-        if node_level_predictions:
-            id_headers += ["node_id"]
-            
-        if labels==True:
-            if std == True:
-                num_cols = (shape[1] - len(id_headers)) // 3
-                headers = id_headers + ["target"] * num_cols + ["prediction"] * num_cols + ["std"] * num_cols
-            else:
-                num_cols = (shape[1] - len(id_headers)) // 2
-                headers = id_headers + ["target"] * num_cols + ["prediction"] * num_cols            
-        else:
-            if std == True:
-                num_cols = (shape[1] - len(id_headers)) // 2
-                headers = id_headers + ["prediction"] * num_cols + ["std"] * num_cols        
-            else:
-                num_cols = (shape[1] - len(id_headers))
-                headers = id_headers + ["prediction"] * num_cols     
-                        
-        with open(filename, "w") as f:
-            csvwriter = csv.writer(f)
-            for i in range(0, len(output)+1):
-                if i == 0:
-                    csvwriter.writerow(headers)
-                elif i > 0:
-                    csvwriter.writerow(output[i - 1, :])
-        return filename
+        headers, num_id_columns = prediction_headers(num_columns, node_level_predictions, labels, std)
+        return PredictionWriter(filename, headers, num_id_columns, file_format=self.output_format)
+
+    def save_results(self, output, results_dir, filename, node_level_predictions=False, labels=True, std=False):
+        writer = self.open_results(results_dir, filename, output.shape[1], node_level_predictions, labels, std)
+        writer.write(output)
+        return writer.close()
 
     # TODO: streamline this from PR #12
     def load_checkpoint(self, load_training_state=True):
@@ -1,3 +1,4 @@
+import copy
 import logging
 import time
 
@@ -7,7 +8,10 @@ from torch import distributed as dist
 from torch.cuda.amp import autocast
 
 from tqdm import tqdm
-from matdeeplearn.common.data import get_dataloader
+from matdeeplearn.common.data import (SizeBucketBatchSampler,
+                                      gather_graph_edges, gather_graphs,
+                                      get_dataloader)
+from matdeeplearn.common.precision import inference_autocast, to_fp32
 from matdeeplearn.common.registry import registry
 from matdeeplearn.modules.evaluator import Evaluator
 from matdeeplearn.trainers.base_trainer import BaseTrainer
@@ -36,6 +40,11 @@ class PropertyTrainer(BaseTrainer):
         save_dir,
         checkpoint_path,
         use_amp,
+        prefetch_batches=0,
+        shared_batches=False,
+        bootstrap=False,
+        output_format="csv",
+        inference_precision="fp32",
     ):
         super().__init__(
             model,
@@ -57,6 +66,11 @@ class PropertyTrainer(BaseTrainer):
             save_dir,
             checkpoint_path,          
             use_amp,
+            prefetch_batches,
+            shared_batches,
+            bootstrap,
+            output_format,
+            inference_precision,
         )
 
     def train(self):
@@ -92,8 +106,8 @@ class PropertyTrainer(BaseTrainer):
                 self.train_sampler.set_epoch(epoch)
             # skip_steps = self.step % len(self.train_loader)
             train_loader_iter = []
-            for i in range(len(self.model)):
-                train_loader_iter.append(iter(self.data_loader[i]["train_loader"]))
+            for i in range(1 if self.shared_batches else len(self.model)):
+                train_loader_iter.append(iter(self._prefetch(self.data_loader[i]["train_loader"])))
             # metrics for every epoch
             _metrics = [{} for _ in range(len(self.model))]
             
@@ -106,7 +120,10 @@ class PropertyTrainer(BaseTrainer):
                 batch = []
                 for n, mod in enumerate(self.model):
                     mod.train()
-                    batch.append(next(train_loader_iter[n]).to(self.rank))
+                    if not self.shared_batches:
+                        batch.append(next(train_loader_iter[n]).to(self.rank))
+                if self.shared_batches:
+                    batch = self._share_batch(next(train_loader_iter[0]).to(self.rank), self.bootstrap)
                 # Get a batch of train data
                 # batch = next(train_loader_iter).to(self.rank) 
                 # print(epoch, i, torch.cuda.memory_allocated() / (1024 * 1024), torch.cuda.memory_cached() / (1024 * 1024), torch.sum(batch.n_atoms))          
@@ -204,7 +221,7 @@ class PropertyTrainer(BaseTrainer):
         evaluator, metrics = Evaluator(), [{} for _ in range(len(self.model))]
 
         loader_iter = []
-        for i in range(len(self.model)):
+        for i in range(1 if self.shared_batches else len(self.model)):
             if split == "val":
                 loader_iter.append(iter(self.data_loader[i]["val_loader"]))
             elif split == "test":
@@ -215,8 +232,11 @@ class PropertyTrainer(BaseTrainer):
         for i in range(0, len(loader_iter[0])):
             #print(i, torch.cuda.memory_allocated() / (1024 * 1024), torch.cuda.memory_cached() / (1024 * 1024))  
             batch = []
-            for i in range(len(self.model)):
-                batch.append(next(loader_iter[i]).to(self.rank))
+            if self.shared_batches:
+                batch = self._share_batch(next(loader_iter[0]).to(self.rank))
+            else:
+                for i in range(len(self.model)):
+                    batch.append(next(loader_iter[i]).to(self.rank))
             
             out_list = self._forward(batch)
             loss = self._compute_loss(out_list, batch)
@@ -240,23 +260,37 @@ class PropertyTrainer(BaseTrainer):
 
         # TODO: make this compatible with model ensemble
         if str(self.rank) not in ("cpu", "cuda"):
-            loader = get_dataloader(
-                loader.dataset, batch_size=loader.batch_size, sampler=None
-            )
+            if isinstance(loader.batch_sampler, SizeBucketBatchSampler):
+                loader = get_dataloader(
+                    loader.dataset, batch_size=None, batch_sampler=loader.batch_sampler.unsharded()
+                )
+            else:
+                loader = get_dataloader(
+                    loader.dataset, batch_size=loader.batch_size, sampler=None
+                )
             
         evaluator, metrics = Evaluator(), {}
-        predict, target = None, None
-        ids = []
-        ids_pos_grad = []
-        target_pos_grad = None
-        ids_cell_grad = []
-        target_cell_grad = None
+        ensemble = len(self.model) > 1
+        # per batch results, concatenated once at the end
+        ids, predict_mean, stds, target = [], [], [], []
         node_level = False 
+        # results are streamed to the output files batch by batch
+        writers = {}
+
+        def write(filename, rows, node_level_predictions, has_labels, std):
+            if not write_output:
+                return
+            if filename not in writers:
+                writers[filename] = self.open_results(
+                    results_dir, filename, rows.shape[1], node_level_predictions, has_labels, std
+                )
+            writers[filename].write(rows)
                 
         loader_iter = iter(loader)        
         for i in range(0, len(loader_iter)):
             batch = next(loader_iter).to(self.rank)
-            out_list = self._forward([batch])
+            with inference_autocast(self.inference_precision, self.device):
+                out_list = [to_fp32(o) for o in self._forward([batch])]
             
             out = {}
             out_stack={}            
@@ -286,9 +320,10 @@ class PropertyTrainer(BaseTrainer):
                     batch_t = batch[self.model[0].module.target_attr].cpu().numpy()
                 else:
                     batch_t = batch[self.model[0].target_attr].cpu().numpy()
+                target.append(batch_t)
                         
             # Node level prediction 
-            if batch_p[0].shape[0] > loader.batch_size: 
+            if batch_p[0].shape[0] > batch.num_graphs: 
                 node_level = True
                 node_ids = batch.z.cpu().numpy()
                 structure_ids = np.repeat(
@@ -304,99 +339,66 @@ class PropertyTrainer(BaseTrainer):
                     batch.structure_id, batch.n_atoms.cpu().numpy(), axis=0
                 )
                 batch_ids_pos_grad = np.column_stack((structure_ids_pos_grad, node_ids_pos_grad)) 
-                ids_pos_grad = batch_ids_pos_grad if i == 0 else np.row_stack((ids_pos_grad, batch_ids_pos_grad))            
-                predict_pos_grad = batch_p_pos_grad if i == 0 else np.concatenate((predict_pos_grad, batch_p_pos_grad), axis=0)
-                predict_pos_grad_std = batch_p_pos_grad_std if i == 0 else np.concatenate((predict_pos_grad_std, batch_p_pos_grad_std), axis=0)
                 if "forces" in batch:
                     batch_t_pos_grad = batch["forces"].cpu().numpy()      
-                    target_pos_grad = batch_t_pos_grad if i == 0 else np.concatenate((target_pos_grad, batch_t_pos_grad), axis=0)
+                    if ensemble:
+                        rows = np.column_stack((batch_ids_pos_grad, batch_t_pos_grad, batch_p_pos_grad, batch_p_pos_grad_std))
+                    else:
+                        rows = np.column_stack((batch_ids_pos_grad, batch_t_pos_grad, batch_p_pos_grad))
+                    write(f"{split}_predictions_pos_grad.csv", rows, True, True, ensemble)
+                else:
+                    rows = np.column_stack((batch_ids_pos_grad, batch_p_pos_grad))
+                    write(f"{split}_predictions_pos_grad.csv", rows, True, False, False)
 
             if out.get("cell_grad") != None:  
                 batch_p_cell_grad = out["cell_grad"].data.view(out["cell_grad"].data.size(0), -1).cpu().numpy()
                 batch_p_cell_grad_std = out["cell_grad_std"].data.view(out["cell_grad"].data.size(0), -1).cpu().numpy()
                 batch_ids_cell_grad = batch.structure_id               
-                ids_cell_grad = batch_ids_cell_grad if i == 0 else np.row_stack((ids_cell_grad, batch_ids_cell_grad))            
-                predict_cell_grad = batch_p_cell_grad if i == 0 else np.concatenate((predict_cell_grad, batch_p_cell_grad), axis=0)
-                predict_cell_grad_std = batch_p_cell_grad_std if i == 0 else np.concatenate((predict_cell_grad_std, batch_p_cell_grad_std), axis=0)
                 if "stress" in batch:
                     batch_t_cell_grad = batch["stress"].view(out["cell_grad"].data.size(0), -1).cpu().numpy()
-                    target_cell_grad = batch_t_cell_grad if i == 0 else np.concatenate((target_cell_grad, batch_t_cell_grad), axis=0)                          
+                    if ensemble:
+                        rows = np.column_stack((batch_ids_cell_grad, batch_t_cell_grad, batch_p_cell_grad, batch_p_cell_grad_std))
+                    else:
+                        rows = np.column_stack((batch_ids_cell_grad, batch_t_cell_grad, batch_p_cell_grad))
+                    write(f"{split}_predictions_cell_grad.csv", rows, False, True, ensemble)
+                else:
+                    rows = np.column_stack((batch_ids_cell_grad, batch_p_cell_grad))
+                    write(f"{split}_predictions_cell_grad.csv", rows, False, False, False)
             
-            ids = batch_ids if i == 0 else np.row_stack((ids, batch_ids))   
-            predict_mean = batch_p_mean if i == 0 else np.concatenate((predict_mean, batch_p_mean), axis=0)       
-            stds = batch_stds if i == 0 else np.row_stack((stds, batch_stds))    
-            if i == 0:                        
-                predict = [0 for _ in range(len(self.model))]        
-            for x in range(len(self.model)):
-                predict[x] = batch_p[x] if i == 0 else np.concatenate((predict[x], batch_p[x]), axis=0)
+            ids.append(np.asarray(batch_ids))
+            predict_mean.append(batch_p_mean)
+            stds.append(batch_stds)
 
             if labels == True:
-                target = batch_t if i == 0 else np.concatenate((target, batch_t), axis=0)
+                if ensemble:
+                    write(f"{split}_predictions.csv", np.column_stack((batch_ids, batch_t, batch_p_mean, batch_stds)), node_level, True, True)
+                    for x in range(len(self.model)):
+                        write(f"{split}_predictions_{x}.csv", np.column_stack((batch_ids, batch_t, batch_p[x])), node_level, True, False)
+                else:
+                    write(f"{split}_predictions.csv", np.column_stack((batch_ids, batch_t, batch_p_mean)), node_level, True, False)
+            else:
+                if ensemble:
+                    write(f"{split}_predictions.csv", np.column_stack((batch_ids, batch_p_mean, batch_stds)), node_level, False, True)
+                    for x in range(len(self.model)):
+                        write(f"{split}_predictions_{x}.csv", np.column_stack((batch_ids, batch_p[x])), node_level, False, False)
+                else:
+                    write(f"{split}_predictions.csv", np.column_stack((batch_ids, batch_p_mean)), node_level, False, False)
             
             if labels == True:
                 del loss, batch, out 
             else:  
                 del batch, out 
-                       
-        if write_output == True:
-            if labels == True:
-                if len(self.model) > 1:    
-                    self.save_results(
-                        np.column_stack((ids, target, predict_mean, stds)), results_dir, f"{split}_predictions.csv", node_level, True, std=True,
-                    )                                                         
-                    for x in range(len(self.model)):
-                        mod = str(x)                                                            
-                        self.save_results(
-                            np.column_stack((ids, target, predict[x])), results_dir, f"{split}_predictions_{mod}.csv", node_level, True, std=False,
-                        )
-                else: 
-                    self.save_results(
-                        np.column_stack((ids, target, predict_mean)), results_dir, f"{split}_predictions.csv", node_level, True, std=False,
-                    )                                     
-            else:
-                if len(self.model) > 1:  
-                    self.save_results(
-                        np.column_stack((ids, predict_mean, stds)), results_dir, f"{split}_predictions.csv", node_level, False, std=True,
-                    )                    
-                    for x in range(len(self.model)):
-                        mod = str(x)
-                        self.save_results(
-                        	np.column_stack((ids, predict[x])), results_dir, f"{split}_predictions_{mod}.csv", node_level, False, std=False,
-                        )
-                else: 
-                    self.save_results(
-                        np.column_stack((ids, predict_mean)), results_dir, f"{split}_predictions.csv", node_level, False, std=False,
-                    )                                   
-            #if out.get("pos_grad") != None:
-            if len(ids_pos_grad) > 0:
-                if isinstance(target_pos_grad, np.ndarray):
-                    if len(self.model) > 1: 
-                        self.save_results(
-                            np.column_stack((ids_pos_grad, target_pos_grad, predict_pos_grad, predict_pos_grad_std)), results_dir, f"{split}_predictions_pos_grad.csv", True, True, std=True
-                        )
-                    else:
-                        self.save_results(
-                            np.column_stack((ids_pos_grad, target_pos_grad, predict_pos_grad)), results_dir, f"{split}_predictions_pos_grad.csv", True, True, std=False
-                        )                    
-                else:
-                    self.save_results(
-                        np.column_stack((ids_pos_grad, predict_pos_grad)), results_dir, f"{split}_predictions_pos_grad.csv", True, False, std=False
-                    )
-            #if out.get("cell_grad") != None:
-            if len(ids_cell_grad) > 0:
-                if isinstance(target_cell_grad, np.ndarray):
-                    if len(self.model) > 1: 
-                        self.save_results(
-                            np.column_stack((ids_cell_grad, target_cell_grad, predict_cell_grad, predict_cell_grad_std)), results_dir, f"{split}_predictions_cell_grad.csv", False, True, std=True
-                        )
-                    else:
-                        self.save_results(
-                            np.column_stack((ids_cell_grad, target_cell_grad, predict_cell_grad)), results_dir, f"{split}_predictions_cell_grad.csv", False, True, std=False
-                        )                    
-                else:
-                    self.save_results(
-                        np.column_stack((ids_cell_grad, predict_cell_grad)), results_dir, f"{split}_predictions_cell_grad.csv", False, False, std=False
-                    )
+
+        for writer in writers.values():
+            writer.close()
+
+        ids = np.row_stack(ids)
+        predict_mean = np.concatenate(predict_mean, axis=0)
+        stds = np.row_stack(stds)
+        if labels == True:
+            target = np.concatenate(target, axis=0)
+        else:
+            target = None
                                                             
         if labels == True:
             predict_loss = metrics[type(self.loss_fn).__name__]["metric"]
@@ -423,9 +425,14 @@ class PropertyTrainer(BaseTrainer):
         assert len(loader) == 1, f"Predicting by calculator only allows one structure at a time, but got {len(loader)} structures."
 
         if str(self.rank) not in ("cpu", "cuda"):
-            loader = get_dataloader(
-                loader.dataset, batch_size=loader.batch_size, sampler=None
-            )
+            if isinstance(loader.batch_sampler, SizeBucketBatchSampler):
+                loader = get_dataloader(
+                    loader.dataset, batch_size=None, batch_sampler=loader.batch_sampler.unsharded()
+                )
+            else:
+                loader = get_dataloader(
+                    loader.dataset, batch_size=loader.batch_size, sampler=None
+                )
             
         results = []
         loader_iter = iter(loader)
@@ -450,6 +457,88 @@ class PropertyTrainer(BaseTrainer):
         
         return results
 
+    def _share_batch(self, batch, bootstrap=False):
+        """
+        one batch for every ensemble member; with bootstrap each member gets
+        its own resample (with replacement) of the structures in the batch
+
+        Members get shallow copies sharing the tensors of the batch, since
+        models with gradients replace pos, cell and displacement on their
+        input (see BaseModel.generate_graph). The on-the-fly graph is
+        searched once per batch (see _share_graph) and resamples gather
+        their edges from it.
+        """
+        graph = self._share_graph(batch)
+        if not bootstrap:
+            member_batches = [copy.copy(batch) for _ in range(len(self.model))]
+            if graph is not None:
+                for member_batch in member_batches:
+                    for key, value in graph.items():
+                        member_batch[key] = value
+            return member_batches
+        member_batches = []
+        for _ in range(len(self.model)):
+            idx = torch.randint(batch.num_graphs, (batch.num_graphs,))
+            member_batch = gather_graphs(batch, batch._slice_dict, idx, batch._inc_dict)
+            if graph is not None:
+                keys = [key for key in graph if key not in ("shared_edge_index", "shared_neighbors")]
+                edge_index, values, counts = gather_graph_edges(
+                    batch, graph["shared_edge_index"], idx, [graph[key] for key in keys]
+                )
+                member_batch.shared_edge_index = edge_index
+                for key, value in zip(keys, values):
+                    member_batch[key] = value
+                if "shared_neighbors" in graph:
+                    member_batch.shared_neighbors = counts
+            member_batches.append(member_batch)
+        return member_batches
+
+    def _share_graph(self, batch):
+        """
+        search the on-the-fly graph of batch once for all ensemble members
+        (edges, distances, distance vectors and, for the ocp method, cell
+        offsets and neighbor counts), or None if the members build no graph
+        or different ones. The members reuse it in
+        BaseModel.generate_graph; with gradients they only recompute the
+        distances from their positions.
+        """
+        models = [getattr(model, "module", model) for model in self.model]
+        settings = {
+            (
+                model.otf_edge_index,
+                model.cutoff_radius,
+                model.n_neighbors,
+                model.graph_method,
+                model.num_offsets,
+                model.edge_padding is not None and getattr(model, "static_shapes", False),
+            )
+            for model in models
+        }
+        if len(settings) > 1:
+            return None
+        otf_edge_index, _, _, _, _, padded = settings.pop()
+        # padded edges are added by each member after the search
+        if not otf_edge_index or padded:
+            return None
+
+        search_batch = copy.copy(batch)
+        search_batch.gradient = False
+        with torch.no_grad():
+            edge_index, edge_weight, edge_vec, cell_offsets, offset_distance, neighbors = models[0].generate_graph(
+                search_batch, models[0].cutoff_radius, models[0].n_neighbors
+            )
+        graph = {
+            "shared_edge_index": edge_index,
+            "shared_edge_weight": edge_weight,
+            "shared_edge_vec": edge_vec,
+        }
+        # the mdl method has no per-edge cell offsets
+        if neighbors is not None:
+            graph["shared_cell_offsets"] = cell_offsets
+            graph["shared_offset_distance"] = offset_distance
+            graph["shared_neighbors"] = neighbors
+        return graph
+
     def _forward(self, batch_data):
         if len(batch_data) > 1:
             output = []